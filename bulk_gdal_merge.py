@@ -4,12 +4,20 @@
 # Purpose: a wrapper function for gdal_merge which merges GeoTiff tif files in multiple sub-folders
 #          to be knitted together into a single file.  An output txt file listing the knitted tif files
 #          is also output, dated with the time of processing.
+#          Using -tiled, the tifs are instead indexed as a virtual mosaic (VRT), which is merged into a
+#          tiled, compressed GeoTiff in windows of -tile_size pixels across a pool of -processes, so
+#          memory use is bounded by the window size rather than the output extent.  A manifest of the
+#          modification times, sizes and extents of the merged tifs is kept alongside the output; on
+#          re-running, only windows intersecting added, changed or removed tifs are merged again.
+#          This requires the GDAL Python bindings (osgeo), and numpy.
 
 import os
 import sys
 import datetime
 import argparse
 import subprocess as sp
+import json
+import multiprocessing
 
 cwd = os.path.dirname(sys.argv[0])
 print(cwd)
@@ -35,22 +43,160 @@ parser.add_argument('-gdal_loc',
                     help='location of the gdal_merge.py script',
                     default='C:/OSGeo4W64/bin/gdal_merge.py',
                     type=str)
+parser.add_argument('-tiled',
+                    help='merge using a virtual mosaic, in windows across a process pool, skipping unchanged inputs on re-runs (requires the GDAL Python bindings)',
+                    action='store_true')
+parser.add_argument('-tile_size',
+                    help='width and height in pixels of the windows merged by each process (default: 4096)',
+                    default=4096,
+                    type=int)
+parser.add_argument('-processes',
+                    help='number of processes merging windows (default: number of CPUs)',
+                    default=multiprocessing.cpu_count(),
+                    type=int)
 args = parser.parse_args()
 
-# initialise tif list file 
-tif_list_name = 'tif_list_{date:%Y-%m-%d}.txt'.format( date=datetime.datetime.now() )
-tif_list_path  = os.path.join(args.dir,tif_list_name)
-tif_list = open(tif_list_path, "w")
-
-# iterate of files within root or otherwise specified directory, noting all tifs
-count = 0
-for root, dirs, files in os.walk(args.dir):
-    for file in files:
-        if file.endswith(".tif"):
-            tif_list.write('{}\n'.format(os.path.join(root, file)))
-            count += 1
-tif_list.close()             
-print('Compiled a list of {} tifs.'.format(count))            
-# merge tifs 
-command = 'python {gm} -v -o {outfile} --optfile {tif_list}'.format(gm = args.gdal_loc, outfile = args.outfile, tif_list =tif_list_name)
-sp.call(command, shell=True, cwd=cwd)
+def tif_manifest(tifs):
+    """
+        Return a dictionary of the modification time, size and extent of each tif.
+    """
+    from osgeo import gdal
+    manifest = {}
+    for tif in tifs:
+        ds = gdal.Open(tif)
+        gt = ds.GetGeoTransform()
+        xs = [gt[0], gt[0] + ds.RasterXSize * gt[1]]
+        ys = [gt[3], gt[3] + ds.RasterYSize * gt[5]]
+        manifest[tif] = {'mtime': os.path.getmtime(tif),
+                         'size': os.path.getsize(tif),
+                         'extent': [min(xs), min(ys), max(xs), max(ys)]}
+        ds = None
+    return manifest
+
+def changed_extents(previous, current):
+    """
+        Return the extents of tifs which have been added, changed or removed since the
+        previous manifest.
+    """
+    extents = []
+    for tif, entry in current.items():
+        before = previous.get(tif)
+        if before is None or before['mtime'] != entry['mtime'] or before['size'] != entry['size']:
+            extents.append(entry['extent'])
+            if before is not None:
+                extents.append(before['extent'])
+    extents += [entry['extent'] for tif, entry in previous.items() if tif not in current]
+    return extents
+
+def windows(xsize, ysize, tile_size, gt, extents = None):
+    """
+        Yield (xoff, yoff, width, height) windows covering the raster, or only those 
+        intersecting the given extents.
+    """
+    for yoff in range(0, ysize, tile_size):
+        for xoff in range(0, xsize, tile_size):
+            width, height = min(tile_size, xsize - xoff), min(tile_size, ysize - yoff)
+            if extents is not None:
+                xs = [gt[0] + xoff * gt[1], gt[0] + (xoff + width) * gt[1]]
+                ys = [gt[3] + yoff * gt[5], gt[3] + (yoff + height) * gt[5]]
+                if not any([e[0] < max(xs) and e[2] > min(xs) and e[1] < max(ys) and e[3] > min(ys) for e in extents]):
+                    continue
+            yield (xoff, yoff, width, height)
+
+def open_mosaic(vrt_path):
+    """
+        Open the virtual mosaic in a merging process.
+    """
+    global mosaic
+    from osgeo import gdal
+    mosaic = gdal.Open(vrt_path)
+
+def read_window(window):
+    """
+        Read a window of each band of the virtual mosaic, merging the tifs it covers.
+    """
+    xoff, yoff, width, height = window
+    return window, [mosaic.GetRasterBand(b + 1).ReadAsArray(xoff, yoff, width, height) for b in range(mosaic.RasterCount)]
+
+def tiled_merge(tifs, outfile):
+    """
+        Merge tifs into a tiled, compressed GeoTiff via a virtual mosaic, in windows across 
+        a process pool, re-merging only windows affected by changed inputs on re-runs.
+    """
+    from osgeo import gdal
+    manifest_path = '{}.manifest.json'.format(outfile)
+    vrt_path = '{}.vrt'.format(os.path.splitext(outfile)[0])
+    current = tif_manifest(tifs)
+    previous = {}
+    if os.path.exists(manifest_path) and os.path.exists(outfile):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    vrt = gdal.BuildVRT(vrt_path, sorted(tifs))
+    geometry = {'size': [vrt.RasterXSize, vrt.RasterYSize, vrt.RasterCount], 'geotransform': list(vrt.GetGeoTransform())}
+    extents = None
+    if previous.get('geometry') == geometry:
+        extents = changed_extents(previous['tifs'], current)
+        if len(extents) == 0:
+            print('All {} tifs are unchanged since {} was merged.'.format(len(tifs), outfile))
+            return
+        out = gdal.Open(outfile, gdal.GA_Update)
+    else:
+        # the manifest is only written once the merge has completed
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        band = vrt.GetRasterBand(1)
+        out = gdal.GetDriverByName('GTiff').Create(outfile, vrt.RasterXSize, vrt.RasterYSize, vrt.RasterCount, band.DataType,
+                                                   options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER',
+                                                            'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+        out.SetGeoTransform(vrt.GetGeoTransform())
+        out.SetProjection(vrt.GetProjection())
+        for b in range(vrt.RasterCount):
+            nodata = vrt.GetRasterBand(b + 1).GetNoDataValue()
+            if nodata is not None:
+                out.GetRasterBand(b + 1).SetNoDataValue(nodata)
+    gt = vrt.GetGeoTransform()
+    todo = list(windows(vrt.RasterXSize, vrt.RasterYSize, args.tile_size, gt, extents))
+    vrt = None
+    print('Merging {} windows of {} tifs across {} processes{}.'.format(len(todo), len(tifs), args.processes, 
+                                                                       '' if extents is None else ' ({} changed inputs)'.format(len(extents))))
+    pool = multiprocessing.Pool(args.processes, initializer=open_mosaic, initargs=(vrt_path,))
+    # windows are read in batches, so that at most a batch of windows is held in memory
+    batch = 2 * args.processes
+    for start in range(0, len(todo), batch):
+        for (xoff, yoff, width, height), arrays in pool.imap_unordered(read_window, todo[start:start + batch]):
+            for b, array in enumerate(arrays):
+                out.GetRasterBand(b + 1).WriteArray(array, xoff, yoff)
+        print('  {} of {} windows merged'.format(min(start + batch, len(todo)), len(todo)))
+    pool.close()
+    pool.join()
+    out.FlushCache()
+    out = None
+    with open(manifest_path, 'w') as f:
+        json.dump({'geometry': geometry, 'tifs': current}, f, indent=2, sort_keys=True)
+    print('Merged {} tifs to {}.'.format(len(tifs), outfile))
+
+# (merging processes re-import this script, so only the main process runs the merge)
+if __name__ == '__main__':
+    # initialise tif list file 
+    tif_list_name = 'tif_list_{date:%Y-%m-%d}.txt'.format( date=datetime.datetime.now() )
+    tif_list_path  = os.path.join(args.dir,tif_list_name)
+    tif_list = open(tif_list_path, "w")
+    
+    # iterate of files within root or otherwise specified directory, noting all tifs (other than the output)
+    count = 0
+    tifs = []
+    outfile = os.path.abspath(os.path.join(cwd, args.outfile))
+    for root, dirs, files in os.walk(args.dir):
+        for file in files:
+            if file.endswith(".tif") and os.path.abspath(os.path.join(root, file)) != outfile:
+                tif_list.write('{}\n'.format(os.path.join(root, file)))
+                tifs.append(os.path.join(root, file))
+                count += 1
+    tif_list.close()             
+    print('Compiled a list of {} tifs.'.format(count))            
+    # merge tifs 
+    if args.tiled:
+        tiled_merge(tifs, outfile)
+    else:
+        command = 'python {gm} -v -o {outfile} --optfile {tif_list}'.format(gm = args.gdal_loc, outfile = args.outfile, tif_list =tif_list_name)
+        sp.call(command, shell=True, cwd=cwd)
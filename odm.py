@@ -35,12 +35,24 @@ from org.opentripplanner.scripting.api import OtpsEntryPoint
 from datetime import datetime,timedelta
 import sys
 import csv
+import threading, Queue
+import subprocess
+import math
+import json
+import struct
+import hashlib
 
-from java.lang import Class
-from java.sql  import DriverManager, SQLException
+from java.lang import Class, String, Throwable
+from java.util import ArrayList, Calendar, TimeZone
+from java.sql  import DriverManager, SQLException, Types
+from java.io   import RandomAccessFile
+from java.nio  import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
 from com.ziclix.python.sql import zxJDBC
 from java.text import SimpleDateFormat
 
+from odm_metrics import Metrics, clock
+
 # To debug using the server you can run:
 # java -Xmx2G -jar otp-0.19.0-shaded.jar --build ./graphs/sa1_dzn_region06_2019 --inMemory
 # and in browser:
@@ -108,28 +120,33 @@ def valid_path(arg):
         return arg   
   
 def valid_duration_reps(arg):
-    print(arg)
     if arg[0]<0:
-        msg = "The duration %s cannot be negative!" % arg
+        msg = "The duration %s cannot be negative!" % arg[0]
         raise argparse.ArgumentTypeError(msg)
     elif arg[1]<0:
-        msg = "The repeat interval %s cannot be negative!" % arg
+        msg = "The repeat interval %s cannot be negative!" % arg[1]
         raise argparse.ArgumentTypeError(msg)
     elif arg[1]>arg[0]:
-        msg = "The repeat interval {} cannot be smaller than the analysis duration {}!".format(args[1],args[0])
+        msg = "The repeat interval {} cannot be larger than the analysis duration {}!".format(arg[1],arg[0])
+        raise argparse.ArgumentTypeError(msg)
+    elif arg[0]>0 and arg[1]==0:
+        msg = "A repeat interval must be specified for the analysis duration {}!".format(arg[0])
         raise argparse.ArgumentTypeError(msg)
     else:
         return arg
         
 # Parse input arguments
 parser = argparse.ArgumentParser(description='Generate origin destination matrix')
-# Note that the time_zone argument is not implemented
 parser.add_argument('--departure_time',
                     help='departure time - format YYYY-MM-DD-HH:MM:SS',
                     required=True,
                     type=valid_date)
+parser.add_argument('--time_zone',
+                    help='Time zone of the departure time, e.g. Australia/Queensland (default: the JVM time zone, as set by run-otp.sh -t)',
+                    default=None,
+                    type=str)
 parser.add_argument('--duration_reps',
-                    help='Two optional parameters defining a time duration and a repeat interval in hours.',
+                    help='Two optional parameters defining a time duration and a repeat interval in hours.  For example, departures every 5 minutes from 07:00 to 09:00 are specified using --departure_time YYYY-MM-DD-07:00:00 --duration_reps 2 0.083333',
                     nargs=2,
                     default=[0,0],
                     type=float)                    
@@ -151,6 +168,20 @@ parser.add_argument('--outdb',
 parser.add_argument('--outtable',
                     help='path to the output sqlite database (default: traveltime_matrix)',
                     default='traveltime_matrix')
+parser.add_argument('--out_format',
+                    help='Format for results: sqlite, recorded in OUTTABLE of the output database; parquet, a partitioned (region/mode/departure time) dataset written incrementally to directory OUTDB_OUTTABLE (without the database extension), using the Python 3 interpreter given by --python with pyarrow installed (implies --checkpoint); or matrix, a dense binary matrix store OUTDB_OUTTABLE.odmx of travel times and distances for every origin and destination (one-to-many only; implies --checkpoint), which may be memory-mapped using odm_matrix.py.  Inputs, summaries and progress are recorded in the output database in any case (default: sqlite)',
+                    default='sqlite',
+                    choices=['sqlite','parquet','matrix'],
+                    type=str)
+parser.add_argument('--matrix_dtype',
+                    help='Value type of the matrix store for --out_format matrix: float32 (minutes and metres), or int16 (tenths of minutes and tens of metres; half the size) (default: float32)',
+                    default='float32',
+                    choices=['float32','int16'],
+                    type=str)
+parser.add_argument('--python',
+                    help='Python 3 interpreter used to run odm_parquet_sink.py for --out_format parquet (default: python3)',
+                    default='python3',
+                    type=str)
 parser.add_argument('--max_time',
                     help='maximum travel time in seconds (default: 1800)',
                     default=1800,
@@ -173,6 +204,31 @@ parser.add_argument('--matching',
                     help='How origins and destinations should be matched. Can be either one-to-one or one-to-many (default: one-to-many)',
                     default='one-to-many',
                     type=str)
+parser.add_argument('--reuse_modes', 
+                    help='Plan each distinct useful combination of modes once per origin (e.g. with --combinations): transit is dropped from the combinations of an origin where none of their transit modes serve stops within its reach, combinations reducing to the same modes share results, and combinations without transit are planned once across departure times',
+                    default=False,
+                    action='store_true')
+parser.add_argument('--dedup_origins', 
+                    help='For one-to-many matching, plan once for each group of origins with identical coordinates (0), or within the given tolerance in metres of the first origin of a group, writing the results for every origin ID in the group (implies --checkpoint)',
+                    default=None,
+                    type=float)
+parser.add_argument('--raster', 
+                    help='Sample each shortest path tree onto a regional grid of cells of the given size in metres, recording for each departure time and mode the minimum travel time to each cell from any origin and the number of origins reaching it within RASTER_CUTOFF, as memory-mapped rasters with GDAL VRT headers in directory OUTDB_OUTTABLE_surface',
+                    default=None,
+                    type=float)
+parser.add_argument('--raster_extent', 
+                    help='Extent of the --raster grid in decimal degrees: top bottom left right (default: the extent of the destinations, with a margin of one cell)',
+                    nargs=4,
+                    default=None,
+                    type=float)
+parser.add_argument('--raster_cutoff', 
+                    help='Travel time in minutes within which cells are counted as reached by an origin, for --raster (default: MAX_TIME)',
+                    default=None,
+                    type=float)
+parser.add_argument('--group_pairs', 
+                    help='For one-to-one matching, group the destinations paired with each distinct origin, so that one shortest path tree is planned per origin and mode and evaluated for the whole group (rather than one per pair); implied by --checkpoint',
+                    default=False, 
+                    action='store_true')
 parser.add_argument('--combinations', 
                     help='Create all combinations of supplied destination list',
                     default=False, 
@@ -188,13 +244,128 @@ parser.add_argument('--latlon_names',
                     type = str,
                     default=['lat','lon'])
 parser.add_argument('--wideform', 
-                    help='Transpose data to wideform from longform main output',
+                    help='Transpose data to wideform from longform main output: results are also recorded in table OUTTABLE_wide, with a row for each origin, destination and departure time, and travel time and distance columns for each mode; this is built as each origin is processed',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--window_output', 
+                    help='Output for a sweep of departure times (see --duration_reps): rows, a result for each departure time; summary, travel time statistics for each origin, destination and mode across the time window (recorded in table OUTTABLE_summary; implies --checkpoint); or both (default: rows)',
+                    default='rows',
+                    choices=['rows','summary','both'],
+                    type=str)
+parser.add_argument('--percentiles', 
+                    help='Percentiles of travel time across the departure time window to be recorded in the summary table, in addition to minimum, median and maximum (default: 90)',
+                    nargs='*',
+                    type = float,
+                    default=[90])
+parser.add_argument('--cutoffs', 
+                    help='Travel times in minutes (e.g. 30 45 60; up to --max_time) within which destinations reached are counted (and weighted, see --weight_column) for each origin, departure time and mode, recorded in table OUTTABLE_access along with the gravity measure (see --decay)',
+                    nargs='*',
+                    type = float,
+                    default=None)
+parser.add_argument('--weight_column', 
+                    help='Column of the destinations file weighting each destination (e.g. jobs) in the measures recorded using --cutoffs (default: each destination has weight 1)',
+                    default=None)
+parser.add_argument('--decay', 
+                    help='Decay function of travel time t (minutes) for the gravity measure recorded using --cutoffs, the sum of the weights of destinations reached multiplied by: exponential, exp(-DECAY_PARAM * t); power, max(t, 1)^-DECAY_PARAM; or linear, max(0, 1 - t / DECAY_PARAM) (default: none, no gravity measure)',
+                    default=None,
+                    choices=['exponential','power','linear'])
+parser.add_argument('--decay_param', 
+                    help='Parameter of the --decay function; greater than 0 for linear (default: 0.1 for exponential, 1 for power, the maximum time in minutes for linear)',
+                    default=None,
+                    type=float)
+parser.add_argument('--aggregate_only', 
+                    help='Record only the measures of destinations reached (see --cutoffs), and not rows for each origin and destination (nor the summary or wide form tables); implies --checkpoint',
+                    default=False,
+                    action='store_true')
+parser.add_argument('--checkpoint', 
+                    help='Record completed (origin, departure time, mode) units in a progress table (OUTTABLE_progress), in the same transaction as their results; on restart, completed units are skipped, regardless of the order of origins in the input file',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--bulk_load', 
+                    help='Write results using integer keys for origin, destination, departure time and mode (with lookup tables OUTTABLE_origin_keys etc, and a view OUTTABLE_view with the usual text columns), reused prepared statements, commits batched across origins (see --commit_every) and SQLite settings tuned for bulk loading; indexes are created once loading has finished.  Implies --checkpoint.',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--index_results', 
+                    help='Once the run has finished, build covering indexes of the results table by origin and by destination (each followed by mode, departure time and travel time), and ANALYZE it, for fast row, column and nearest destination queries (see odm_query.py); always done with --bulk_load',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--commit_every', 
+                    help='Number of origins written per transaction when using --bulk_load (default: 100)',
+                    default=100,
+                    type=int)
+parser.add_argument('--stream_inputs', 
+                    help='Read each input csv once in chunks, staging it to the database and building the OTP population in the same pass (rather than copying inputs via an intermediate _updated.csv file)',
                     default=False, 
                     action='store_true')
+parser.add_argument('--chunk_size', 
+                    help='Number of rows read and staged at a time when using --stream_inputs (default: 10000)',
+                    default=10000,
+                    type=int)
+parser.add_argument('--restage_inputs', 
+                    help='Stage the input csv files to the database even if they are unchanged since they were last staged for OUTTABLE (by default, unchanged inputs, as identified by their path, size and SHA-1 digest, are read directly into the OTP populations without being staged again)',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--prune_dests', 
+                    help='For one-to-many matching, only evaluate each shortest path tree for destinations within the straight line distance reachable within --max_time at the maximum speed of its modes (see MAX_SPEEDS); the travel time limit is still applied to the results',
+                    default=False, 
+                    action='store_true')
+parser.add_argument('--workers', 
+                    help='Number of threads planning disjoint shards of origins against the shared router; results are written in origin order by a single writer (default: 1)',
+                    default=1,
+                    type=int)
+parser.add_argument('--queue_size', 
+                    help='Maximum number of origins planned ahead of the writer, which writes results in origin order; workers pause while this many origins are being planned or awaiting the writer (default: 4 x WORKERS)',
+                    default=None,
+                    type=int)
+parser.add_argument('--progress_interval', 
+                    help='Minimum interval in seconds between progress reports (default: 10)',
+                    default=10,
+                    type=float)
+parser.add_argument('--metrics', 
+                    help='With each progress report, record timings of the plan, eval, filter and write phases by mode, throughput, estimated time remaining and heap use (see odm_metrics.py): jsonl, appended as JSON lines to OUTDB_OUTTABLE_metrics.jsonl; or table, in table OUTTABLE_metrics',
+                    default=None,
+                    choices=['jsonl','table'])
 parser.add_argument('--cmd', 
                     help='The command used to call the python script may be specified; if so it is recorded to the log txt file.',
                     default=None)
-args = parser.parse_args()
+# odm_batch.py runs jobs within a single JVM, supplying each job's arguments (job_argv)
+# and a shared OtpsEntryPoint with the job's graph loaded (shared_otp)
+job_argv   = globals().get('job_argv', None)
+shared_otp = globals().get('shared_otp', None)
+# and a cache of populations read from unchanged input files, shared between jobs (see loadPopulation)
+shared_populations = globals().get('shared_populations', None)
+args = parser.parse_args(job_argv)
+try:
+    valid_duration_reps(args.duration_reps)
+except argparse.ArgumentTypeError, msg:
+    parser.error(msg)
+if args.bulk_load:
+    # results are committed in batches across origins, so progress must be checkpointed
+    args.checkpoint = True
+if args.aggregate_only:
+    # without rows in the results table, resuming relies on the progress table
+    args.checkpoint = True
+if args.out_format in ['parquet', 'matrix']:
+    # results are written to the parquet dataset or matrix store, so resuming relies on the progress table
+    args.checkpoint = True
+if args.window_output == 'summary':
+    # without rows in the results table, resuming relies on the progress table
+    args.checkpoint = True
+if args.dedup_origins is not None:
+    # group members are written after the group's first origin, out of ID order, so resuming relies on the progress table
+    args.checkpoint = True
+if args.aggregate_only and args.cutoffs is None:
+    parser.error('--aggregate_only requires --cutoffs')
+if args.cutoffs is not None and max(args.cutoffs + [0]) > args.max_time / 60.0:
+    # results beyond --max_time are not recorded, so could not be counted
+    parser.error('--cutoffs may not exceed --max_time ({:g} minutes)'.format(args.max_time / 60.0))
+if args.decay == 'linear' and args.decay_param is not None and args.decay_param <= 0:
+    parser.error('--decay_param must be greater than 0 for linear decay')
+if args.out_format == 'matrix' and args.matching != 'one-to-many':
+    parser.error('--out_format matrix requires one-to-many matching')
+if args.checkpoint and args.matching == 'one-to-one':
+    # progress is recorded by origin, so pairs sharing an origin must be evaluated together
+    args.group_pairs = True
 
 # Get the project name from the supplied project directory
 proj_name = os.path.basename(os.path.normpath(args.proj_dir))
@@ -206,9 +377,87 @@ JDBC_DRIVER = "org.sqlite.JDBC"
 
 TABLE_NAME      = "{}".format(args.outtable)
 
+# results table columns; with --bulk_load, fields are recorded as integer keys to lookup tables
+if args.bulk_load:
+    results_columns = "origin_id INTEGER, destination_id INTEGER, dep_time_id INTEGER, mode_id INTEGER, dist_m INTEGER, time_mins REAL"
+else:
+    results_columns = "origin TEXT, destination TEXT, dep_time TEXT, mode TEXT, dist_m INTEGER, time_mins REAL"
+
+# with --bulk_load or parquet output, results are committed in batches across origins
+batched_commits = args.bulk_load or args.out_format == 'parquet'
+
+# lookup tables of integer keys for results fields, when using --bulk_load
+key_fields = ['origin', 'destination', 'dep_time', 'mode']
+result_keys = dict([(field, {}) for field in key_fields])
+
+# SQLite settings for bulk loading; page size only takes effect for a new database
+bulk_pragmas = ["PRAGMA page_size = 65536;",
+                "PRAGMA journal_mode = WAL;",
+                "PRAGMA synchronous = NORMAL;",
+                "PRAGMA cache_size = -262144;",
+                "PRAGMA temp_store = MEMORY;"]
+
+# fingerprints of the input files staged as the origins and destinations tables (see stagedInputs)
+inputs_columns = "input TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL, sha1 TEXT"
+
+# (origin, departure time, mode) units recorded as complete when using --checkpoint
+progress_columns = "origin TEXT NOT NULL, dep_time TEXT NOT NULL, mode TEXT NOT NULL, PRIMARY KEY (origin, dep_time, mode)"
+
+# Upper bounds on travel speed (metres per second) used to prune destinations beyond reach 
+# (see --prune_dests); these exceed OTP's default walk (1.33), bicycle (5) and car (40) speeds.
+# Public transport modes are bounded by the TRANSIT speed.
+MAX_SPEEDS = {'WALK': 1.5, 'BICYCLE': 6.0, 'CAR': 45.0, 'TRANSIT': 45.0}
+
+# modes travelling on the street network, and transit modes (see --reuse_modes)
+STREET_MODES = ['WALK', 'BICYCLE', 'CAR']
+TRANSIT_MODES = ['TRANSIT', 'TRAM', 'SUBWAY', 'RAIL', 'BUS', 'FERRY', 'CABLE_CAR', 'GONDOLA', 'FUNICULAR', 'AIRPLANE']
+
+# IDs of the origins in each group, by the ID of the group's first (planned) origin, when using --dedup_origins
+origin_members = {}
+
+# coordinate reference system of accessibility surfaces (see --raster)
+WGS84_WKT = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]'
+
+# destinations evaluated and potentially evaluated when using --prune_dests
+prune_counts = {'evaluated': 0, 'total': 0}
+prune_lock = threading.Lock()
+
+# serialises use of the database connection between the writer and worker threads
+db_lock = threading.RLock()
+
+# statements prepared on the results connection, for reuse; see prepareStatement
+prepared_statements = {}
+
+# origins written since the last commit when using --bulk_load
+uncommitted_origins = 0
+
+# batches written by the parquet sink are named by run and sequence (see flushParquetSink),
+# and recorded in OUTTABLE_parquet_batches when committed
+parquet_run = datetime.now().strftime('%Y%m%d%H%M%S')
+parquet_sequence = 0
+
+# snapshots of run metrics recorded when using --metrics table; timings are stored as JSON
+metrics_columns = ['recorded', 'elapsed_s', 'origins', 'total_origins', 'trees', 'rows',
+                   'trees_per_s', 'rows_per_s', 'eta_s', 'heap_used_mb', 'heap_max_mb', 'timings']
+
+# measures of destinations reached recorded when using --cutoffs
+access_columns = ['origin', 'dep_time', 'mode']
+if args.cutoffs is not None:
+    access_columns += ['count_{:g}'.format(x) for x in args.cutoffs]
+    if args.weight_column is not None:
+        access_columns += ['weight_{:g}'.format(x) for x in args.cutoffs]
+    if args.decay is not None:
+        access_columns += ['gravity']
+
+# travel time statistics recorded across a departure time window
+summary_columns = (['origin', 'destination', 'mode', 'departures', 'min_mins', 'median_mins'] 
+                   + ['p{:g}_mins'.format(q) for q in args.percentiles] 
+                   + ['max_mins'])
+
 def createTable(table,values = " 'origin', 'destination', 'dep_time','mode','dist_m', 'time_mins' "):
     """
-        Return string to create a database table pending given context (results, origins or destinations)
+        Return string to create a database table pending given context (results, origins or destinations);
+        other contexts (e.g. summary, progress) are created as tables suffixed to the results table name.
     """
     if table == "origins":
         TABLE_CREATOR   = "create table if not exists origins_{} ({});".format(TABLE_NAME,values)
@@ -216,11 +465,14 @@ def createTable(table,values = " 'origin', 'destination', 'dep_time','mode','dis
         TABLE_CREATOR   = "create table if not exists destinations_{} ({});".format(TABLE_NAME,values)
     if table == "results":
         TABLE_CREATOR   = "create table if not exists {} ({});".format(TABLE_NAME,values)
+    if table not in ["origins", "destinations", "results"]:
+        TABLE_CREATOR   = "create table if not exists {}_{} ({});".format(TABLE_NAME,table,values)
     return(TABLE_CREATOR)
 
 def insertRows(table,values="?,?,?,?,?,?"):
     """
-        Return string to insert rows to a database table pending given context (results, origins or destinations)
+        Return string to insert rows to a database table pending given context (results, origins or destinations);
+        other contexts (e.g. summary, progress) are inserted to tables suffixed to the results table name.
     """
     if table == "origins":
         RECORD_INSERTER   = "insert into origins_{} values ({});".format(TABLE_NAME,values)
@@ -228,6 +480,10 @@ def insertRows(table,values="?,?,?,?,?,?"):
         RECORD_INSERTER   = "insert into destinations_{} values ({});".format(TABLE_NAME,values)
     if table == "results":
         RECORD_INSERTER   = "insert into {} values ({});".format(TABLE_NAME,values)
+    if table in ["progress", "inputs"]:
+        RECORD_INSERTER   = "insert or replace into {}_{} values ({});".format(TABLE_NAME,table,values)
+    elif table not in ["origins", "destinations", "results"]:
+        RECORD_INSERTER   = "insert into {}_{} values ({});".format(TABLE_NAME,table,values)
     return(RECORD_INSERTER)    
 
 def getConnection(JDBC_URL, JDBC_DRIVER, sql_zxJDBC=True):
@@ -257,13 +513,22 @@ def getConnection(JDBC_URL, JDBC_DRIVER, sql_zxJDBC=True):
             sys.exit(-1)
     return dbConn
 
+def prepareStatement(dbConn, sql):
+    """
+        Return a prepared statement for the given SQL, reusing the statement if it
+        has previously been prepared (statements are prepared on the results connection).
+    """
+    if sql not in prepared_statements:
+        prepared_statements[sql] = dbConn.prepareStatement(sql)
+    return prepared_statements[sql]
+
 def populateTable(dbConn, feedstock, sql_zxJDBC = False):
     """
         Given an open connection to a SQLite database and a list of tuples
         with the data to be inserted, insert the data into the target table.
     """
     try:
-        preppedStmt = dbConn.prepareStatement(insertRows('results'))
+        preppedStmt = prepareStatement(dbConn, insertRows('results'))
         for origin, destination, dep_time, mode, dist_m, time_mins in feedstock:
             preppedStmt.setString(1, origin)
             preppedStmt.setString(2, destination)
@@ -272,122 +537,1609 @@ def populateTable(dbConn, feedstock, sql_zxJDBC = False):
             preppedStmt.setInt(5, dist_m)
             preppedStmt.setDouble(6, time_mins)
             preppedStmt.addBatch()
-        dbConn.setAutoCommit(False)
         preppedStmt.executeBatch()
-        dbConn.setAutoCommit(True)
     except SQLException, msg:
         print msg
         return False
     
     return True
     
+def resultKey(dbConn, field, value):
+    """
+        Return the integer key for a value of a results field (origin, destination, 
+        dep_time or mode), recording new values in the field's lookup table.
+    """
+    keys = result_keys[field]
+    if value not in keys:
+        keys[value] = len(keys) + 1
+        preppedStmt = prepareStatement(dbConn, insertRows('{}_keys'.format(field),'?,?'))
+        preppedStmt.setInt(1, keys[value])
+        preppedStmt.setString(2, value)
+        preppedStmt.executeUpdate()
+    return keys[value]
+
+def populateKeyedTable(dbConn, feedstock):
+    """
+        Given an open connection to a SQLite database and a list of tuples
+        with the data to be inserted, insert the data into the target table
+        using integer keys for origin, destination, departure time and mode.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('results'))
+        for origin, destination, dep_time, mode, dist_m, time_mins in feedstock:
+            preppedStmt.setInt(1, resultKey(dbConn, 'origin', origin))
+            preppedStmt.setInt(2, resultKey(dbConn, 'destination', destination))
+            preppedStmt.setInt(3, resultKey(dbConn, 'dep_time', dep_time))
+            preppedStmt.setInt(4, resultKey(dbConn, 'mode', mode.strip('"')))
+            preppedStmt.setInt(5, dist_m)
+            preppedStmt.setDouble(6, time_mins)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def prepareBulkLoad(stmt):
+    """
+        Apply bulk loading settings to the results connection, create the key lookup 
+        tables and view, drop results indexes (to be rebuilt by finishBulkLoad) and 
+        load previously recorded keys.
+    """
+    try:
+        for pragma in bulk_pragmas:
+            stmt.execute(pragma)
+        for field in key_fields:
+            stmt.execute(createTable('{}_keys'.format(field), 
+                                     "id INTEGER PRIMARY KEY, {} TEXT UNIQUE".format(field)))
+            keys = result_keys[field]
+            keys.clear()
+            rs = stmt.executeQuery("SELECT id, {field} FROM {table}_{field}_keys;".format(field = field, table = TABLE_NAME))
+            while rs.next():
+                keys[rs.getString(2)] = rs.getInt(1)
+            rs.close()
+        stmt.execute('''
+            CREATE VIEW IF NOT EXISTS {table}_view AS
+            SELECT o.origin, d.destination, t.dep_time, m.mode, r.dist_m, r.time_mins
+            FROM {table} r
+            JOIN {table}_origin_keys o ON r.origin_id = o.id
+            JOIN {table}_destination_keys d ON r.destination_id = d.id
+            JOIN {table}_dep_time_keys t ON r.dep_time_id = t.id
+            JOIN {table}_mode_keys m ON r.mode_id = m.id;
+            '''.format(table = TABLE_NAME))
+        for index in ['origin_idx', 'destination_idx', 'origin_cover', 'destination_cover']:
+            stmt.execute("DROP INDEX IF EXISTS {}_{};".format(TABLE_NAME, index))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    stmt.getConnection().setAutoCommit(False)
+
+def finishBulkLoad(stmt):
+    """
+        Commit outstanding results and build the results indexes once loading has finished.
+    """
+    try:
+        stmt.getConnection().commit()
+        stmt.getConnection().setAutoCommit(True)
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    indexResults(stmt)
+
+def indexResults(stmt):
+    """
+        Build covering indexes of the results table by origin and by destination, each 
+        followed by mode, departure time and travel time, so that an origin's row, a 
+        destination's column and, for a mode and departure time, the nearest destinations
+        or origins are read in order from an index; then ANALYZE the table for the query 
+        planner.  These match the indexes built by odm_query.py for finished databases.
+    """
+    if args.bulk_load:
+        origin, destination, mode, dep_time = 'origin_id', 'destination_id', 'mode_id', 'dep_time_id'
+    else:
+        origin, destination, mode, dep_time = 'origin', 'destination', 'mode', 'dep_time'
+    try:
+        print("Creating results indexes...")
+        for name, first, other in [('origin', origin, destination), ('destination', destination, origin)]:
+            stmt.execute("DROP INDEX IF EXISTS {}_{}_idx;".format(TABLE_NAME, name))
+            stmt.execute('''CREATE INDEX IF NOT EXISTS {table}_{name}_cover 
+                            ON {table} ({first}, {mode}, {dep_time}, time_mins, {other}, dist_m);'''.format(table = TABLE_NAME,
+                                                                                                              name = name,
+                                                                                                              first = first,
+                                                                                                              mode = mode,
+                                                                                                              dep_time = dep_time,
+                                                                                                              other = other))
+        stmt.execute("ANALYZE {};".format(TABLE_NAME))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+def populateSummary(dbConn, feedstock):
+    """
+        Given an open connection to a SQLite database and a list of summary tuples
+        (see summariseWindow), insert the data into the summary table.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('summary',','.join(['?']*len(summary_columns))))
+        for row in feedstock:
+            preppedStmt.setString(1, row[0])
+            preppedStmt.setString(2, row[1])
+            preppedStmt.setString(3, row[2])
+            preppedStmt.setInt(4, row[3])
+            for column, value in enumerate(row[4:]):
+                preppedStmt.setDouble(column + 5, value)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def populateAccess(dbConn, feedstock):
+    """
+        Given an open connection to a SQLite database and a list of measure tuples
+        (see aggregateAccess), insert the data into the access table.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('access',','.join(['?']*len(access_columns))))
+        for row in feedstock:
+            preppedStmt.setString(1, row[0])
+            preppedStmt.setString(2, row[1])
+            preppedStmt.setString(3, row[2])
+            for column, value in enumerate(row[3:]):
+                if column < len(args.cutoffs):
+                    preppedStmt.setInt(column + 4, value)
+                else:
+                    preppedStmt.setDouble(column + 4, value)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def populateProgress(dbConn, origin, units):
+    """
+        Given an open connection to a SQLite database, an origin ID and a list of 
+        (departure time, mode) units planned for it, record these as complete in the 
+        progress table.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('progress','?,?,?'))
+        for dep_time, mode in units:
+            preppedStmt.setString(1, origin)
+            preppedStmt.setString(2, dep_time)
+            preppedStmt.setString(3, mode)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def populateMetrics(dbConn, snapshot):
+    """
+        Given an open connection to a SQLite database and a metrics snapshot (see odm_metrics.py),
+        insert it into the metrics table.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('metrics',','.join(['?']*len(metrics_columns))))
+        preppedStmt.setString(1, snapshot['recorded'])
+        for column, field in enumerate(metrics_columns[1:-1]):
+            if snapshot[field] is None:
+                preppedStmt.setNull(column + 2, Types.REAL)
+            else:
+                preppedStmt.setDouble(column + 2, snapshot[field])
+        preppedStmt.setString(len(metrics_columns), json.dumps(snapshot['timings'], sort_keys = True))
+        preppedStmt.executeUpdate()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def completedUnits(origin):
+    """
+        Return the (departure time, mode) units recorded as complete for the given 
+        origin ID in the progress table, using an indexed lookup on its primary key.
+    """
+    if not args.checkpoint:
+        return frozenset()
+    with db_lock:
+        try:
+            preppedStmt = prepareStatement(dbConn, '''SELECT dep_time, mode FROM {}_progress WHERE origin = ?;'''.format(TABLE_NAME))
+            preppedStmt.setString(1, origin)
+            rs = preppedStmt.executeQuery()
+            units = []
+            while rs.next():
+                units.append((rs.getString(1), rs.getString(2)))
+            rs.close()
+        except SQLException, msg:
+            print msg
+            sys.exit(1)
+    return frozenset(units)
+
+def percentile(values, q):
+    """
+        Return the q-th percentile of an ascending sorted list of values, 
+        linearly interpolating between the closest ranks.
+    """
+    position = (len(values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summariseWindow(set):
+    """
+        Given the result tuples for an origin across the departure time window, return 
+        a tuple for each destination and mode recording the number of departures for which
+        the destination was reached, and the minimum, median, requested percentiles and 
+        maximum of travel time in minutes.
+    """
+    times = {}
+    for r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins in set:
+        times.setdefault((r_origin, r_destination, r_mode), []).append(r_time_mins)
+    summary = []
+    for (r_origin, r_destination, r_mode), values in times.items():
+        values.sort()
+        summary.append((r_origin, r_destination, r_mode, len(values), values[0], percentile(values, 50)) 
+                       + tuple([percentile(values, q) for q in args.percentiles]) 
+                       + (values[-1],))
+    return summary
+
+def decayWeight(minutes):
+    """
+        Return the --decay function of travel time in minutes.
+    """
+    if args.decay == 'exponential':
+        return math.exp(-decay_param * minutes)
+    if args.decay == 'power':
+        return max(minutes, 1.0) ** -decay_param
+    return max(0.0, 1.0 - minutes / decay_param)
+
+def aggregateAccess(r_origin, set, units):
+    """
+        Given the result tuples for an origin and the (departure time, mode) units planned, 
+        return a tuple for each unit recording the number of destinations reached within each 
+        of the --cutoffs, their total weight (if --weight_column is specified) and the gravity 
+        measure (if --decay is specified); units reaching no destinations have zero measures.
+    """
+    cutoffs = args.cutoffs
+    measures = {}
+    for r_dep_time, transport_mode in units:
+        measures[(r_dep_time, '"{}"'.format(transport_mode))] = [0] * len(cutoffs) + [0.0] * (len(access_columns) - 3 - len(cutoffs))
+    for r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins in set:
+        values = measures.setdefault((r_dep_time, r_mode), [0] * len(cutoffs) + [0.0] * (len(access_columns) - 3 - len(cutoffs)))
+        weight = 1.0 if dest_weights is None else dest_weights.get(r_destination, 0.0)
+        for i, cutoff in enumerate(cutoffs):
+            if r_time_mins <= cutoff:
+                values[i] += 1
+                if dest_weights is not None:
+                    values[len(cutoffs) + i] += weight
+        if args.decay is not None:
+            values[-1] += weight * decayWeight(r_time_mins)
+    return [(r_origin, r_dep_time, r_mode) + tuple(values) for (r_dep_time, r_mode), values in sorted(measures.items())]
+
+def startParquetSink(stmt):
+    """
+        Launch odm_parquet_sink.py to write results to a partitioned parquet dataset,
+        returning the process; rows are streamed to it by sinkRows.  The files of each 
+        batch are written under temporary names, and renamed once the batch is committed
+        (see commitBatch); temporary files left by an interrupted run are renamed if their
+        batch was committed, and otherwise removed.
+    """
+    outdir = '{}_{}'.format(os.path.splitext(args.outdb)[0], TABLE_NAME)
+    committed = set()
+    try:
+        stmt.execute(createTable("parquet_batches", "batch TEXT PRIMARY KEY"))
+        rs = stmt.executeQuery("SELECT batch FROM {}_parquet_batches;".format(TABLE_NAME))
+        while rs.next():
+            committed.add(rs.getString(1))
+        rs.close()
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    for root, dirs, files in os.walk(outdir):
+        for name in files:
+            if not name.endswith('.parquet.tmp'):
+                continue
+            # files are named part-<batch>-<sequence>.parquet.tmp
+            path = os.path.join(root, name)
+            if name[len('part-'):].rsplit('-', 1)[0] in committed:
+                os.rename(path, path[:-len('.tmp')])
+            else:
+                os.remove(path)
+    sink_script = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), 'odm_parquet_sink.py')
+    print("Writing results to parquet dataset {}".format(outdir))
+    return subprocess.Popen([args.python, sink_script, '--outdir', outdir, '--region', proj_name],
+                            stdin = subprocess.PIPE, 
+                            stdout = subprocess.PIPE)
+
+def sinkRows(feedstock):
+    """
+        Stream a list of result tuples to the parquet sink.
+    """
+    for origin, destination, dep_time, mode, dist_m, time_mins in feedstock:
+        parquet_sink.stdin.write('R\t{}\t{}\t{}\t{}\t{}\t{!r}\n'.format(origin, destination, dep_time, 
+                                                                          mode.strip('"'), dist_m, time_mins))
+    return True
+
+def flushParquetSink(dbConn):
+    """
+        Ask the parquet sink to write its buffered rows to disk under temporary names, 
+        waiting for confirmation, and record the batch in the current transaction; return 
+        the batch, to be published by publishParquetBatch once committed.
+    """
+    global parquet_sequence
+    parquet_sequence += 1
+    batch = '{}-{:06d}'.format(parquet_run, parquet_sequence)
+    parquet_sink.stdin.write('F\t{}\n'.format(batch))
+    parquet_sink.stdin.flush()
+    if parquet_sink.stdout.readline().strip() != 'OK':
+        print("The parquet sink failed; re-run to resume from the last commit.")
+        sys.exit(1)
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('parquet_batches','?'))
+        preppedStmt.setString(1, batch)
+        preppedStmt.executeUpdate()
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    return batch
+
+def publishParquetBatch(batch):
+    """
+        Ask the parquet sink to rename the files of a committed batch to their final names.
+    """
+    parquet_sink.stdin.write('C\t{}\n'.format(batch))
+    parquet_sink.stdin.flush()
+
+def commitBatch(dbConn):
+    """
+        Commit results written since the last commit when using batched commits, 
+        first flushing the parquet sink if used (and then publishing its files).
+    """
+    global uncommitted_origins
+    batch = None
+    if args.out_format == 'parquet':
+        batch = flushParquetSink(dbConn)
+    dbConn.commit()
+    if batch is not None:
+        publishParquetBatch(batch)
+    uncommitted_origins = 0
+
+def pivotWide(set):
+    """
+        Given the result tuples for an origin, return wide form tuples of origin, destination
+        and departure time followed by the travel time and distance for each mode (None where
+        not reached).  Results for modes in run_once are carried to later departure times.
+    """
+    mode_index = dict([(mode, index) for index, mode in enumerate(modes)])
+    dep_times = [dep.isoformat() for dep in date_list]
+    wide = {}
+    for r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins in set:
+        index = mode_index[r_mode.strip('"')]
+        if modes[index] in run_once:
+            row_dep_times = dep_times
+        else:
+            row_dep_times = [r_dep_time]
+        for dep_time in row_dep_times:
+            row = wide.setdefault((dep_time, r_destination), [r_origin, r_destination, dep_time] + [None] * (2 * len(modes)))
+            row[3 + 2 * index] = r_time_mins
+            row[4 + 2 * index] = r_dist_m
+    return [tuple(wide[key]) for key in sorted(wide.keys())]
+
+def populateWide(dbConn, feedstock):
+    """
+        Given an open connection to a SQLite database and a list of wide form tuples
+        (see pivotWide), insert the data into the wide form table.
+    """
+    try:
+        preppedStmt = prepareStatement(dbConn, insertRows('wide',','.join(['?']*len(wide_columns))))
+        for row in feedstock:
+            preppedStmt.setString(1, row[0])
+            preppedStmt.setString(2, row[1])
+            preppedStmt.setString(3, row[2])
+            for index in range(len(modes)):
+                time_mins = row[3 + 2 * index]
+                dist_m    = row[4 + 2 * index]
+                if time_mins is None:
+                    preppedStmt.setNull(4 + 2 * index, Types.DOUBLE)
+                    preppedStmt.setNull(5 + 2 * index, Types.INTEGER)
+                else:
+                    preppedStmt.setDouble(4 + 2 * index, time_mins)
+                    preppedStmt.setInt(5 + 2 * index, dist_m)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+    except SQLException, msg:
+        print msg
+        return False
+    
+    return True
+
+def writeResults(dbConn, r_origin, set, units):
+    """
+        Write the results for an origin, as rows for each departure time and/or 
+        as a summary across the departure time window (see --window_output), and in 
+        wide form if --wideform is specified, in a single transaction.  If --checkpoint is specified, the (departure time, mode)
+        units planned are recorded as complete in the same transaction.  With --bulk_load 
+        or parquet output, the transaction is committed once args.commit_every origins have 
+        been written (after the parquet sink has written its buffered rows).
+    """
+    global uncommitted_origins
+    with db_lock:
+        success = True
+        if not batched_commits:
+            dbConn.setAutoCommit(False)
+        if args.window_output in ['rows','both'] and not args.aggregate_only:
+            if args.out_format == 'parquet':
+                success = sinkRows(set) and success
+            elif args.out_format == 'matrix':
+                success = matrix_store.writeOrigin(r_origin, set, units) and success
+            elif args.bulk_load:
+                success = populateKeyedTable(dbConn, set) and success
+            else:
+                success = populateTable(dbConn, set) and success
+        if args.window_output in ['summary','both'] and not args.aggregate_only:
+            success = populateSummary(dbConn, summariseWindow(set)) and success
+        if args.wideform and not args.aggregate_only:
+            success = populateWide(dbConn, pivotWide(set)) and success
+        if args.cutoffs is not None:
+            success = populateAccess(dbConn, aggregateAccess(r_origin, set, units)) and success
+        if args.checkpoint:
+            success = populateProgress(dbConn, r_origin, units) and success
+        if not success:
+            dbConn.rollback()
+            if batched_commits:
+                print("Results for the last {} origins were rolled back; re-run to resume from the last commit.".format(uncommitted_origins + 1))
+                sys.exit(1)
+        elif batched_commits:
+            uncommitted_origins += 1
+            if uncommitted_origins >= args.commit_every:
+                commitBatch(dbConn)
+        else:
+            dbConn.commit()
+        if not batched_commits:
+            dbConn.setAutoCommit(True)
+    return success
+
+def writeGroup(dbConn, r_origin, set, units):
+    """
+        Write the results for an origin, and for each other origin in its group (see 
+        --dedup_origins), relabelled with its ID.  With --checkpoint, each origin's units 
+        already recorded as complete are not written again.
+    """
+    members = origin_members.get(r_origin)
+    if members is None:
+        return writeResults(dbConn, r_origin, set, units)
+    success = True
+    for member in members:
+        member_set = [(member,) + row[1:] for row in set]
+        member_units = units
+        completed = completedUnits(member)
+        if len(completed) > 0:
+            member_set = [row for row in member_set if (row[2], row[3].strip('"')) not in completed]
+            member_units = [unit for unit in units if unit not in completed]
+        success = writeResults(dbConn, member, member_set, member_units) and success
+    return success
+
+def groupOrigins(origins, tolerance):
+    """
+        Group origins with identical coordinates or, given a tolerance greater than zero,
+        within tolerance metres of the first origin of a group (see --dedup_origins); 
+        return a list of the first origin of each group, recording the IDs of each group's
+        origins in origin_members.
+    """
+    cells = {}
+    planned = []
+    count = 0
+    lat0 = None
+    for origin in origins:
+        count += 1
+        if lat0 is None:
+            lat0 = origin.getLat()
+        x, y = (origin.getLon() * 111320.0 * math.cos(math.radians(lat0)), origin.getLat() * 110574.0)
+        match = None
+        if tolerance > 0:
+            cx, cy = int(math.floor(x / tolerance)), int(math.floor(y / tolerance))
+            for px, py, first in itertools.chain.from_iterable([cells.get((i, j), []) 
+                                                                 for i in range(cx - 1, cx + 2)
+                                                                 for j in range(cy - 1, cy + 2)]):
+                if (px - x)**2 + (py - y)**2 <= tolerance**2:
+                    match = first
+                    break
+        else:
+            cx, cy = origin.getLat(), origin.getLon()
+            if (cx, cy) in cells:
+                match = cells[(cx, cy)][0][2]
+        r_origin = origin.getStringData(orig_id)
+        if match is None:
+            cells.setdefault((cx, cy), []).append((x, y, origin))
+            planned.append(origin)
+            origin_members[r_origin] = [r_origin]
+        else:
+            origin_members[match.getStringData(orig_id)].append(r_origin)
+    print("Grouped {} origins as {} distinct start points; planning for {:.1%} of origins ({} shortest path tree searches saved per mode and departure)".format(count,
+                                                                                                                                                            len(planned),
+                                                                                                                                                            len(planned) / float(max(count, 1)),
+                                                                                                                                                            count - len(planned)))
+    return planned
+
+def newRequest():
+    """
+        Return a routing request with the travel time and walking distance limits applied;
+        each worker thread requires its own request object, as origin, departure time and 
+        modes are set on it.
+    """
+    req = otp.createRequest()
+    req.setMaxWalkDistance(args.max_walking_distance)
+    req.setMaxTimeSec(args.max_time)
+    return req
+
+def setDepartureTime(req, dep):
+    """
+        Set the departure time of a routing request, in the time zone given by --time_zone
+        if specified (otherwise the JVM default time zone is used).
+    """
+    if args.time_zone is None:
+        req.setDateTime(dep.year,dep.month,dep.day,dep.hour,dep.minute,dep.second)
+    else:
+        cal = Calendar.getInstance(TimeZone.getTimeZone(args.time_zone))
+        cal.clear()
+        cal.set(dep.year,dep.month - 1,dep.day,dep.hour,dep.minute,dep.second)
+        req.setDateTime(cal.getTime())
+
+class DestinationIndex(object):
+    """
+        Grid index over the coordinates of a destination population, returning those 
+        destinations within a given straight line distance of a point (see --prune_dests).
+        Coordinates are projected to metres using an equirectangular approximation, with 
+        a margin allowing for its error across a region.
+    """
+    margin = 1.05
+    
+    def __init__(self, population, cell_size = 1000.0):
+        self.cell_size = cell_size
+        self.individuals = [individual for individual in population]
+        lats = [individual.getLat() for individual in self.individuals]
+        self.lat0 = sum(lats) / max(len(lats), 1)
+        self.cells = {}
+        self.points = []
+        for individual in self.individuals:
+            x, y = self.project(individual.getLat(), individual.getLon())
+            self.points.append((x, y, individual))
+            cell = (int(math.floor(x / cell_size)), int(math.floor(y / cell_size)))
+            self.cells.setdefault(cell, []).append((x, y, individual))
+        xs = [x for x, y, individual in self.points] or [0]
+        ys = [y for x, y, individual in self.points] or [0]
+        self.extent = (min(xs), min(ys), max(xs), max(ys))
+    
+    def project(self, lat, lon):
+        """
+            Return approximate x and y coordinates in metres for a latitude and longitude.
+        """
+        return (lon * 111320.0 * math.cos(math.radians(self.lat0)), lat * 110574.0)
+    
+    def within(self, lat, lon, radius):
+        """
+            Return a list of the destinations within radius metres of the given point, or 
+            None if all destinations are within this distance.
+        """
+        radius = radius * self.margin
+        x, y = self.project(lat, lon)
+        xmin, ymin, xmax, ymax = self.extent
+        if max((x - xmin)**2, (x - xmax)**2) + max((y - ymin)**2, (y - ymax)**2) <= radius**2:
+            return None
+        selected = ArrayList()
+        span = int(math.ceil(radius / self.cell_size))
+        if (2 * span + 1)**2 > len(self.cells):
+            candidates = self.points
+        else:
+            cx = int(math.floor(x / self.cell_size))
+            cy = int(math.floor(y / self.cell_size))
+            candidates = itertools.chain.from_iterable([self.cells.get((i, j), []) 
+                                                        for i in range(cx - span, cx + span + 1)
+                                                        for j in range(cy - span, cy + span + 1)])
+        for px, py, individual in candidates:
+            if (px - x)**2 + (py - y)**2 <= radius**2:
+                selected.add(individual)
+        return selected
+
+def reachRadius(transport_mode):
+    """
+        Return the maximum straight line distance (metres) reachable within --max_time 
+        using the given transport mode(s).
+    """
+    speeds = [MAX_SPEEDS.get(mode, MAX_SPEEDS['TRANSIT']) for mode in transport_mode.split(',')]
+    return max(speeds) * args.max_time
+
+class ModePlanner(object):
+    """
+        Reduces the modes planned for an origin to those which may contribute to its 
+        results (see --reuse_modes).  Transit is dropped from a combination where no stops
+        served by any of its transit modes are within reach of the origin using the 
+        combination's street modes within --max_time (where --max_walking_distance does not 
+        limit walking or cycling within this reach, so the street modes give the same 
+        results); otherwise, the combination is planned in full, as trips may transfer 
+        between its transit modes.  
+        Combinations reducing to the same modes share a shortest path tree, and those 
+        without transit share it across departure times.
+    """
+    def __init__(self, stops):
+        self.indexes = {}
+        if stops is not None:
+            self.indexes = dict([(mode, DestinationIndex(mode_stops)) for mode, mode_stops in stops.items()])
+        self.stops_known = stops is not None
+        self.counts = {'planned': 0, 'reused': 0}
+        self.lock = threading.Lock()
+    
+    def timetabled(self, transport_mode):
+        """
+            Return True if the given transport mode(s) include transit.
+        """
+        return any([mode in TRANSIT_MODES for mode in transport_mode.split(',')])
+    
+    def served(self, mode, lat, lon, radius):
+        """
+            Return True if any stops served by the transit mode are within radius metres of the point.
+        """
+        if mode == 'TRANSIT':
+            indexes = self.indexes.values()
+        else:
+            indexes = [self.indexes[mode]] if mode in self.indexes else []
+        for index in indexes:
+            if len(index.individuals) == 0:
+                continue
+            within = index.within(lat, lon, radius)
+            if within is None or within.size() > 0:
+                return True
+        return False
+    
+    def reduce(self, origin, transport_modes):
+        """
+            Return a dictionary of the reduced mode(s) to be planned from the origin for each 
+            of the given transport modes.
+        """
+        reduced = {}
+        for transport_mode in transport_modes:
+            reduced[transport_mode] = transport_mode
+            parts = transport_mode.split(',')
+            street = [mode for mode in parts if mode in STREET_MODES]
+            if not self.stops_known or len(street) == 0 or not self.timetabled(transport_mode):
+                continue
+            # walking (or cycling) to and from stops is limited by --max_walking_distance
+            active = [mode for mode in street if mode != 'CAR'] or ['WALK']
+            if reachRadius(','.join(active)) > args.max_walking_distance:
+                continue
+            radius = reachRadius(','.join(street))
+            if not any([self.served(mode, origin.getLat(), origin.getLon(), radius) 
+                        for mode in parts if mode in TRANSIT_MODES]):
+                reduced[transport_mode] = ','.join(street)
+        return reduced
+    
+    def count(self, planned = 0, reused = 0):
+        with self.lock:
+            self.counts['planned'] += planned
+            self.counts['reused'] += reused
+
+def transitStops():
+    """
+        Return a dictionary of the transit stops in the router's graph by the transit 
+        modes serving them, or None if these are not accessible.
+    """
+    try:
+        # the scripting API does not expose the graph, so it is retrieved by reflection
+        field = router.getClass().getDeclaredField('router')
+        field.setAccessible(True)
+        index = field.get(router).graph.index
+        stops = {}
+        for stop in index.stopForId.values():
+            for mode in frozenset([pattern.mode.toString() for pattern in index.patternsForStop.get(stop)]):
+                stops.setdefault(mode, []).append(stop)
+    except (Exception, Throwable), msg:
+        print("Transit stops could not be read from the graph ({}); transit modes will not be reduced".format(msg))
+        return None
+    print("Read {} transit stops by mode: {}".format(len(index.stopForId), 
+                                                    ', '.join(['{} {}'.format(len(x), mode) for mode, x in sorted(stops.items())])))
+    return stops
+
+class AccessSurface(object):
+    """
+        Regular latitude/longitude grid over the region, onto which each shortest path tree
+        is sampled (see --raster).  For each departure time and mode, the minimum travel time
+        (minutes) to each cell from any origin, and the number of origins from which each cell
+        is reached within --raster_cutoff minutes, are accumulated in memory-mapped files 
+        (float32 and int32, little endian, row major from the north west), each layer having
+        a GDAL virtual raster (VRT) header; e.g. gdal_translate -co TILED=YES -co COMPRESS=DEFLATE
+        converts a layer to a tiled, compressed GeoTiff.  Each origin counts once towards a 
+        layer's reach counts, including the members of its group (see --dedup_origins): the 
+        (origin, departure time, mode) units accumulated are recorded in accumulated.csv, so 
+        origins replanned on resuming are not counted again.  Unless resuming, the surfaces 
+        of a previous run are discarded.
+    """
+    def __init__(self, top, bottom, left, right, cell_size, outdir, resuming):
+        self.dlat = cell_size / 110574.0
+        self.dlon = cell_size / (111320.0 * math.cos(math.radians((top + bottom) / 2)))
+        self.rows = max(int(math.ceil((top - bottom) / self.dlat)), 1)
+        self.cols = max(int(math.ceil((right - left) / self.dlon)), 1)
+        self.top, self.left = top, left
+        self.outdir = outdir
+        self.cutoff = args.raster_cutoff if args.raster_cutoff is not None else args.max_time / 60.0
+        self.layers = {}
+        self.lock = threading.Lock()
+        # the cell centres are evaluated as a population
+        self.population = otp.createEmptyPopulation()
+        self.population.setHeaders(['cell'])
+        for row in range(self.rows):
+            for col in range(self.cols):
+                self.population.addIndividual(top - (row + 0.5) * self.dlat, left + (col + 0.5) * self.dlon, 
+                                              [str(row * self.cols + col)])
+        self.cells = dict([(individual, int(individual.getStringData('cell'))) for individual in self.population])
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        ledger = os.path.join(outdir, 'accumulated.csv')
+        self.accumulated = {}
+        if resuming and os.path.exists(ledger):
+            with open(ledger, 'rb') as f:
+                for r_origin, r_dep_time, transport_mode in csv.reader(f):
+                    self.accumulated.setdefault((r_dep_time, transport_mode), {})[r_origin] = True
+        else:
+            for name in os.listdir(outdir):
+                if os.path.splitext(name)[1] in ['.f32', '.i32', '.vrt', '.csv']:
+                    os.remove(os.path.join(outdir, name))
+        self.ledger = open(ledger, 'ab')
+        self.ledger_writer = csv.writer(self.ledger)
+        print("Sampling shortest path trees to a {} x {} grid of {:g} metre cells in {}".format(self.rows, self.cols, cell_size, outdir))
+    
+    def sample(self, spt):
+        """
+            Return a list of (cell, travel time in minutes) for cells reached by the tree within --max_time.
+        """
+        cells = []
+        for result in spt.eval(self.population):
+            if result is None:
+                continue
+            if (result.getTime() is not None) and (0 <= result.getTime() <= args.max_time):
+                cells.append((self.cells[result.getIndividual()], result.getTime() / 60.0))
+        return cells
+    
+    def mapFile(self, path, initial):
+        """
+            Return a memory-mapped buffer of a cell value per grid cell, filling a new file with the initial value.
+        """
+        size = self.rows * self.cols * 4
+        exists = os.path.exists(path) and os.path.getsize(path) == size
+        channel = RandomAccessFile(path, 'rw').getChannel()
+        buffer = channel.map(FileChannel.MapMode.READ_WRITE, 0, size).order(ByteOrder.LITTLE_ENDIAN)
+        if not exists:
+            for index in range(self.rows * self.cols):
+                if isinstance(initial, float):
+                    buffer.putFloat(index * 4, initial)
+                else:
+                    buffer.putInt(index * 4, initial)
+        return buffer
+    
+    def layer(self, r_dep_time, transport_mode):
+        """
+            Return the minimum time and reach count buffers for a departure time and mode,
+            creating their files and VRT header if required.
+        """
+        if (r_dep_time, transport_mode) not in self.layers:
+            name = '{}_{}'.format(transport_mode.replace(',', '+'), r_dep_time.replace(':', ''))
+            bands = [('min_mins', 'Float32', self.mapFile(os.path.join(self.outdir, '{}_min_mins.f32'.format(name)), float('nan'))),
+                     ('reach_count', 'Int32', self.mapFile(os.path.join(self.outdir, '{}_reach_count.i32'.format(name)), 0))]
+            with open(os.path.join(self.outdir, '{}.vrt'.format(name)), 'w') as f:
+                f.write('<VRTDataset rasterXSize="{}" rasterYSize="{}">\n'.format(self.cols, self.rows))
+                f.write('  <SRS>{}</SRS>\n'.format(WGS84_WKT.replace('"', '&quot;')))
+                f.write('  <GeoTransform>{!r}, {!r}, 0, {!r}, 0, {!r}</GeoTransform>\n'.format(self.left, self.dlon, self.top, -self.dlat))
+                for band, (description, data_type, buffer) in enumerate(bands):
+                    f.write('  <VRTRasterBand dataType="{}" band="{}" subClass="VRTRawRasterBand">\n'.format(data_type, band + 1))
+                    f.write('    <Description>{}</Description>\n'.format(description))
+                    if data_type == 'Float32':
+                        f.write('    <NoDataValue>nan</NoDataValue>\n')
+                    f.write('    <SourceFilename relativeToVRT="1">{}_{}.{}</SourceFilename>\n'.format(name, description, 'f32' if data_type == 'Float32' else 'i32'))
+                    f.write('    <ImageOffset>0</ImageOffset>\n    <PixelOffset>4</PixelOffset>\n')
+                    f.write('    <LineOffset>{}</LineOffset>\n    <ByteOrder>LSB</ByteOrder>\n'.format(self.cols * 4))
+                    f.write('  </VRTRasterBand>\n')
+                f.write('</VRTDataset>\n')
+            self.layers[(r_dep_time, transport_mode)] = (bands[0][2], bands[1][2])
+        return self.layers[(r_dep_time, transport_mode)]
+    
+    def accumulate(self, r_origin, r_dep_time, transport_mode, cells):
+        """
+            Update the layer for a departure time and mode with the cells sampled from an origin's
+            tree, counting each origin in its group not already accumulated for the layer.
+        """
+        with self.lock:
+            accumulated = self.accumulated.setdefault((r_dep_time, transport_mode), {})
+            members = [x for x in origin_members.get(r_origin, [r_origin]) if x not in accumulated]
+            if len(members) == 0:
+                return
+            min_mins, reach_count = self.layer(r_dep_time, transport_mode)
+            for cell, minutes in cells:
+                offset = cell * 4
+                current = min_mins.getFloat(offset)
+                if math.isnan(current) or minutes < current:
+                    min_mins.putFloat(offset, minutes)
+                if minutes <= self.cutoff:
+                    reach_count.putInt(offset, reach_count.getInt(offset) + len(members))
+            for member in members:
+                accumulated[member] = True
+                self.ledger_writer.writerow([member, r_dep_time, transport_mode])
+            self.ledger.flush()
+    
+    def close(self):
+        with self.lock:
+            for min_mins, reach_count in self.layers.values():
+                min_mins.force()
+                reach_count.force()
+            self.ledger.close()
+        print("Wrote accessibility surfaces for {} departure time and mode layers to {}".format(len(self.layers), self.outdir))
+
+class MatrixStore(object):
+    """
+        Dense binary matrix store of the travel time and walk distance from each origin
+        to each destination, for each departure time and mode planned (see --out_format 
+        matrix, and odm_matrix.py for the format, which reads the store and converts results
+        tables to it).  Each origin's row of each layer is written as its results are written;
+        a store with the same origins, destinations and layers is kept on resuming.
+    """
+    def __init__(self, path, origin_ids, dest_ids, layers, dtype):
+        self.path = path
+        self.dtype = dtype
+        self.itemsize = 4 if dtype == 'float32' else 2
+        self.time_scale, self.dist_scale, self.sentinel = {'float32': (1, 1, None), 'int16': (0.1, 10, -1)}[dtype]
+        self.origin_index = dict([(x, i) for i, x in enumerate(origin_ids)])
+        self.dest_index = dict([(x, i) for i, x in enumerate(dest_ids)])
+        self.row_size = len(dest_ids) * self.itemsize
+        self.blank = self.fill(len(dest_ids))
+        header = {'origins': origin_ids,
+                  'destinations': dest_ids,
+                  'dtype': dtype,
+                  'time_scale': self.time_scale,
+                  'dist_scale': self.dist_scale,
+                  'sentinel': self.sentinel,
+                  'layers': [{'dep_time': dep_time, 'mode': mode, 'time_offset': 0, 'dist_offset': 0} for dep_time, mode in layers]}
+        # offsets are assigned once the length of the header (with offsets up to 20 digits) is known
+        length = len(json.dumps(header)) + 40 * len(layers)
+        data_offset = -(-(16 + length) // 4096) * 4096
+        size = len(origin_ids) * self.row_size
+        self.offsets = {}
+        for i, layer in enumerate(header['layers']):
+            layer['time_offset'] = data_offset + 2 * i * size
+            layer['dist_offset'] = data_offset + (2 * i + 1) * size
+            self.offsets[(layer['dep_time'], layer['mode'])] = (layer['time_offset'], layer['dist_offset'])
+        encoded = json.dumps(header)
+        total = data_offset + 2 * len(layers) * size
+        if os.path.exists(path) and os.path.getsize(path) == total and self.readHeader(path) == json.loads(encoded):
+            print("Resuming matrix store {}".format(path))
+            self.channel = RandomAccessFile(path, 'rw').getChannel()
+            return
+        print("Writing results to matrix store {} ({} origins, {} destinations, {} departure time and mode layers, {:.1f} MB)".format(path,
+                                                                                                                              len(origin_ids),
+                                                                                                                              len(dest_ids),
+                                                                                                                              len(layers),
+                                                                                                                              total / 1024.0**2))
+        self.channel = RandomAccessFile(path, 'rw').getChannel()
+        self.channel.truncate(0)
+        buffer = ByteBuffer.allocate(data_offset).order(ByteOrder.LITTLE_ENDIAN)
+        buffer.put(String('ODMATRX1').getBytes('US-ASCII'))
+        buffer.putLong(data_offset - 16)
+        buffer.put(String(encoded + ' ' * (data_offset - 16 - len(encoded))).getBytes('US-ASCII'))
+        buffer.flip()
+        self.writeBuffer(buffer, 0)
+        # all pairs are unreachable until written
+        chunk = self.fill(max(min(total - data_offset, 1 << 22), self.itemsize) // self.itemsize)
+        position = data_offset
+        while position < total:
+            chunk.clear()
+            chunk.limit(min(chunk.capacity(), total - position))
+            self.writeBuffer(chunk, position)
+            position += chunk.capacity()
+    
+    def readHeader(self, path):
+        try:
+            with open(path, 'rb') as f:
+                if f.read(8) != 'ODMATRX1':
+                    return None
+                length = struct.unpack('<Q', f.read(8))[0]
+                return json.loads(f.read(length))
+        except (IOError, ValueError, struct.error):
+            return None
+    
+    def fill(self, count):
+        """
+            Return a buffer of count unreachable values.
+        """
+        buffer = ByteBuffer.allocate(count * self.itemsize).order(ByteOrder.LITTLE_ENDIAN)
+        for index in range(count):
+            if self.sentinel is None:
+                buffer.putFloat(index * 4, float('nan'))
+            else:
+                buffer.putShort(index * 2, self.sentinel)
+        return buffer
+    
+    def blankRow(self):
+        """
+            Return a buffer of an origin's row of unreachable values, copied from self.blank.
+        """
+        buffer = ByteBuffer.allocate(self.row_size).order(ByteOrder.LITTLE_ENDIAN)
+        buffer.put(self.blank.duplicate())
+        buffer.clear()
+        return buffer
+    
+    def writeBuffer(self, buffer, position):
+        while buffer.hasRemaining():
+            position += self.channel.write(buffer, position)
+    
+    def putValue(self, buffer, index, value, scale):
+        if self.sentinel is None:
+            buffer.putFloat(index * 4, value)
+        else:
+            buffer.putShort(index * 2, min(max(int(round(value / scale)), 0), 32767))
+    
+    def writeOrigin(self, r_origin, set, units):
+        """
+            Write an origin's row of each (departure time, mode) unit planned, from its result tuples.
+        """
+        row = self.origin_index.get(r_origin)
+        if row is None:
+            print("Origin {} is not in the matrix store".format(r_origin))
+            return False
+        rows = {}
+        for unit in units:
+            rows[unit] = (self.blankRow(), self.blankRow())
+        for result in set:
+            r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins = result[1:]
+            buffers = rows.get((r_dep_time, r_mode.strip('"')))
+            index = self.dest_index.get(r_destination)
+            if buffers is None or index is None:
+                continue
+            self.putValue(buffers[0], index, r_time_mins, self.time_scale)
+            self.putValue(buffers[1], index, r_dist_m, self.dist_scale)
+        for unit, (time_buffer, dist_buffer) in rows.items():
+            time_offset, dist_offset = self.offsets[unit]
+            self.writeBuffer(time_buffer, time_offset + row * self.row_size)
+            self.writeBuffer(dist_buffer, dist_offset + row * self.row_size)
+        return True
+    
+    def close(self):
+        self.channel.force(False)
+        self.channel.close()
+        print("Wrote matrix store {}".format(self.path))
+
+def readIds(path, id_name):
+    """
+        Return the IDs in a column of an input csv file, in order.
+    """
+    with open(os.path.abspath(path), 'rb') as f:
+        reader = csv.reader(f)
+        id_col = reader.next().index(id_name)
+        return [row[id_col] for row in reader]
+
+def planMode(req, origin, targets, transport_mode):
+    """
+        Plan a shortest path tree from the origin using the given transport mode(s), with 
+        the request's departure time, and evaluate it for the target destination(s); return 
+        a list of (destination, walk distance, travel time) tuples for destinations reached 
+        within the time limit, and the (cell, travel time) samples of the tree for the 
+        accessibility surface (or None, if --raster is not specified), or None if no tree 
+        could be planned.
+    """
+    # define transport mode
+    req.setModes(transport_mode)
+    
+    phase_time = clock()
+    spt = router.plan(req)
+    metrics.record('plan', transport_mode, clock() - phase_time)
+    if spt is None: 
+        # print "SPT is None"
+        return None
+    metrics.add(trees = 1)
+    cells = None
+    if surface is not None:
+        phase_time = clock()
+        cells = surface.sample(spt)
+        metrics.record('raster', transport_mode, clock() - phase_time)
+    phase_time = clock()
+    
+    # Evaluate the SPT for destination (one-to-one), the destinations paired with
+    # the origin (--group_pairs) or all points (one-to-many), or only those points 
+    # within reach (--prune_dests)
+    if args.matching == 'one-to-one' and not args.group_pairs:
+        results = [spt.eval(targets)]
+    elif dest_index is not None:
+        reachable = dest_index.within(origin.getLat(), origin.getLon(), reachRadius(transport_mode))
+        if reachable is None:
+            reachable = targets
+            evaluated = len(dest_index.individuals)
+        else:
+            evaluated = reachable.size()
+        with prune_lock:
+            prune_counts['evaluated'] += evaluated
+            prune_counts['total'] += len(dest_index.individuals)
+        results = spt.eval(reachable)
+    else:
+        results = spt.eval(targets)
+    metrics.record('eval', transport_mode, clock() - phase_time)
+    phase_time = clock()
+    reached = []
+    for result in results:
+        if result is None:
+            continue
+        if (result.getTime() is not None) and (0 <= result.getTime() <=args.max_time) :
+            r_destination = result.getIndividual().getStringData(dest_id)
+            r_dist_m      = int(0 if result.getWalkDistance() is None else result.getWalkDistance())
+            r_time_mins   = result.getTime()/60.0   
+            reached.append((r_destination, r_dist_m, r_time_mins))
+    metrics.record('filter', transport_mode, clock() - phase_time)
+    return reached, cells
+
+def evaluateOrigin(req, origin, targets):
+    """
+        Plan a shortest path tree from the given origin for each departure time and 
+        transport mode, and evaluate it for the target destination(s); return a list of 
+        result tuples suitable for populateTable, and a list of the (departure time, mode)
+        units planned.  Modes listed in run_once are only planned for the first departure 
+        time, and units already recorded as complete (see --checkpoint) are skipped.  
+        With --reuse_modes, modes are reduced for the origin (see ModePlanner) and the 
+        results of each distinct reduced mode are reused.
+    """
+    req.setOrigin(origin)
+    r_origin = origin.getStringData(orig_id)
+    completed = completedUnits(r_origin)
+    for member in origin_members.get(r_origin, [])[1:]:
+        # only units complete for all origins in the group may be skipped
+        completed = completed & completedUnits(member)
+    if mode_planner is not None:
+        plan_modes = mode_planner.reduce(origin, modes)
+    reused = {}
+    set = []
+    units = []
+    for i, dep in enumerate(date_list):
+        setDepartureTime(req, dep)
+        r_dep_time    = dep.isoformat()
+        for transport_mode in modes:
+            if (r_dep_time, transport_mode) in completed:
+                continue
+            if (transport_mode not in run_once) or (transport_mode in run_once and i == 0):
+                units.append((r_dep_time, transport_mode))
+                if mode_planner is None:
+                    planned = planMode(req, origin, targets, transport_mode)
+                else:
+                    plan_mode = plan_modes[transport_mode]
+                    # modes without transit give the same results at any departure time
+                    key = (r_dep_time if mode_planner.timetabled(plan_mode) else None, plan_mode)
+                    if key in reused:
+                        planned = reused[key]
+                        mode_planner.count(reused = 1)
+                    else:
+                        planned = reused[key] = planMode(req, origin, targets, plan_mode)
+                        mode_planner.count(planned = 1)
+                if planned is None:
+                    continue
+                reached, cells = planned
+                if cells is not None:
+                    surface.accumulate(r_origin, r_dep_time, transport_mode, cells)
+                # Add a new row of result in the output
+                r_mode        = '"{}"'.format(transport_mode)
+                for r_destination, r_dist_m, r_time_mins in reached:
+                    set.append((r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins))
+    return set, units
+
+def groupPairs(origins, dests):
+    """
+        Group one-to-one origin destination pairs by origin ID, returning a list of
+        (origin, destinations) tasks in order of each origin's first appearance.
+    """
+    groups = {}
+    tasks = []
+    pairs = 0
+    for origin, dest in itertools.izip(origins, dests):
+        r_origin = origin.getStringData(orig_id)
+        if r_origin not in groups:
+            groups[r_origin] = ArrayList()
+            tasks.append((origin, groups[r_origin]))
+        groups[r_origin].add(dest)
+        pairs += 1
+    print("Grouped {} origin destination pairs by {} distinct origins".format(pairs, len(tasks)))
+    return tasks
+
+def planTasks(tasks, lock, window, queue, stop):
+    """
+        Worker thread target: take (index, (origin, targets)) tasks in turn from the shared
+        iterator, evaluating each using a dedicated request object and passing results to 
+        the writer via the queue.  A task is only taken once the window semaphore allows, 
+        bounding the origins planned ahead of the writer.  Stops once no tasks remain, or 
+        early if the stop event is set; a final None marks the worker as complete.
+    """
+    try:
+        req = newRequest()
+        while True:
+            window.acquire()
+            with lock:
+                task = None if stop.isSet() else next(tasks, None)
+            if task is None:
+                # the unused place in the window is returned for the other workers
+                window.release()
+                break
+            index, (origin, targets) = task
+            set_time = time.time()
+            set, units = evaluateOrigin(req, origin, targets)
+            queue.put((index, origin.getStringData(orig_id), set, units, time.time() - set_time))
+    except (Exception, Throwable), msg:
+        queue.put((None, None, msg, None, None))
+    queue.put(None)
+
+def reportProgress(r_origin):
+    """
+        Print the number of origins processed, the rate of processing, estimated time 
+        remaining and heap use, recording a metrics snapshot if --metrics is specified.
+    """
+    snapshot = metrics.snapshot()
+    eta = 'unknown' if snapshot['eta_s'] is None else '{:.1f} minutes'.format(snapshot['eta_s'] / 60)
+    print("Processed {} of {} origins ({:.1%}) in {:.1f} minutes; {:.2f} origins, {:.2f} trees and {:.0f} rows per second; ETA {}; heap {:.0f} of {:.0f} MB; last origin {}".format(
+              snapshot['origins'], 
+              snapshot['total_origins'],
+              snapshot['origins'] / float(max(snapshot['total_origins'], 1)),
+              snapshot['elapsed_s'] / 60,
+              snapshot['origins_per_s'],
+              snapshot['trees_per_s'],
+              snapshot['rows_per_s'],
+              eta,
+              snapshot['heap_used_mb'],
+              snapshot['heap_max_mb'],
+              r_origin))
+    if args.metrics is not None:
+        snapshot['recorded'] = datetime.now().isoformat()
+        if args.metrics == 'jsonl':
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(snapshot, sort_keys = True) + '\n')
+        else:
+            with db_lock:
+                populateMetrics(dbConn, snapshot)
+
+def planParallel(tasks):
+    """
+        Plan tasks on args.workers threads against the shared router, each taking the next
+        task as it becomes free.  Results pass through a queue to this (single writer) 
+        thread, and are written in task order, so the output is identical to a serial run; 
+        workers only take a task while fewer than args.queue_size (by default, 4 x workers)
+        taken tasks remain to be written, so results awaiting the writer are bounded.  Progress
+        is reported at most every args.progress_interval seconds.  If a worker fails or 
+        the run is interrupted, the other workers are stopped, and the results received 
+        are written and committed before exiting.
+    """
+    global metrics
+    tasks = list(enumerate(tasks))
+    metrics = Metrics(len(tasks))
+    window_size = args.queue_size or 4 * args.workers
+    queue = Queue.Queue(maxsize = window_size)
+    window = threading.Semaphore(window_size)
+    lock = threading.Lock()
+    stop = threading.Event()
+    shared_tasks = iter(tasks)
+    for w in range(args.workers):
+        worker = threading.Thread(target = planTasks, 
+                                  args = (shared_tasks, lock, window, queue, stop))
+        worker.setDaemon(True)
+        worker.start()
+    running = args.workers
+    pending = {}
+    next_index = 0
+    failure = None
+    r_origin = None
+    last_report = time.time()
+    try:
+        while running > 0:
+            try:
+                item = queue.get(True, 1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                running -= 1
+                continue
+            index, r_origin, set, units, duration = item
+            if index is None:
+                failure = "Worker failed: {}".format(set)
+                stop.set()
+                # wake workers waiting for the window, which the failed task holds back
+                for w in range(args.workers):
+                    window.release()
+                continue
+            pending[index] = item
+            while next_index in pending:
+                index, r_origin, set, units, duration = pending.pop(next_index)
+                write_time = clock()
+                writeGroup(dbConn, r_origin, set, units)
+                metrics.record('write', 'all', clock() - write_time)
+                metrics.add(origins = 1, rows = len(set))
+                next_index += 1
+                window.release()
+            if time.time() - last_report >= args.progress_interval:
+                reportProgress(r_origin)
+                last_report = time.time()
+    except KeyboardInterrupt:
+        failure = "Interrupted"
+        stop.set()
+    if failure is not None:
+        if args.checkpoint:
+            # completed units are recorded, so results received out of order may also be kept
+            for index in sorted(pending.keys()):
+                index, r_origin, set, units, duration = pending.pop(index)
+                writeGroup(dbConn, r_origin, set, units)
+                metrics.add(origins = 1, rows = len(set))
+        reportProgress(r_origin)
+        if batched_commits:
+            # flushes the parquet sink, which must remain open until then
+            commitBatch(dbConn)
+        if args.out_format == 'parquet':
+            parquet_sink.stdin.close()
+            parquet_sink.wait()
+        if matrix_store is not None:
+            matrix_store.close()
+        print(failure)
+        sys.exit(1)
+    reportProgress(r_origin)
+
+def resumePoint(stmt):
+    """
+        Discard results for the largest origin ID, which may be incomplete if a previous 
+        run was interrupted, and return the largest remaining origin ID (or '' if none); 
+        origins with IDs sorting after this remain to be processed.
+    """
+    try:
+        stmt.executeUpdate('''
+            DELETE FROM {result} 
+            WHERE origin = (SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1);
+            '''.format(result=TABLE_NAME))
+        rs = stmt.executeQuery('''SELECT COALESCE((SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1),'')'''.format(result=TABLE_NAME))
+        rs.next()
+        resume_after = rs.getString(1)
+        rs.close()
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    return resume_after
+
+def resumingRun(stmt):
+    """
+        Return True if results (or, with --checkpoint, progress) were recorded by a previous run.
+    """
+    try:
+        rs = stmt.executeQuery("SELECT EXISTS (SELECT 1 FROM {});".format('{}_progress'.format(TABLE_NAME) if args.checkpoint else TABLE_NAME))
+        rs.next()
+        resuming = rs.getInt(1) == 1
+        rs.close()
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    return resuming
+
+def streamPopulation(path, table, id_name, resume_after = None, stage = True):
+    """
+        Read an input csv file once, in chunks of args.chunk_size rows; each chunk is 
+        copied to the origins or destinations database table (unless stage is False, for
+        inputs already staged) and its individuals are added to an OTP population, which 
+        is returned.  If resume_after is given, individuals with IDs sorting at or before 
+        it are not added to the population.
+    """
+    population = otp.createEmptyPopulation()
+    count = 0
+    added = 0
+    with open(os.path.abspath(path), 'rb') as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        id_col  = header.index(id_name)
+        lat_col = header.index(lat)
+        lon_col = header.index(lon)
+        population.setHeaders(header)
+        try:
+            if stage:
+                stmt.execute("drop table if exists {}_{};".format(table,TABLE_NAME))
+                stmt.execute(createTable(table, ','.join(["'{}'".format(x) for x in header])))
+                preppedStmt = dbConn.prepareStatement(insertRows(table, ','.join(['?']*len(header))))
+                dbConn.setAutoCommit(False)
+            while True:
+                chunk = list(itertools.islice(reader, args.chunk_size))
+                if len(chunk) == 0:
+                    break
+                for row in chunk:
+                    if stage:
+                        for column, value in enumerate(row):
+                            preppedStmt.setString(column + 1, value)
+                        preppedStmt.addBatch()
+                    if (resume_after is None) or (row[id_col] > resume_after):
+                        population.addIndividual(float(row[lat_col]), float(row[lon_col]), row)
+                        added += 1
+                if stage:
+                    preppedStmt.executeBatch()
+                    dbConn.commit()
+                count += len(chunk)
+            if stage:
+                dbConn.setAutoCommit(True)
+        except SQLException, msg:
+            print msg
+            sys.exit(1)
+    print("Read {} {} from {} ({} to be processed{})".format(count, table, path, added, '' if stage else '; already staged'))
+    return population
+
+def fileFingerprint(path):
+    """
+        Return the absolute path, size, modification time and SHA-1 digest of an input file.
+    """
+    path = os.path.abspath(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    return (path, os.path.getsize(path), os.path.getmtime(path), digest.hexdigest())
+
+def stagedInputs(stmt, fingerprints):
+    """
+        Return True if each input (origins and destinations) was staged to its table from 
+        a file with the same content, as recorded by recordInputs.
+    """
+    try:
+        for table, (path, size, mtime, sha1) in fingerprints.items():
+            rs = stmt.executeQuery('''SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = '{}_{}';'''.format(table, TABLE_NAME))
+            rs.next()
+            exists = rs.getInt(1) > 0
+            rs.close()
+            rs = stmt.executeQuery('''SELECT path, size, sha1 FROM {}_inputs WHERE input = '{}';'''.format(TABLE_NAME, table))
+            recorded = None
+            if rs.next():
+                recorded = (rs.getString(1), rs.getLong(2), rs.getString(3))
+            rs.close()
+            if not exists or recorded != (path, size, sha1):
+                return False
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    return True
+
+def recordInputs(dbConn, fingerprints):
+    """
+        Record the fingerprints of the input files staged to the origins and destinations tables.
+    """
+    try:
+        preppedStmt = dbConn.prepareStatement(insertRows('inputs', '?,?,?,?,?'))
+        for table, (path, size, mtime, sha1) in fingerprints.items():
+            preppedStmt.setString(1, table)
+            preppedStmt.setString(2, path)
+            preppedStmt.setLong(3, size)
+            preppedStmt.setDouble(4, mtime)
+            preppedStmt.setString(5, sha1)
+            preppedStmt.addBatch()
+        preppedStmt.executeBatch()
+        preppedStmt.close()
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+def loadPopulation(path, table, id_name, fingerprint, resume_after = None):
+    """
+        Return the population of an input file already staged to the database, reusing the
+        population read by a previous job in this JVM (see odm_jobs.py) if the file is unchanged
+        and the whole population is required.  Up to four populations are kept.
+    """
+    if not resume_after:
+        # resumePoint returns '' when no results have been recorded
+        resume_after = None
+    key = (fingerprint, table, id_name, lat, lon)
+    if shared_populations is not None and resume_after is None and key in shared_populations:
+        print("Reusing {} population from {} (unchanged)".format(table, path))
+        return shared_populations[key]
+    population = streamPopulation(path, table, id_name, resume_after, stage = False)
+    if shared_populations is not None and resume_after is None:
+        if len(shared_populations) >= 4:
+            shared_populations.clear()
+        shared_populations[key] = population
+    return population
+
 #################################################################################    
 
 # Start timing the code
 start_time = time.time()
 
-# Instantiate zxJDBC SQL connection
-dbConn = getConnection(JDBC_URL,JDBC_DRIVER, True)
-cursor = dbConn.cursor()
+# Read Points of Destination - The file points.csv, drawing on defaults or specified IDs, latitude and longitude
+orig_id = args.id_names[0]
+dest_id = args.id_names[1]
+lat = args.latlon_names[0]
+lon = args.latlon_names[1]
+
+# Instantiate an OtpsEntryPoint (or use that shared by odm_batch.py)
+if shared_otp is not None:
+    otp = shared_otp
+else:
+    otp = OtpsEntryPoint.fromArgs(['--graphs', 'graphs', '--router', proj_name])
+
+# Inputs unchanged since they were last staged for this table are not staged again
+fingerprints = {'origins': fileFingerprint(args.originsfile),
+                'destinations': fileFingerprint(args.destsfile)}
 
+# Open Xenial connection
+dbConn = getConnection(JDBC_URL, JDBC_DRIVER, sql_zxJDBC = False)
+stmt = dbConn.createStatement()
 try:
-    cursor.execute(createTable("results"))
+    # bulk loading settings first, as the page size only takes effect before the first table is created
+    if args.bulk_load:
+        for pragma in bulk_pragmas:
+            stmt.execute(pragma)
+    stmt.execute(createTable("inputs", inputs_columns))
 except SQLException, msg:
     print msg
     sys.exit(1)
+inputs_staged = not args.restage_inputs and stagedInputs(stmt, fingerprints)
+
+if args.stream_inputs or inputs_staged:
+    # Stage inputs (unless already staged) and build populations in a single pass of each file
+    try:
+        stmt.execute(createTable("results", results_columns))
+        if args.window_output in ['summary','both']:
+            stmt.execute(createTable("summary", 
+                                     ','.join(["'{}'".format(x) for x in summary_columns])))
+        if args.checkpoint:
+            stmt.execute(createTable("progress", progress_columns))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+    # with --checkpoint all origins are loaded, and completed units skipped when planning
+    resume_after = None if args.checkpoint else resumePoint(stmt)
+    if inputs_staged:
+        origins = loadPopulation(args.originsfile, "origins", orig_id, fingerprints['origins'], resume_after)
+        dests   = loadPopulation(args.destsfile, "destinations", dest_id, fingerprints['destinations'])
+    else:
+        origins = streamPopulation(args.originsfile, "origins", orig_id, resume_after)
+        dests   = streamPopulation(args.destsfile, "destinations", dest_id)
+else:
+    stmt.close()
+    dbConn.close()
+    
+    # Instantiate zxJDBC SQL connection
+    dbConn = getConnection(JDBC_URL,JDBC_DRIVER, True)
+    cursor = dbConn.cursor()
+
+    try:
+        if args.bulk_load:
+            for pragma in bulk_pragmas:
+                cursor.execute(pragma)
+        cursor.execute(createTable("results", results_columns))
+        if args.window_output in ['summary','both']:
+            cursor.execute(createTable("summary", 
+                                       ','.join(["'{}'".format(x) for x in summary_columns])))
+        if args.checkpoint:
+            cursor.execute(createTable("progress", progress_columns))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+    with open(os.path.abspath('./{}'.format(args.originsfile)), 'rb') as f:
+        reader = csv.reader(f)
+        origin_list = map(tuple, reader)
 
-with open(os.path.abspath('./{}'.format(args.originsfile)), 'rb') as f:
-    reader = csv.reader(f)
-    origin_list = map(tuple, reader)
-
-with open(os.path.abspath('./{}'.format(args.destsfile)), 'rb') as f:
-    reader = csv.reader(f)
-    dests_list = map(tuple, reader)
-
-try:    
-    # copy origins to db
-    cursor.execute("drop table if exists origins_{};".format(TABLE_NAME))
-    cursor.execute(createTable(table = "origins",
-                               values = "'Y', 'X', 'fid', 'SA1_MAINCO', 'SA1_7DIGIT', 'COMPOUND_ID'"))    
-    cursor.executemany(insertRows("origins",','.join(['?' for x in range(0,len(origin_list[0]))])), 
-                       origin_list[1:])
+    with open(os.path.abspath('./{}'.format(args.destsfile)), 'rb') as f:
+        reader = csv.reader(f)
+        dests_list = map(tuple, reader)
+
+    try:    
+        # copy origins to db
+        cursor.execute("drop table if exists origins_{};".format(TABLE_NAME))
+        cursor.execute(createTable(table = "origins",
+                                   values = "'Y', 'X', 'fid', 'SA1_MAINCO', 'SA1_7DIGIT', 'COMPOUND_ID'"))    
+        cursor.executemany(insertRows("origins",','.join(['?' for x in range(0,len(origin_list[0]))])), 
+                           origin_list[1:])
+        dbConn.commit()
+        # copy dests to db
+        cursor.execute("drop table if exists destinations_{};".format(TABLE_NAME))
+        cursor.execute(createTable(table = "destinations",
+                                   values = "'Y', 'X', 'fid', 'DZN_CODE_2016', 'COMPOUND_ID'")) 
+        cursor.executemany(insertRows("destinations",','.join(['?' for x in range(0,len(dests_list[0]))])), 
+                           dests_list[1:])
+        dbConn.commit()   
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+    # SNIPPETS FOR DEBUGGING
+    # cursor.execute("SELECT * FROM {result};".format(result=TABLE_NAME))
+    # for row in cursor.fetchall():
+        # print(row)
+    
+    # Delete all records with largest ID
+    # Assuming records are processed sequentially by id, if the process has crashed
+    # the safest way to ensure all results are processed are to discard the potentially
+    # incomplate previous transaction set (larget id) and recommence from there.
+    # With --checkpoint, all origins are retained and completed units skipped when planning.
+    resume_after = "''"
+    if not args.checkpoint:
+        cursor.execute('''
+            DELETE FROM {result} 
+            WHERE origin = (SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1);
+            '''.format(result=TABLE_NAME))
+        dbConn.commit()
+        resume_after = "COALESCE((SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1),'')".format(result = TABLE_NAME)
+    cursor.execute('''DROP TABLE IF EXISTS origins_updated''')
     dbConn.commit()
-    # copy dests to db
-    cursor.execute("drop table if exists destinations_{};".format(TABLE_NAME))
-    cursor.execute(createTable(table = "destinations",
-                               values = "'Y', 'X', 'fid', 'DZN_CODE_2016', 'COMPOUND_ID'")) 
-    cursor.executemany(insertRows("destinations",','.join(['?' for x in range(0,len(dests_list[0]))])), 
-                       dests_list[1:])
-    dbConn.commit()   
-except SQLException, msg:
-    print msg
-    sys.exit(1)
+    cursor.execute('''CREATE TABLE origins_updated AS 
+                    SELECT * FROM origins_{result} 
+                    WHERE "{id}" > {resume_after};
+                    '''.format(result = TABLE_NAME,
+                               id = args.id_names[0],
+                               resume_after = resume_after))
+    dbConn.commit()
+    
+    cursor.execute('''
+        SELECT "{id}",
+               "{lat}",
+               "{lon}"
+        FROM origins_updated
+        '''.format(id = args.id_names[0],
+                   lat = args.latlon_names[0],
+                   lon = args.latlon_names[1]))
+    rows = cursor.fetchall()
 
-# SNIPPETS FOR DEBUGGING
-# cursor.execute("SELECT * FROM {result};".format(result=TABLE_NAME))
-# for row in cursor.fetchall():
-    # print(row)
-    
-# Delete all records with largest ID
-# Assuming records are processed sequentially by id, if the process has crashed
-# the safest way to ensure all results are processed are to discard the potentially
-# incomplate previous transaction set (larget id) and recommence from there.
-cursor.execute('''
-    DELETE FROM {result} 
-    WHERE origin = (SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1);
-    '''.format(result=TABLE_NAME))
-dbConn.commit()
-cursor.execute('''DROP TABLE IF EXISTS origins_updated''')
-dbConn.commit()
-cursor.execute('''CREATE TABLE origins_updated AS 
-                SELECT * FROM origins_{result} 
-                WHERE "{id}" > COALESCE((SELECT origin FROM {result} ORDER BY origin DESC LIMIT 1),'');
-                '''.format(result = TABLE_NAME,
-                           id = args.id_names[0]))
-dbConn.commit()
-    
-cursor.execute('''
-    SELECT "{id}",
-           "{lat}",
-           "{lon}"
-    FROM origins_updated
-    '''.format(id = args.id_names[0],
-               lat = args.latlon_names[0],
-               lon = args.latlon_names[1]))
-rows = cursor.fetchall()
-
-updated_csv = '{}_updated{}'.format(*os.path.splitext(args.originsfile))
-try:
-    os.remove(updated_csv)
-except OSError:
-    pass
+    updated_csv = '{}_updated{}'.format(*os.path.splitext(args.originsfile))
+    try:
+        os.remove(updated_csv)
+    except OSError:
+        pass
     
-with open(updated_csv, 'w') as f:
-    updated_origins = csv.writer(f)
-    updated_origins.writerow((args.id_names[0],args.latlon_names[0],args.latlon_names[1]))
-    updated_origins.writerows(rows)
+    with open(updated_csv, 'w') as f:
+        updated_origins = csv.writer(f)
+        updated_origins.writerow((args.id_names[0],args.latlon_names[0],args.latlon_names[1]))
+        updated_origins.writerows(rows)
     
-# Close the zxJDBC connection
-cursor.close()
-dbConn.close()
+    # Close the zxJDBC connection
+    cursor.close()
+    dbConn.close()
 
-# open Xenial connection
-dbConn = getConnection(JDBC_URL, JDBC_DRIVER, sql_zxJDBC = False)
-stmt = dbConn.createStatement()
+    # open Xenial connection
+    dbConn = getConnection(JDBC_URL, JDBC_DRIVER, sql_zxJDBC = False)
+    stmt = dbConn.createStatement()
 
-# Read Points of Destination - The file points.csv, drawing on defaults or specified IDs, latitude and longitude
-orig_id = args.id_names[0]
-dest_id = args.id_names[1]
-lat = args.latlon_names[0]
-lon = args.latlon_names[1]
+    # Load origins and destinations
+    origins = otp.loadCSVPopulation(updated_csv, lat, lon)
+    dests   = otp.loadCSVPopulation(args.destsfile, lat, lon)
+
+if not inputs_staged:
+    recordInputs(dbConn, fingerprints)
+
+if args.out_format == 'parquet':
+    parquet_sink = startParquetSink(stmt)
 
+if args.bulk_load:
+    prepareBulkLoad(stmt)
+elif batched_commits:
+    dbConn.setAutoCommit(False)
 
-# Instantiate an OtpsEntryPoint
-otp = OtpsEntryPoint.fromArgs(['--graphs', 'graphs', '--router', proj_name])
+# Spatial index of destinations, for pruning those beyond reach of each origin
+dest_index = None
+if args.prune_dests and args.matching == 'one-to-many':
+    dest_index = DestinationIndex(dests)
 
-# Load origins and destinations
-origins = otp.loadCSVPopulation(updated_csv, lat, lon)
-dests   = otp.loadCSVPopulation(args.destsfile, lat, lon)
+# Accessibility surface sampled from each shortest path tree
+surface = None
+if args.raster is not None:
+    if args.raster_extent is not None:
+        top, bottom, left, right = args.raster_extent
+    else:
+        # the extent of the destinations, with a margin of one cell
+        lats = [individual.getLat() for individual in dests]
+        lons = [individual.getLon() for individual in dests]
+        margin_lat = args.raster / 110574.0
+        margin_lon = args.raster / (111320.0 * math.cos(math.radians(sum(lats) / len(lats))))
+        top, bottom, left, right = max(lats) + margin_lat, min(lats) - margin_lat, min(lons) - margin_lon, max(lons) + margin_lon
+    surface = AccessSurface(top, bottom, left, right, args.raster, 
+                            '{}_{}_surface'.format(os.path.splitext(args.outdb)[0], TABLE_NAME),
+                            resumingRun(stmt))
 
 # Get the default router
 router = otp.getRouter(proj_name)
@@ -410,6 +2162,58 @@ else:
 
 run_once = args.run_once  
 
+# Reduce and reuse modes for each origin, so trees are only planned for distinct useful modes
+mode_planner = None
+if args.reuse_modes:
+    mode_planner = ModePlanner(transitStops())
+
+if args.wideform:
+    # wide form table, with travel time and distance columns for each mode
+    wide_columns = ['origin', 'destination', 'dep_time'] 
+    for transport_mode in modes:
+        wide_columns += ['{}_time_mins'.format(transport_mode), '{}_dist_m'.format(transport_mode)]
+    try:
+        stmt.execute(createTable("wide", ','.join(['"{}"'.format(x) for x in wide_columns])))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+if args.cutoffs is not None:
+    # measures of destinations reached for each origin, departure time and mode
+    dest_weights = None
+    if args.weight_column is not None:
+        dest_weights = {}
+        invalid = 0
+        for individual in dests:
+            try:
+                dest_weights[individual.getStringData(dest_id)] = float(individual.getStringData(args.weight_column))
+            except (TypeError, ValueError):
+                dest_weights[individual.getStringData(dest_id)] = 0.0
+                invalid += 1
+        if invalid > 0:
+            print("{} destinations without a numeric {} were given weight 0".format(invalid, args.weight_column))
+    decay_param = args.decay_param
+    if decay_param is None:
+        decay_param = {'exponential': 0.1, 'power': 1.0, 'linear': args.max_time / 60.0}.get(args.decay)
+    try:
+        stmt.execute(createTable("access", 
+                                 ', '.join(['"{}" TEXT'.format(x) for x in access_columns[:3]] 
+                                           + ['"{}" {}'.format(x, 'INTEGER' if x.startswith('count_') else 'REAL') for x in access_columns[3:]])))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
+
+if args.metrics == 'jsonl':
+    metrics_file = '{}_{}_metrics.jsonl'.format(os.path.splitext(args.outdb)[0], TABLE_NAME)
+    print("Recording metrics to {}".format(metrics_file))
+elif args.metrics == 'table':
+    try:
+        stmt.execute(createTable("metrics", 
+                                 'recorded TEXT, ' + ', '.join(['{} {}'.format(x, 'INTEGER' if x in ['origins', 'total_origins', 'trees', 'rows'] else 'REAL') 
+                                                           for x in metrics_columns[1:-1]]) + ', timings TEXT'))
+    except SQLException, msg:
+        print msg
+        sys.exit(1)
 
 # Save the parameters used to generate the result, along with date and time of analysis
 commencement = datetime.now().strftime("%Y%m%d_%H%M")
@@ -421,101 +2225,69 @@ if args.cmd is not None:
     cmd = args.cmd.replace('--','\\\n    --')
     parameter_file.write('{}\n\nCommenced at {}'.format(cmd,commencement))
 else:
-    parameter_file.write('{}\n\nCommenced at {}'.format('\n'.join(sys.argv[1:]),commencement))
+    parameter_file.write('{}\n\nCommenced at {}'.format('\n'.join(job_argv or sys.argv[1:]),commencement))
 parameter_file.close() 
 
-# start_date = datetime.now()
+# Departure times: the commencement time, repeated at the specified interval (hours)
+# up to the end of the specified duration (hours), inclusive
 start_datetime = args.departure_time
 date_list = [start_datetime]
-# if args.duration_reps[0] > 0:
-    # end_datetime = start_datetime + timedelta(hours=args.duration_reps[0])
-    # new_datetime = start_datetime
-    # while new_datetime < end_datetime:
-        # new_datetime += timedelta(hours=args.duration_reps[1])
-        # date_list.append(new_datetime)
+if args.duration_reps[0] > 0:
+    end_datetime = start_datetime + timedelta(hours=args.duration_reps[0])
+    interval = timedelta(seconds=round(args.duration_reps[1]*3600))
+    new_datetime = start_datetime + interval
+    while new_datetime <= end_datetime:
+        date_list.append(new_datetime)
+        new_datetime += interval
         
-req = otp.createRequest()
-req.setMaxWalkDistance(args.max_walking_distance)
-
 print(args.matching)
 print(modes)
-i = 0       
-for dep in date_list:
-    # req.setDateTime(dep.year,dep.month,dep.day,dep.hour,dep.minute,dep.second)
-    # req.setDateTime(dep)
-    req.setMaxTimeSec(args.max_time)
-    r_dep_time    = dep.isoformat()
-    # r_dep_time    = str(dep)
-    # One-to-one matching
-    if args.matching == 'one-to-one':
-        index = 0;
-        for origin, dest in itertools.izip(origins, dests):
-            set_time = time.time()
-            index += 1
-            req.setOrigin(origin)
-            r_origin = origin.getStringData(orig_id)
-            print("Processing dep {}: origin {}...".format(r_dep_time,r_origin)),
-            set = []
-            for transport_mode in modes:
-                if (transport_mode not in run_once) or (transport_mode in run_once and i == 0):
-                    # define transport mode
-                    req.setModes(transport_mode)
-                    
-                    spt = router.plan(req)
-                    if spt is None: 
-                        # print "SPT is None"
-                        continue
-                    
-                    # Evaluate the SPT for destination
-                    result = spt.eval(dest)
-                    # Add a new row of result in the CSV output
-                    if result is not None:
-                        if (result.getTime() is not None) and (0 <= result.getTime() <=args.max_time) :
-                            r_destination = dest.getStringData(dest_id)
-                            r_mode        = '"{}"'.format(transport_mode)
-                            r_dist_m      = int(0 if result.getWalkDistance() is None else result.getWalkDistance())
-                            r_time_mins   = result.getTime()/60.0   
-                            set.append((r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins))
-            populateTable(dbConn, set)
-            print(set)
-            print("Completed in %g seconds" % (time.time() - set_time))
-  
-    # One-to-many matching
-    if args.matching == 'one-to-many':
-        # all_dests = []
-        # for dest in dests:
-            # all_dests.append(dest.getStringData(dest_id))
-        
-        for index, origin in enumerate(origins):
-            set_time = time.time()
-            req.setOrigin(origin)
-            r_origin      = origin.getStringData(orig_id)
-            print("Processing dep {}: origin {}...".format(r_dep_time,r_origin)),
-            set = []
-            for transport_mode in modes:
-                if (transport_mode not in run_once) or (transport_mode in run_once and i == 0):
-                    # define transport mode
-                    req.setModes(transport_mode)
-                    
-                    spt = router.plan(req)
-                    
-                    if spt is None: 
-                        # print "SPT is None"
-                        continue
-                    
-                    # Evaluate the SPT for all points
-                    results = spt.eval(dests)
-                    # Add a new row of result in the CSV output
-                    for result in results:
-                        if (result.getTime() is not None) and (0 <= result.getTime() <=args.max_time) :
-                            r_destination = result.getIndividual().getStringData(dest_id)
-                            r_mode        = '"{}"'.format(transport_mode)
-                            r_dist_m      = int(0 if result.getWalkDistance() is None else result.getWalkDistance())
-                            r_time_mins   = result.getTime()/60.0   
-                            set.append((r_origin, r_destination, r_dep_time, r_mode, r_dist_m, r_time_mins))
-            populateTable(dbConn, set)
-            print("Completed in %g seconds" % (time.time() - set_time))
-    i+=1
+print("Departure times: {}".format(', '.join([dep.isoformat() for dep in date_list])))
+if args.matching == 'one-to-one' and args.group_pairs:
+    # Grouped one-to-one matching: each distinct origin is evaluated against all of its paired destinations
+    tasks = groupPairs(origins, dests)
+elif args.matching == 'one-to-one':
+    # One-to-one matching: each origin is evaluated against its paired destination
+    tasks = itertools.izip(origins, dests)
+if args.matching == 'one-to-many':
+    # One-to-many matching: each origin is evaluated against all destinations
+    if args.dedup_origins is not None:
+        origins = groupOrigins(origins, args.dedup_origins)
+    tasks = ((origin, dests) for origin in origins)
+
+# Dense matrix store of results for each origin, destination, departure time and mode
+matrix_store = None
+if args.out_format == 'matrix':
+    matrix_store = MatrixStore('{}_{}.odmx'.format(os.path.splitext(args.outdb)[0], TABLE_NAME),
+                               readIds(args.originsfile, orig_id),
+                               readIds(args.destsfile, dest_id),
+                               [(dep.isoformat(), transport_mode) for i, dep in enumerate(date_list) 
+                                for transport_mode in modes if transport_mode not in run_once or i == 0],
+                               args.matrix_dtype)
+
+# Plan on worker thread(s), writing results from this thread
+planParallel(tasks)
+
+if surface is not None:
+    surface.close()
+
+if matrix_store is not None:
+    matrix_store.close()
+
+# the last batch is committed (flushing the parquet sink first) before the sink is closed
+if batched_commits:
+    commitBatch(dbConn)
+if args.bulk_load:
+    finishBulkLoad(stmt)
+elif batched_commits:
+    dbConn.setAutoCommit(True)
+
+if args.out_format == 'parquet':
+    parquet_sink.stdin.close()
+    parquet_sink.wait()
+
+if args.index_results and not args.bulk_load and args.out_format == 'sqlite':
+    indexResults(stmt)
 
 # Close the database connection
 stmt.close()
@@ -532,3 +2304,11 @@ parameter_file.write('\nCompleted at {}\nDuration (hours): {:.2}'.format(complet
 parameter_file.close() 
 print("Elapsed time was {:.2} hours".format(duration))
 print("Processed OD travel estimates for modes: {}".format(modes))
+if dest_index is not None:
+    print("Destination pruning evaluated {} of {} destinations for shortest path trees ({:.1%})".format(prune_counts['evaluated'],
+                                                                                                         prune_counts['total'],
+                                                                                                         prune_counts['evaluated'] / float(max(prune_counts['total'], 1))))
+if mode_planner is not None:
+    print("Mode reuse planned {} shortest path trees, reusing results for {} further modes ({:.1%} of trees saved)".format(mode_planner.counts['planned'],
+                                                                                                                       mode_planner.counts['reused'],
+                                                                                                                       mode_planner.counts['reused'] / float(max(sum(mode_planner.counts.values()), 1))))
@@ -0,0 +1,161 @@
+# !/usr/bin/jython
+
+# This Jython script runs a batch of odm.py jobs within a single JVM (via run-otp.sh -b).
+# Jobs for a region (graph) share one OtpsEntryPoint, so each graph is loaded once and
+# re-used for all of its departure times and mode lists; regions are run concurrently
+# while their estimated graph memory fits within the memory budget, and queued otherwise.
+# Graphs are held in a least recently used cache (see odm_graphs.py); using --watch, the
+# process stays running and runs manifests as they are placed in a spool directory, so
+# that repeated runs for a region re-use its resident graph.
+#
+# The manifest is a JSON list of jobs; each job's entries are passed to odm.py as
+# arguments (lists are expanded, and true values become flags), except for
+#     region     the project (graph) directory name within ./graphs, used as --proj_dir
+#     time_zone  the time zone of the departure time, passed to odm.py as --time_zone (by default,
+#                the JVM time zone, as set by run-otp.sh -t)
+# For example, the two passes of 30_min_cities_analysis_region_loop.sh for region 06 are:
+# [
+#   {"region": "sa1_dzn_region06_2019", "time_zone": "Australia/Queensland",
+#    "departure_time": "2019-10-16-07:45:00", "max_time": 10800, "max_walking_distance": 100000,
+#    "originsfile": "graphs/sa1_dzn_region06_2019/sa1_2016_network_snapped_pwc_region06.csv",
+#    "destsfile": "graphs/sa1_dzn_region06_2019/dzn_2016_network_snapped_centroids_region06.csv",
+#    "outdb": "graphs/sa1_dzn_region06_2019/sa1_dzn_region06_2019_0745_max_3hrs.db",
+#    "outtable": "od_modes_0745", "mode_list": ["WALK", "BICYCLE", "CAR", "WALK,TRANSIT"],
+#    "run_once": ["WALK", "BICYCLE", "CAR"], "id_names": ["SA1_MAINCO", "DZN_CODE_2016"],
+#    "latlon_names": ["Y", "X"], "wideform": true},
+#   {"region": "sa1_dzn_region06_2019", "time_zone": "Australia/Queensland",
+#    "departure_time": "2019-10-16-10:45:00", "max_time": 10800, "max_walking_distance": 100000,
+#    "originsfile": "graphs/sa1_dzn_region06_2019/sa1_2016_network_snapped_pwc_region06.csv",
+#    "destsfile": "graphs/sa1_dzn_region06_2019/dzn_2016_network_snapped_centroids_region06.csv",
+#    "outdb": "graphs/sa1_dzn_region06_2019/sa1_dzn_region06_2019_1045_max_3hrs_transit_only.db",
+#    "outtable": "od_modes_1045", "mode_list": ["WALK,TRANSIT"],
+#    "id_names": ["SA1_MAINCO", "DZN_CODE_2016"], "latlon_names": ["Y", "X"], "wideform": true}
+# ]
+#
+# ./run-otp.sh -b manifest.json
+# ./run-otp.sh -b "--watch graphs/spool"
+
+import argparse, time, os.path, sys
+import json
+import threading
+
+from java.lang import Runtime, Throwable
+
+from odm_graphs import GraphCache, GB
+from odm_jobs import runJob
+
+def valid_path(arg):
+    if not os.path.exists(arg):
+        msg = "The path %s does not exist!" % arg
+        raise argparse.ArgumentTypeError(msg)
+    else:
+        return arg
+
+# Parse input arguments
+parser = argparse.ArgumentParser(description='Run a batch of origin destination matrix jobs in a single JVM')
+parser.add_argument('manifest',
+                    help='path to a JSON manifest listing odm.py jobs',
+                    nargs='?',
+                    default=None,
+                    type=valid_path)
+parser.add_argument('--watch',
+                    help='Spool directory to watch for JSON manifests; each is run in turn (and moved to the done or failed sub-directory), keeping graphs resident between manifests',
+                    default=None,
+                    type=valid_path)
+parser.add_argument('--poll',
+                    help='Interval in seconds at which the spool directory is checked for manifests (default: 10)',
+                    default=10,
+                    type=float)
+parser.add_argument('--memory_budget',
+                    help='Memory budget in GB for resident graphs (default: 80%% of the JVM maximum heap)',
+                    default=None,
+                    type=float)
+parser.add_argument('--graph_memory_factor',
+                    help='Estimated memory required for a loaded graph, as a multiple of its Graph.obj file size (default: 3)',
+                    default=3,
+                    type=float)
+args = parser.parse_args()
+if (args.manifest is None) == (args.watch is None):
+    parser.error('specify either a manifest or a --watch directory')
+
+if args.memory_budget is None:
+    budget = 0.8 * Runtime.getRuntime().maxMemory()
+else:
+    budget = args.memory_budget * GB
+
+def runRegion(region, region_jobs, results):
+    """
+        Acquire a region's graph from the cache, and run each of its jobs in turn.
+    """
+    try:
+        otp = graph_cache.acquire(region)
+    except (Exception, Throwable), msg:
+        print("Region {} failed: {}".format(region, msg))
+        for job in region_jobs:
+            results.append((region, job.get('departure_time'), job.get('outtable'), False, 0))
+        return
+    try:
+        for job in region_jobs:
+            job_time = time.time()
+            print("Commencing {} job departing {}".format(region, job.get('departure_time')))
+            success = runJob(otp, job)
+            results.append((region, job.get('departure_time'), job.get('outtable'), success, time.time() - job_time))
+    finally:
+        otp = None
+        graph_cache.release(region)
+
+def runManifest(manifest):
+    """
+        Run the jobs listed in a manifest, concurrently by region; return True if all succeeded.
+    """
+    # group jobs by region, in order of first appearance in the manifest
+    jobs = json.load(open(manifest))
+    regions = []
+    region_jobs = {}
+    for job in jobs:
+        if job['region'] not in region_jobs:
+            regions.append(job['region'])
+            region_jobs[job['region']] = []
+        region_jobs[job['region']].append(job)
+    
+    start_time = time.time()
+    results = []
+    threads = []
+    for region in regions:
+        print("Starting region {} ({} jobs)".format(region, len(region_jobs[region])))
+        # the graph cache queues regions until their graphs fit within the memory budget
+        thread = threading.Thread(target = runRegion, args = (region, region_jobs[region], results))
+        thread.start()
+        threads.append(thread)
+    
+    for thread in threads:
+        thread.join()
+    
+    print("\nBatch {} completed in {:.2} hours".format(manifest, (time.time() - start_time)/60/60))
+    for region, departure_time, outtable, success, duration in results:
+        print("{}\t{}\t{}\t{}\t{:.1f} minutes".format(region, departure_time, outtable, 'completed' if success else 'FAILED', duration/60))
+    print(graph_cache.report())
+    return all([result[3] for result in results])
+
+graph_cache = GraphCache(budget, args.graph_memory_factor)
+
+if args.manifest is not None:
+    if not runManifest(args.manifest):
+        sys.exit(1)
+else:
+    for outcome in ['done', 'failed']:
+        if not os.path.exists(os.path.join(args.watch, outcome)):
+            os.makedirs(os.path.join(args.watch, outcome))
+    print("Watching {} for manifests".format(args.watch))
+    while True:
+        manifests = sorted([x for x in os.listdir(args.watch) if x.endswith('.json')])
+        if len(manifests) == 0:
+            time.sleep(args.poll)
+            continue
+        manifest = os.path.join(args.watch, manifests[0])
+        try:
+            outcome = 'done' if runManifest(manifest) else 'failed'
+        except (Exception, Throwable), msg:
+            print("Manifest {} failed: {}".format(manifest, msg))
+            outcome = 'failed'
+        os.rename(manifest, os.path.join(args.watch, outcome, manifests[0]))
@@ -0,0 +1,331 @@
+# This script is a reproducible benchmark for the odm.py pipeline.
+# It generates a small synthetic project in ./graphs/odm_benchmark: a street grid (OpenStreetMap
+# XML) with a toy GTFS feed of bus routes along some of its rows and columns, and origin and
+# destination csv files of configurable size, placed at random (with a fixed seed) within the
+# grid.  It then uses run-otp.sh to build the graph (once) and to run odm.py for each benchmark
+# case -- one-to-many and one-to-one matrices across a list of modes -- recording metrics
+# (see odm_metrics.py).  Planning, evaluation and write throughput for each case are reported,
+# and compared with a stored baseline (saved using --save_baseline); a case whose throughput
+# falls by more than the tolerance is reported as a regression, and the exit status is 1.
+#
+# Run from the repository directory (where run-otp.sh and the OTP, Jython and SQLite jars are
+# located), for example:
+#   python3 odm_benchmark.py --save_baseline
+#   python3 odm_benchmark.py --origins 100 --dests 500 --odm_args "--workers 4"
+#
+# Baselines are specific to the machine and benchmark size, which are recorded with them;
+# generated inputs are only replaced if the size or seed changes (or using --rebuild).
+
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import zipfile
+
+PROJECT = 'odm_benchmark'
+PROJ_DIR = os.path.join('graphs', PROJECT)
+TIME_ZONE = 'Australia/Melbourne'
+ORIGIN_LAT, ORIGIN_LON = -37.85, 144.90
+METRES_PER_DEGREE = 111320.0
+BUS_SPEED = 8.0   # metres per second
+
+parser = argparse.ArgumentParser(description='Benchmark odm.py using a synthetic network')
+parser.add_argument('--origins',
+                    help='number of origins (default: 50)',
+                    default=50,
+                    type=int)
+parser.add_argument('--dests',
+                    help='number of destinations for one-to-many matching (default: 200)',
+                    default=200,
+                    type=int)
+parser.add_argument('--grid',
+                    help='number of street intersections along each side of the grid (default: 40)',
+                    default=40,
+                    type=int)
+parser.add_argument('--spacing',
+                    help='distance in metres between intersections (default: 200)',
+                    default=200,
+                    type=float)
+parser.add_argument('--seed',
+                    help='random seed for origin and destination locations (default: 1)',
+                    default=1,
+                    type=int)
+parser.add_argument('--mode_list',
+                    help='modes to travel by (default: WALK BICYCLE CAR WALK,TRANSIT)',
+                    nargs='*',
+                    default=['WALK', 'BICYCLE', 'CAR', 'WALK,TRANSIT'])
+parser.add_argument('--matching',
+                    help='benchmark cases to run (default: one-to-many one-to-one)',
+                    nargs='*',
+                    choices=['one-to-many', 'one-to-one'],
+                    default=['one-to-many', 'one-to-one'])
+parser.add_argument('--departure_time',
+                    help='departure time - format YYYY-MM-DD-HH:MM:SS (default: 2019-10-16-07:45:00)',
+                    default='2019-10-16-07:45:00')
+parser.add_argument('--max_time',
+                    help='maximum travel time in seconds (default: 3600)',
+                    default=3600,
+                    type=int)
+parser.add_argument('--odm_args',
+                    help='additional arguments passed to odm.py for every case, in quotes (e.g. "--workers 4")',
+                    default='')
+parser.add_argument('--baseline',
+                    help='path to the stored baseline (default: graphs/odm_benchmark/baseline.json)',
+                    default=os.path.join(PROJ_DIR, 'baseline.json'))
+parser.add_argument('--save_baseline',
+                    help='store the results of this run as the baseline',
+                    action='store_true')
+parser.add_argument('--tolerance',
+                    help='fractional fall in throughput relative to the baseline reported as a regression (default: 0.1)',
+                    default=0.1,
+                    type=float)
+parser.add_argument('--rebuild',
+                    help='regenerate the network, inputs and graph',
+                    action='store_true')
+parser.add_argument('--setup_only',
+                    help='generate the project and inputs without running the benchmark',
+                    action='store_true')
+args = parser.parse_args()
+
+def grid_coordinates(row, col):
+    """
+        Return the latitude and longitude of a grid intersection.
+    """
+    lat = ORIGIN_LAT + row * args.spacing / METRES_PER_DEGREE
+    lon = ORIGIN_LON + col * args.spacing / (METRES_PER_DEGREE * math.cos(math.radians(ORIGIN_LAT)))
+    return lat, lon
+
+def write_osm(path):
+    """
+        Write the street grid as OpenStreetMap XML, with a residential way along each row and column.
+    """
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="odm_benchmark.py">\n')
+        for row in range(args.grid):
+            for col in range(args.grid):
+                lat, lon = grid_coordinates(row, col)
+                f.write('  <node id="{}" version="1" lat="{:.7f}" lon="{:.7f}"/>\n'.format(row * args.grid + col + 1, lat, lon))
+        way = 0
+        for line in ['row', 'col']:
+            for i in range(args.grid):
+                way += 1
+                f.write('  <way id="{}" version="1">\n'.format(way))
+                for j in range(args.grid):
+                    node = i * args.grid + j + 1 if line == 'row' else j * args.grid + i + 1
+                    f.write('    <nd ref="{}"/>\n'.format(node))
+                f.write('    <tag k="highway" v="residential"/>\n'
+                        '    <tag k="name" v="{} {}"/>\n'
+                        '  </way>\n'.format(line.title(), i))
+        f.write('</osm>\n')
+
+def write_gtfs(path):
+    """
+        Write a toy GTFS feed: bus routes in both directions along every fifth row and column
+        of the grid, stopping at every second intersection, every ten minutes from 06:00 to 22:00
+        on every day of the week surrounding the departure date.
+    """
+    date = datetime.datetime.strptime(args.departure_time, '%Y-%m-%d-%H:%M:%S').date()
+    stops = [['stop_id', 'stop_name', 'stop_lat', 'stop_lon']]
+    routes = [['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type']]
+    trips = [['route_id', 'service_id', 'trip_id', 'direction_id']]
+    stop_times = [['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']]
+    stop_ids = set()
+    hop = int(math.ceil(2 * args.spacing / BUS_SPEED))
+    for line in ['row', 'col']:
+        for i in range(0, args.grid, 5):
+            route_id = '{}{}'.format(line, i)
+            routes.append([route_id, 'bench', route_id, '{} {}'.format(line.title(), i), 3])
+            route_stops = []
+            for j in range(0, args.grid, 2):
+                row, col = (i, j) if line == 'row' else (j, i)
+                stop_id = 's{}_{}'.format(row, col)
+                if stop_id not in stop_ids:
+                    stop_ids.add(stop_id)
+                    lat, lon = grid_coordinates(row, col)
+                    stops.append([stop_id, stop_id, '{:.7f}'.format(lat), '{:.7f}'.format(lon)])
+                route_stops.append(stop_id)
+            for direction, sequence in enumerate([route_stops, route_stops[::-1]]):
+                for start in range(6 * 3600, 22 * 3600, 600):
+                    trip_id = '{}_{}_{}'.format(route_id, direction, start)
+                    trips.append([route_id, 'daily', trip_id, direction])
+                    for k, stop_id in enumerate(sequence):
+                        t = start + k * hop
+                        hms = '{:02d}:{:02d}:{:02d}'.format(t // 3600, t % 3600 // 60, t % 60)
+                        stop_times.append([trip_id, hms, hms, stop_id, k + 1])
+    tables = {'agency.txt': [['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+                             ['bench', 'Benchmark Transit', 'http://example.com', TIME_ZONE]],
+              'calendar.txt': [['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+                               ['daily'] + [1] * 7 + ['{:%Y%m%d}'.format(date - datetime.timedelta(days=7)),
+                                                      '{:%Y%m%d}'.format(date + datetime.timedelta(days=7))]],
+              'stops.txt': stops,
+              'routes.txt': routes,
+              'trips.txt': trips,
+              'stop_times.txt': stop_times}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, rows in tables.items():
+            z.writestr(name, '\n'.join([','.join([str(x) for x in row]) for row in rows]) + '\n')
+
+def write_points(path, id_name, prefix, count, rng):
+    """
+        Write a csv of points placed at random within the grid.
+    """
+    south, west = grid_coordinates(0, 0)
+    north, east = grid_coordinates(args.grid - 1, args.grid - 1)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([id_name, 'Y', 'X'])
+        for i in range(count):
+            writer.writerow(['{}{:07d}'.format(prefix, i),
+                             '{:.7f}'.format(rng.uniform(south, north)),
+                             '{:.7f}'.format(rng.uniform(west, east))])
+
+def setup():
+    """
+        Generate the project network and inputs, unless already generated with the same settings.
+    """
+    settings = {'grid': args.grid, 'spacing': args.spacing, 'seed': args.seed,
+                'origins': args.origins, 'dests': args.dests, 'departure_time': args.departure_time}
+    settings_file = os.path.join(PROJ_DIR, 'benchmark_settings.json')
+    if not args.rebuild and os.path.exists(settings_file):
+        with open(settings_file) as f:
+            if json.load(f) == settings:
+                return settings
+    network = {'grid': args.grid, 'spacing': args.spacing, 'departure_time': args.departure_time}
+    previous = {}
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            previous = json.load(f)
+    if not os.path.exists(PROJ_DIR):
+        os.makedirs(PROJ_DIR)
+    if args.rebuild or dict([(k, previous.get(k)) for k in network]) != network:
+        print("Generating synthetic network in {}".format(PROJ_DIR))
+        write_osm(os.path.join(PROJ_DIR, 'benchmark.osm'))
+        write_gtfs(os.path.join(PROJ_DIR, 'gtfs_benchmark.zip'))
+        if os.path.exists(os.path.join(PROJ_DIR, 'Graph.obj')):
+            os.remove(os.path.join(PROJ_DIR, 'Graph.obj'))
+    print("Generating {} origins and {} destinations".format(args.origins, args.dests))
+    rng = random.Random(args.seed)
+    write_points(os.path.join(PROJ_DIR, 'origins.csv'), 'origin_id', 'O', args.origins, rng)
+    write_points(os.path.join(PROJ_DIR, 'dests.csv'), 'dest_id', 'D', args.dests, rng)
+    write_points(os.path.join(PROJ_DIR, 'dests_paired.csv'), 'dest_id', 'P', args.origins, rng)
+    with open(settings_file, 'w') as f:
+        json.dump(settings, f, indent=2, sort_keys=True)
+    return settings
+
+def run_case(matching):
+    """
+        Run odm.py for a benchmark case using run-otp.sh, returning its final metrics snapshot.
+    """
+    table = matching.replace('-', '_')
+    outdb = os.path.join(PROJ_DIR, 'benchmark.db')
+    metrics_file = '{}_{}_metrics.jsonl'.format(os.path.splitext(outdb)[0], table)
+    for path in [metrics_file, outdb, outdb + '-wal', outdb + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+    parquet_dir = '{}_{}'.format(os.path.splitext(outdb)[0], table)
+    if os.path.isdir(parquet_dir):
+        shutil.rmtree(parquet_dir)
+    odm_args = ['--departure_time', args.departure_time,
+                '--time_zone', TIME_ZONE,
+                '--max_time', str(args.max_time),
+                '--max_walking_distance', '2000',
+                '--matching', matching,
+                '--originsfile', os.path.join(PROJ_DIR, 'origins.csv'),
+                '--destsfile', os.path.join(PROJ_DIR, 'dests.csv' if matching == 'one-to-many' else 'dests_paired.csv'),
+                '--outdb', outdb,
+                '--outtable', table,
+                '--mode_list'] + args.mode_list + [
+                '--id_names', 'origin_id', 'dest_id',
+                '--latlon_names', 'Y', 'X',
+                '--stream_inputs',
+                '--metrics', 'jsonl',
+                '--progress_interval', '60'] + shlex.split(args.odm_args)
+    command = ['./run-otp.sh', '-d', PROJECT, '-t', TIME_ZONE, '-w', ' '.join([shlex.quote(x) for x in odm_args])]
+    print("\nBenchmark case {}".format(matching))
+    if subprocess.call(command) != 0 or not os.path.exists(metrics_file):
+        sys.exit("Benchmark case {} failed".format(matching))
+    with open(metrics_file) as f:
+        return json.loads(f.readlines()[-1])
+
+def throughput(snapshot):
+    """
+        Summarise a metrics snapshot as throughput for each phase: trees planned and evaluated
+        per second of planning and evaluation time, and rows filtered and written per second
+        of filtering and writing time, along with overall trees and rows per second.
+    """
+    totals = {}
+    for mode, phases in snapshot['timings'].items():
+        for phase, timing in phases.items():
+            totals[phase] = totals.get(phase, 0) + timing['total_s']
+    return {'origins': snapshot['origins'],
+            'trees': snapshot['trees'],
+            'rows': snapshot['rows'],
+            'elapsed_s': snapshot['elapsed_s'],
+            'plan_trees_per_s': snapshot['trees'] / max(totals.get('plan', 0), 1e-6),
+            'eval_trees_per_s': snapshot['trees'] / max(totals.get('eval', 0), 1e-6),
+            'filter_rows_per_s': snapshot['rows'] / max(totals.get('filter', 0), 1e-6),
+            'write_rows_per_s': snapshot['rows'] / max(totals.get('write', 0), 1e-6),
+            'trees_per_s': snapshot['trees_per_s'],
+            'rows_per_s': snapshot['rows_per_s'],
+            'plan_mean_ms': dict([(mode, phases['plan']['mean_ms']) for mode, phases in snapshot['timings'].items() if 'plan' in phases])}
+
+RATES = ['plan_trees_per_s', 'eval_trees_per_s', 'filter_rows_per_s', 'write_rows_per_s', 'trees_per_s', 'rows_per_s']
+
+def report(results, baseline):
+    """
+        Print the throughput of each case with its change from the baseline; return the
+        list of regressions beyond the tolerance.
+    """
+    regressions = []
+    for case, result in results.items():
+        print("\n{}: {} origins, {} trees, {} rows in {:.1f} seconds".format(case, result['origins'], result['trees'],
+                                                                            result['rows'], result['elapsed_s']))
+        base = baseline.get('cases', {}).get(case)
+        for rate in RATES:
+            line = "  {:<20}{:>14.1f}".format(rate, result[rate])
+            if base is not None and base.get(rate):
+                change = result[rate] / base[rate] - 1
+                line += "{:>14.1f}{:>+9.1%}".format(base[rate], change)
+                if change < -args.tolerance:
+                    line += "  REGRESSION"
+                    regressions.append((case, rate, change))
+            print(line)
+        for mode, mean in sorted(result['plan_mean_ms'].items()):
+            print("  plan mean ms {:<20}{:>8.1f}".format(mode, mean))
+    return regressions
+
+settings = setup()
+if args.setup_only:
+    sys.exit(0)
+
+results = {}
+for matching in args.matching:
+    results[matching] = throughput(run_case(matching))
+
+baseline = {}
+if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings or baseline.get('mode_list') != args.mode_list:
+        print("\nThe baseline {} was recorded with different settings; throughput is not compared".format(args.baseline))
+        baseline = {}
+regressions = report(results, baseline)
+
+if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+        json.dump({'recorded': datetime.datetime.now().isoformat(),
+                   'settings': settings,
+                   'mode_list': args.mode_list,
+                   'odm_args': args.odm_args,
+                   'cases': results}, f, indent=2, sort_keys=True)
+    print("\nSaved baseline to {}".format(args.baseline))
+elif regressions:
+    print("\n{} regressions beyond {:.0%} tolerance".format(len(regressions), args.tolerance))
+    sys.exit(1)
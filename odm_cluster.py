@@ -0,0 +1,428 @@
+# !/usr/bin/jython
+
+# This Jython script distributes odm.py jobs across worker processes on several nodes (via
+# run-otp.sh -c), using a spool directory on a shared filesystem as the work queue, so that no
+# external broker is required.  It is run with one of the following actions:
+#     submit MANIFEST  split the jobs of a manifest (see odm_batch.py for the format) into tasks of
+#                      up to --chunk_size origins and, where possible, single departure times, and
+#                      add these to the spool
+#     work             claim and run tasks until stopped (or, using --exit_when_idle, until no
+#                      tasks remain); each task writes its results to its own shard database
+#     merge            combine the shards of each job whose tasks are all done into the job's outdb
+#     status           report the number of tasks pending, leased, done and failed for each job
+#
+# The spool directory contains:
+#     jobs/      a description of each submitted job and its tasks
+#     inputs/    the origin (and, for one-to-one matching, destination) csv file for each chunk
+#     pending/   tasks awaiting a worker
+#     leased/    tasks claimed by a worker, named <task>@<worker>@<claim time>
+#     done/      completed tasks, retaining their lease name, which identifies their shard
+#     failed/    tasks which failed --max_attempts times
+#     shards/    the shard database written by each lease
+# Tasks are claimed by renaming them from pending to leased, which succeeds for only one worker.
+# A worker touches its lease while the task runs; any worker finding a lease which has not been
+# touched within --lease seconds returns the task to pending (or failed), so tasks from workers
+# which crash or stall are leased out again.  Lease times are compared across nodes, so their
+# clocks should be synchronised to well within the lease period.
+#
+# Jobs using --bulk_load or --out_format parquet or matrix are not supported, as their results
+# are not held in plain tables which may be merged; nor are jobs using --raster or --metrics
+# jsonl, whose files would be written separately by each task.  Departure times are only split
+# across tasks when results are written as rows without --wideform; modes in run_once are
+# planned by the task for the first departure time.
+#
+# ./run-otp.sh -c "submit manifest.json --spool /shared/odm_spool --chunk_size 500"
+# ./run-otp.sh -c "work --spool /shared/odm_spool"        (on each node)
+# ./run-otp.sh -c "merge --spool /shared/odm_spool"
+
+import argparse, time, os.path, sys
+import csv
+import json
+import threading
+from datetime import datetime, timedelta
+
+from java.lang import Class, Runtime, Throwable
+from java.lang.management import ManagementFactory
+from java.sql import DriverManager, SQLException
+
+from odm_graphs import GraphCache, GB
+from odm_jobs import runJob
+
+SPOOL_DIRS = ['jobs', 'inputs', 'pending', 'leased', 'done', 'failed', 'shards', 'tmp']
+
+# Parse input arguments
+parser = argparse.ArgumentParser(description='Run origin destination matrix jobs across several nodes using a shared spool directory')
+parser.add_argument('action',
+                    help='submit a manifest, work on tasks, merge completed jobs, or report status',
+                    choices=['submit', 'work', 'merge', 'status'])
+parser.add_argument('manifest',
+                    help='path to a JSON manifest listing odm.py jobs (for submit)',
+                    nargs='?',
+                    default=None)
+parser.add_argument('--spool',
+                    help='spool directory on a filesystem shared by all nodes',
+                    required=True)
+parser.add_argument('--chunk_size',
+                    help='Maximum number of origins in a task (default: 1000)',
+                    default=1000,
+                    type=int)
+parser.add_argument('--lease',
+                    help='Seconds after which a task whose lease has not been renewed is returned to pending (default: 600)',
+                    default=600,
+                    type=float)
+parser.add_argument('--max_attempts',
+                    help='Number of attempts at a task before it is moved to failed (default: 3)',
+                    default=3,
+                    type=int)
+parser.add_argument('--poll',
+                    help='Interval in seconds at which a worker checks for pending tasks (default: 10)',
+                    default=10,
+                    type=float)
+parser.add_argument('--exit_when_idle',
+                    help='Stop working once no tasks are pending or leased',
+                    default=False,
+                    action='store_true')
+parser.add_argument('--memory_budget',
+                    help='Memory budget in GB for resident graphs (default: 80%% of the JVM maximum heap)',
+                    default=None,
+                    type=float)
+parser.add_argument('--graph_memory_factor',
+                    help='Estimated memory required for a loaded graph, as a multiple of its Graph.obj file size (default: 3)',
+                    default=3,
+                    type=float)
+args = parser.parse_args()
+if args.action == 'submit' and args.manifest is None:
+    parser.error('a manifest must be specified to submit')
+
+def spoolPath(*parts):
+    return os.path.join(args.spool, *parts)
+
+def writeJSON(path, value):
+    """
+        Write a JSON file, so that it appears under its name only once complete.
+    """
+    tmp = spoolPath('tmp', '{}.{}'.format(os.path.basename(path), workerId()))
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+def readJSON(path):
+    with open(path) as f:
+        return json.load(f)
+
+def workerId():
+    """
+        Return an identifier for this process (pid@host).
+    """
+    return ManagementFactory.getRuntimeMXBean().getName().replace('@', '-')
+
+def departureTimes(job):
+    """
+        Return the departure times of a job, as odm.py would expand them.
+    """
+    start_datetime = datetime.strptime(job['departure_time'], "%Y-%m-%d-%H:%M:%S")
+    date_list = [start_datetime]
+    duration, interval = [float(x) for x in job.get('duration_reps', [0, 0])]
+    if duration > 0:
+        end_datetime = start_datetime + timedelta(hours=duration)
+        interval = timedelta(seconds=round(interval*3600))
+        new_datetime = start_datetime + interval
+        while new_datetime <= end_datetime:
+            date_list.append(new_datetime)
+            new_datetime += interval
+    return date_list
+
+def splitInput(path, job_id, name, chunk_size):
+    """
+        Split an input csv file into chunks of up to chunk_size rows in the spool inputs
+        directory, returning the list of chunk paths.
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = reader.next()
+        out = None
+        for count, row in enumerate(reader):
+            if count % chunk_size == 0:
+                if out is not None:
+                    out.close()
+                chunks.append(spoolPath('inputs', '{}_{}_{:05d}.csv'.format(job_id, name, len(chunks))))
+                out = open(chunks[-1], 'wb')
+                writer = csv.writer(out)
+                writer.writerow(header)
+            writer.writerow(row)
+        if out is not None:
+            out.close()
+    return chunks
+
+def submit(manifest):
+    """
+        Split the jobs of a manifest into tasks, and add them to the spool.
+    """
+    stem = os.path.splitext(os.path.basename(manifest))[0]
+    for number, job in enumerate(readJSON(manifest)):
+        if job.get('bulk_load') or job.get('out_format', 'sqlite') != 'sqlite':
+            sys.exit("Job {} of {}: --bulk_load and parquet or matrix output are not supported for distributed runs".format(number, manifest))
+        if job.get('raster') is not None or job.get('metrics') == 'jsonl':
+            sys.exit("Job {} of {}: --raster and --metrics jsonl are not supported for distributed runs, as their files are written by each task".format(number, manifest))
+        job_id = '{}_{:03d}_{}'.format(stem, number, job['region'])
+        origins = splitInput(job['originsfile'], job_id, 'origins', args.chunk_size)
+        if job.get('matching', 'one-to-many') == 'one-to-one':
+            dests = splitInput(job['destsfile'], job_id, 'dests', args.chunk_size)
+        else:
+            dests = [job['destsfile']] * len(origins)
+        departures = [None]
+        if job.get('window_output', 'rows') == 'rows' and not job.get('wideform'):
+            departures = departureTimes(job)
+        tasks = []
+        for chunk, (origins_chunk, dests_chunk) in enumerate(zip(origins, dests)):
+            for i, departure in enumerate(departures):
+                task = dict(job)
+                task.update({'originsfile': origins_chunk,
+                             'destsfile': dests_chunk,
+                             'stream_inputs': True})
+                task.pop('outdb', None)
+                if departure is not None:
+                    task['departure_time'] = departure.strftime("%Y-%m-%d-%H:%M:%S")
+                    task['duration_reps'] = [0, 0]
+                    if i > 0 and job.get('run_once'):
+                        task['mode_list'] = [x for x in job.get('mode_list', ['WALK,BUS,RAIL']) if x not in job['run_once']]
+                        if len(task['mode_list']) == 0:
+                            continue
+                task_id = '{}_{:05d}_{:03d}'.format(job_id, chunk, i)
+                writeJSON(spoolPath('pending', '{}.json'.format(task_id)), {'task_id': task_id,
+                                                                             'job_id': job_id,
+                                                                             'job': task,
+                                                                             'attempts': 0,
+                                                                             'errors': []})
+                tasks.append(task_id)
+        writeJSON(spoolPath('jobs', '{}.json'.format(job_id)), {'job_id': job_id,
+                                                                 'job': job,
+                                                                 'tasks': tasks,
+                                                                 'submitted': datetime.now().isoformat()})
+        print("Submitted job {} as {} tasks ({} origin chunks, {} departure times)".format(job_id, len(tasks), len(origins), len(departures)))
+
+def requeue(path, task_id, error):
+    """
+        Return a claimed task to pending, or move it to failed once it has been attempted
+        --max_attempts times, removing the claimed file and its shard.
+    """
+    task = readJSON(path)
+    task['attempts'] += 1
+    task['errors'].append('{} {}'.format(datetime.now().isoformat(), error))
+    outcome = 'failed' if task['attempts'] >= args.max_attempts else 'pending'
+    writeJSON(spoolPath(outcome, '{}.json'.format(task_id)), task)
+    os.remove(path)
+    shard = spoolPath('shards', '{}.db'.format(os.path.basename(path)))
+    if os.path.exists(shard):
+        os.remove(shard)
+    print("Task {} {} ({}); moved to {}".format(task_id, error, task['attempts'], outcome))
+
+def reclaimExpired():
+    """
+        Return tasks whose leases have not been renewed within --lease seconds to pending.
+    """
+    for name in os.listdir(spoolPath('leased')):
+        parts = name.split('@')
+        if len(parts) != 3:
+            continue
+        path = spoolPath('leased', name)
+        try:
+            renewed = max(os.path.getmtime(path), float(parts[2]))
+        except OSError:
+            continue
+        if time.time() - renewed < args.lease:
+            continue
+        # only one worker succeeds in moving the expired lease
+        claimed = spoolPath('tmp', name)
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        requeue(claimed, parts[0], 'lease expired')
+
+def claimTask():
+    """
+        Claim a pending task, returning the path of its lease (or None if none are pending).
+    """
+    for name in sorted(os.listdir(spoolPath('pending'))):
+        if not name.endswith('.json'):
+            continue
+        lease = spoolPath('leased', '{}@{}@{:.0f}'.format(name[:-len('.json')], workerId(), time.time()))
+        try:
+            os.rename(spoolPath('pending', name), lease)
+        except OSError:
+            continue
+        if os.path.exists(lease):
+            return lease
+    return None
+
+def renewLease(lease, stop):
+    """
+        Touch the lease file until stopped, or until the lease is lost.
+    """
+    while True:
+        stop.wait(args.lease / 4)
+        if stop.isSet():
+            return
+        try:
+            os.utime(lease, None)
+        except OSError:
+            print("Lease {} was lost".format(os.path.basename(lease)))
+            return
+
+def work():
+    """
+        Claim and run tasks, each writing to its own shard database.
+    """
+    graph_cache = GraphCache(0.8 * Runtime.getRuntime().maxMemory() if args.memory_budget is None else args.memory_budget * GB,
+                             args.graph_memory_factor)
+    print("Worker {} watching {}".format(workerId(), args.spool))
+    while True:
+        reclaimExpired()
+        lease = claimTask()
+        if lease is None:
+            if args.exit_when_idle and len(os.listdir(spoolPath('leased'))) == 0:
+                break
+            time.sleep(args.poll)
+            continue
+        task = readJSON(lease)
+        name = os.path.basename(lease)
+        job = dict(task['job'])
+        job['outdb'] = spoolPath('shards', '{}.db'.format(name))
+        stop = threading.Event()
+        renewer = threading.Thread(target = renewLease, args = (lease, stop))
+        renewer.setDaemon(True)
+        renewer.start()
+        task_time = time.time()
+        print("Running task {} (attempt {})".format(task['task_id'], task['attempts'] + 1))
+        try:
+            otp = graph_cache.acquire(job['region'])
+            try:
+                success = runJob(otp, job)
+            finally:
+                otp = None
+                graph_cache.release(job['region'])
+        except (Exception, Throwable), msg:
+            print("Task {} failed: {}".format(task['task_id'], msg))
+            success = False
+        stop.set()
+        renewer.join()
+        claimed = spoolPath('done' if success else 'tmp', name)
+        try:
+            os.rename(lease, claimed)
+        except OSError:
+            # the lease expired while running, and the task has been leased out again
+            print("Discarding results of task {}, as its lease expired".format(task['task_id']))
+            if os.path.exists(job['outdb']):
+                os.remove(job['outdb'])
+            continue
+        if success:
+            print("Completed task {} in {:.1f} minutes".format(task['task_id'], (time.time() - task_time) / 60))
+        else:
+            requeue(claimed, task['task_id'], 'failed')
+    print(graph_cache.report())
+
+def doneTasks():
+    """
+        Return a dictionary of the done file name for each completed task.
+    """
+    return dict([(name.split('@')[0], name) for name in sorted(os.listdir(spoolPath('done'))) if '@' in name])
+
+def mergeJob(job_record, done):
+    """
+        Insert the tables of each shard of a completed job into its outdb, recording the
+        shards merged so that each is merged only once.
+    """
+    job = job_record['job']
+    Class.forName('org.sqlite.JDBC')
+    merged_table = '{}_merged_shards'.format(job['outtable'])
+    dbConn = DriverManager.getConnection('jdbc:sqlite:{}'.format(job['outdb']))
+    stmt = dbConn.createStatement()
+    try:
+        stmt.execute('CREATE TABLE IF NOT EXISTS "{}" (task_id TEXT PRIMARY KEY, shard TEXT, merged TEXT)'.format(merged_table))
+        rs = stmt.executeQuery('SELECT task_id FROM "{}"'.format(merged_table))
+        merged = []
+        while rs.next():
+            merged.append(rs.getString(1))
+        rs.close()
+        count = 0
+        for task_id in job_record['tasks']:
+            if task_id in merged:
+                continue
+            shard = spoolPath('shards', '{}.db'.format(done[task_id]))
+            stmt.execute("ATTACH DATABASE '{}' AS shard".format(shard.replace("'", "''")))
+            dbConn.setAutoCommit(False)
+            rs = stmt.executeQuery("SELECT name, sql FROM shard.sqlite_master WHERE type = 'table'")
+            tables = []
+            while rs.next():
+                tables.append((rs.getString(1), rs.getString(2)))
+            rs.close()
+            for table, sql in tables:
+                rs = stmt.executeQuery("SELECT COUNT(*) FROM main.sqlite_master WHERE type = 'table' AND name = '{}'".format(table))
+                rs.next()
+                exists = rs.getInt(1) > 0
+                rs.close()
+                if not exists:
+                    stmt.execute(sql)
+                if table.startswith('origins_') or table.startswith('destinations_'):
+                    # inputs are staged by each task, so are only added if not already present
+                    stmt.execute('INSERT INTO main."{0}" SELECT * FROM shard."{0}" EXCEPT SELECT * FROM main."{0}"'.format(table))
+                else:
+                    # rows of tables with a primary key (e.g. progress) are replaced
+                    stmt.execute('INSERT OR REPLACE INTO main."{0}" SELECT * FROM shard."{0}"'.format(table))
+            stmt.execute("INSERT INTO \"{}\" VALUES ('{}', '{}', '{}')".format(merged_table, task_id, done[task_id], datetime.now().isoformat()))
+            dbConn.commit()
+            dbConn.setAutoCommit(True)
+            stmt.execute("DETACH DATABASE shard")
+            count += 1
+    except SQLException, msg:
+        print("Merging job {} failed: {}".format(job_record['job_id'], msg))
+        if not dbConn.getAutoCommit():
+            dbConn.rollback()
+        return False
+    finally:
+        stmt.close()
+        dbConn.close()
+    print("Merged {} shards of job {} into {}".format(count, job_record['job_id'], job['outdb']))
+    return True
+
+def merge():
+    """
+        Merge the shards of each job whose tasks are all done.
+    """
+    done = doneTasks()
+    for name in sorted(os.listdir(spoolPath('jobs'))):
+        job_record = readJSON(spoolPath('jobs', name))
+        remaining = [x for x in job_record['tasks'] if x not in done]
+        if len(remaining) > 0:
+            print("Job {} has {} of {} tasks remaining; not merged".format(job_record['job_id'], len(remaining), len(job_record['tasks'])))
+            continue
+        mergeJob(job_record, done)
+
+def status():
+    """
+        Report the state of the tasks of each job.
+    """
+    states = {}
+    for state in ['pending', 'leased', 'done', 'failed']:
+        for name in os.listdir(spoolPath(state)):
+            states[name.split('@')[0].replace('.json', '')] = state
+    print("job\ttasks\tpending\tleased\tdone\tfailed")
+    for name in sorted(os.listdir(spoolPath('jobs'))):
+        job_record = readJSON(spoolPath('jobs', name))
+        counts = [len([x for x in job_record['tasks'] if states.get(x) == state]) for state in ['pending', 'leased', 'done', 'failed']]
+        print('\t'.join([job_record['job_id'], str(len(job_record['tasks']))] + [str(x) for x in counts]))
+
+for directory in SPOOL_DIRS:
+    if not os.path.exists(spoolPath(directory)):
+        os.makedirs(spoolPath(directory))
+
+if args.action == 'submit':
+    submit(args.manifest)
+elif args.action == 'work':
+    work()
+elif args.action == 'merge':
+    merge()
+else:
+    status()
@@ -1,21 +1,165 @@
-# This script takes the output from odm_combinations.py 
+# This script takes the output from odm_combinations.py
 # (a jython script for running OpenTripPlanner analyses across combinations of travel modes)
 # and transforms it to wide format
 
-# If running this on Ubuntu / Unix4Win you may need to 
+# If running this on Ubuntu / Unix4Win you may need to
 # sudo apt-get install python-pip
 # sudo pip install numpy
 # sudo pip install pandas
 
+# Large inputs may be processed out-of-core using --chunksize; the input is then streamed
+# in chunks, with the rows for the last origin of each chunk carried to the next, so the
+# input is assumed to be grouped by origin (as odm.py writes all results for an origin
+# together).  The SQLite results tables produced by odm.py may also be used as input,
+# by specifying the database as infile along with --table (always processed in chunks,
+# read in order of origin; tables written using --bulk_load are read through their view).
+# For example:
+#   python odm_combo_wide_long.py SA2_SA2_ODM.all_mode_combinations.csv --chunksize 1000000
+#   python odm_combo_wide_long.py graphs/sa1_dzn_region01_2019/sa1_dzn_region01_2019_0745_max_3hrs.db --table od_modes_0745
+
 import pandas as pd
+import numpy as np
 import os
 import sys
+import argparse
+import sqlite3
+
+SQLITE_EXTENSIONS = ['.db', '.sqlite', '.sqlite3']
+
+def source_table(args):
+    """
+        Return the table or view with text columns for the results table: tables written
+        using --bulk_load have integer keys, resolved by their view.
+    """
+    con = sqlite3.connect(args.infile)
+    names = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+    con.close()
+    view = '{}_view'.format(args.table)
+    return view if view in names else args.table
+
+def chunk_reader(args, columns):
+    """
+        Yield chunks of the input as data frames, with numeric values as float32.
+    """
+    if args.sqlite:
+        con = sqlite3.connect(args.infile)
+        # rows are read grouped by origin, as chunked_wide requires
+        query = 'SELECT {} FROM "{}" ORDER BY "{}"'.format(','.join(['"{}"'.format(x) for x in columns]), args.source, columns[0])
+        for chunk in pd.read_sql_query(query, con, chunksize=args.chunksize):
+            yield chunk.astype(dict([(x, np.float32) for x in columns[-2:]]))
+        con.close()
+    else:
+        for chunk in pd.read_csv(args.infile,
+                                 usecols=columns,
+                                 dtype=dict([(x, str) for x in columns[:-2]] + [(x, np.float32) for x in columns[-2:]]),
+                                 chunksize=args.chunksize):
+            yield chunk
+
+def mode_order(args, mode):
+    """
+        Return the transport modes in the input, in order of first appearance.
+    """
+    if args.sqlite:
+        con = sqlite3.connect(args.infile)
+        combos = [row[0] for row in con.execute('SELECT DISTINCT "{}" FROM "{}"'.format(mode, args.source))]
+        con.close()
+    else:
+        combos = []
+        for chunk in pd.read_csv(args.infile, usecols=[mode], dtype=str, chunksize=args.chunksize):
+            combos += [x for x in chunk[mode].unique() if x not in combos]
+    return [x.strip('"') for x in combos]
+
+def pivot_block(block, index, mode, value, combos):
+    """
+        Return a block of long form rows as a wide data frame of the given value by mode,
+        using compact categorical identifiers.
+    """
+    block = block[index + [mode, value]].astype(dict([(x, 'category') for x in index + [mode]]))
+    wide = block.set_index(index + [mode])[value].unstack(mode)
+    wide = wide.reindex(columns=combos)
+    wide.columns = list(wide.columns)
+    wide.reset_index(inplace=True)
+    # drop unobserved categorical combinations of identifiers
+    return wide[wide[combos].notnull().any(axis=1)]
+
+def chunked_wide(args, stub, outdir):
+    """
+        Stream the input in chunks, pivoting blocks of complete origins to wide form and
+        appending them to the walk distance and travel time outputs.
+    """
+    if args.sqlite:
+        index = ['origin', 'destination']
+        con = sqlite3.connect(args.infile)
+        if 'dep_time' in [row[1] for row in con.execute('PRAGMA table_info("{}")'.format(args.source))]:
+            index += ['dep_time']
+        con.close()
+        mode, dist, time = 'mode', 'dist_m', 'time_mins'
+    else:
+        index = ['Origin', 'Destination']
+        mode, dist, time = 'Transport_mode(s)', 'Walk_distance (meters)', 'Travel_time (seconds)'
+    combos = mode_order(args, mode)
+    outputs = [(dist, os.path.join(outdir,'{}_walk_dist_m.csv'.format(stub))),
+               (time, os.path.join(outdir,'{}_travel_time_mins.csv'.format(stub)))]
+    for value, outfile in outputs:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+
+    # rows are numbered across blocks, as the unchunked output's index column
+    rows_written = dict([(outfile, 0) for value, outfile in outputs])
+
+    def write_block(block, header):
+        block = block.copy()
+        block[mode] = block[mode].str.strip('"')
+        for value, outfile in outputs:
+            wide = pivot_block(block, index, mode, value, combos)
+            wide.index = np.arange(rows_written[outfile], rows_written[outfile] + len(wide))
+            wide[index + combos].to_csv(outfile, mode='a', header=header)
+            rows_written[outfile] += len(wide)
+
+    header = True
+    carry = None
+    for chunk in chunk_reader(args, index + [mode, dist, time]):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        # the last origin may continue in the next chunk
+        last = chunk[index[0]] == chunk[index[0]].iloc[-1]
+        carry = chunk[last]
+        if (~last).any():
+            write_block(chunk[~last], header)
+            header = False
+    if carry is not None:
+        write_block(carry, header)
+
+parser = argparse.ArgumentParser(description='Transform long form origin destination matrix output to wide form')
+parser.add_argument('infile',
+                    help='long form csv file, or SQLite database produced by odm.py (with --table)',
+                    nargs='?',
+                    default=None)
+parser.add_argument('--table',
+                    help='results table, for a SQLite database infile',
+                    default=None)
+parser.add_argument('--chunksize',
+                    help='number of rows to read at a time; if specified, the input is processed out-of-core (default for SQLite input: 1000000)',
+                    default=None,
+                    type=int)
+args = parser.parse_args()
+if args.infile is not None:
+  args.sqlite = os.path.splitext(args.infile)[1].lower() in SQLITE_EXTENSIONS
+  if args.sqlite and args.table is None:
+    parser.error('a --table must be specified for SQLite input')
+  if args.sqlite:
+    args.source = source_table(args)
 
-if len(sys.argv) < 2:
+if args.infile is None:
   print("Hey, there's no output filename specified!  This program expects this as an argument in order to run")
   print("(For example, you could run: python odm_combo_wide_long.py SA2_SA2_ODM.all_mode_combinations.csv ")
+elif args.sqlite or args.chunksize is not None:
+  if args.chunksize is None:
+    args.chunksize = 1000000
+  stub = args.table if args.sqlite else os.path.splitext(os.path.basename(args.infile))[0]
+  chunked_wide(args, stub, os.path.dirname(args.infile))
 else:
-  infile  = sys.argv[1]
+  infile  = args.infile
   outdir = os.path.dirname(infile)
   # read csv back in as Pandas dataframe (df)
   df = pd.read_csv(infile )
@@ -0,0 +1,390 @@
+# This script compares two or more origin destination matrix outputs (scenarios), such as the
+# 07:45 and 10:45 runs of 30_min_cities_analysis_region_loop.sh, or runs before and after a change
+# of GTFS feed.  Inputs may be odm.py SQLite results tables (including those written using
+# --bulk_load), or long form csv files as read by odm_combo_wide_long.py.
+#
+# Results are aligned on (origin, destination, mode), encoded as 64 bit integer keys using
+# dictionaries of IDs shared between inputs.  To bound memory use, each input is streamed once in
+# chunks, with its encoded rows spooled to disk in --partitions partitions by origin; each partition
+# is then compared for all scenarios using array operations, so memory use is proportional to the
+# size of a partition.  Where a scenario has several departure times for a pair, their travel
+# times are reduced to the mean (or minimum, see --reduce).
+#
+# The comparison is written to a SQLite database (--outdb), in tables named for --name:
+#     NAME                  each pair's value for each scenario, and its difference from the
+#                           first (base) scenario (NULL where either is unreached), with integer
+#                           origin, destination and mode keys
+#     NAME_origin_summary   for each origin, mode and scenario after the first, counts of
+#                           destinations reached in the base and scenario, in both, gained and
+#                           lost, and the distribution (mean, minimum, percentiles and maximum)
+#                           of the differences for destinations reached in both
+#     NAME_*_keys           the IDs of origin, destination and mode keys, with views NAME_view
+#                           and NAME_origin_summary_view of the tables with IDs
+# For example:
+#   python odm_compare.py graphs/sa1_dzn_region06_2019/sa1_dzn_region06_2019_0745_max_3hrs.db \
+#                         graphs/sa1_dzn_region06_2019/sa1_dzn_region06_2019_1045_max_3hrs.db \
+#                         --tables od_modes_0745 od_modes_1045 --labels am pm --name am_pm
+#   python odm_compare.py before.csv after.csv --pair_output changed
+
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+SQLITE_EXTENSIONS = ['.db', '.sqlite', '.sqlite3']
+
+# columns of odm.py results tables, and of long form csv files (travel time in seconds)
+SQLITE_COLUMNS = {'origin': 'origin', 'destination': 'destination', 'mode': 'mode',
+                  'time_mins': 'time_mins', 'dist_m': 'dist_m'}
+CSV_COLUMNS = {'origin': 'Origin', 'destination': 'Destination', 'mode': 'Transport_mode(s)',
+               'time_mins': 'Travel_time (seconds)', 'dist_m': 'Walk_distance (meters)'}
+
+# bits of the integer keys: origin (23), mode (8) and destination (32), so pairs sort by origin and mode
+ORIGIN_SHIFT = 40
+MODE_SHIFT = 32
+MAX_CODES = {'origin': 1 << 23, 'mode': 1 << 8, 'destination': 1 << 32}
+
+SPOOL_DTYPE = np.dtype([('key', '<i8'), ('value', '<f4')])
+
+class Encoder(object):
+    """
+        Dictionary encoding of IDs as consecutive integers, shared between inputs.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.index = pd.Index([], dtype=object)
+
+    def encode(self, values):
+        values = pd.Index(values.astype(str))
+        uniques = values.unique()
+        new = uniques[self.index.get_indexer(uniques) < 0]
+        if len(new) > 0:
+            self.index = self.index.append(new)
+            if len(self.index) > MAX_CODES[self.field]:
+                raise ValueError('more than {} distinct {} IDs'.format(MAX_CODES[self.field], self.field))
+        return self.index.get_indexer(values).astype(np.int64)
+
+def chunk_reader(source, args):
+    """
+        Yield chunks of an input's origin, destination, mode and compared value as data frames.
+    """
+    value = args.value
+    if source['sqlite']:
+        con = sqlite3.connect(source['path'])
+        names = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+        if source['table'] not in names:
+            raise ValueError('{} has no table {}'.format(source['path'], source['table']))
+        # tables written using --bulk_load have integer keys, resolved by their view
+        table = '{}_view'.format(source['table']) if '{}_view'.format(source['table']) in names else source['table']
+        columns = [SQLITE_COLUMNS[x] for x in ['origin', 'destination', 'mode', value]]
+        query = 'SELECT {} FROM "{}"'.format(','.join(['"{}"'.format(x) for x in columns]), table)
+        for chunk in pd.read_sql_query(query, con, chunksize=args.chunksize):
+            chunk.columns = ['origin', 'destination', 'mode', 'value']
+            yield chunk
+        con.close()
+    else:
+        columns = [CSV_COLUMNS[x] for x in ['origin', 'destination', 'mode', value]]
+        for chunk in pd.read_csv(source['path'],
+                                 usecols=columns,
+                                 dtype=dict([(x, str) for x in columns[:3]]),
+                                 chunksize=args.chunksize):
+            chunk = chunk[columns]
+            chunk.columns = ['origin', 'destination', 'mode', 'value']
+            if value == 'time_mins':
+                chunk['value'] = chunk['value'] / 60.0
+            yield chunk
+
+def spool_path(spool, scenario, partition):
+    return os.path.join(spool, '{}_{}.bin'.format(scenario, partition))
+
+def spool_input(source, scenario, encoders, spool, args):
+    """
+        Encode an input's rows as integer keys, appending them to the spool file of each origin's partition.
+    """
+    count = 0
+    for chunk in chunk_reader(source, args):
+        origin = encoders['origin'].encode(chunk['origin'].values)
+        destination = encoders['destination'].encode(chunk['destination'].values)
+        mode = encoders['mode'].encode(chunk['mode'].str.strip('"').values)
+        rows = np.empty(len(chunk), dtype=SPOOL_DTYPE)
+        rows['key'] = (origin << ORIGIN_SHIFT) | (mode << MODE_SHIFT) | destination
+        rows['value'] = chunk['value'].values.astype(np.float32)
+        partition = origin % args.partitions
+        order = np.argsort(partition, kind='stable')
+        rows = rows[order]
+        bounds = np.searchsorted(partition[order], np.arange(args.partitions + 1))
+        for p in range(args.partitions):
+            if bounds[p] < bounds[p + 1]:
+                with open(spool_path(spool, scenario, p), 'ab') as f:
+                    rows[bounds[p]:bounds[p + 1]].tofile(f)
+        count += len(chunk)
+        sys.stdout.write('\r{}: {} rows'.format(source['label'], count))
+        sys.stdout.flush()
+    print('')
+
+def read_partition(spool, scenario, partition, reduce):
+    """
+        Return the sorted distinct keys of a scenario's partition, and their values (reduced
+        across departure times).
+    """
+    path = spool_path(spool, scenario, partition)
+    if not os.path.exists(path):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows = np.fromfile(path, dtype=SPOOL_DTYPE)
+    keys, inverse = np.unique(rows['key'], return_inverse=True)
+    if len(keys) == len(rows):
+        values = np.empty(len(keys), dtype=np.float32)
+        values[inverse] = rows['value']
+    elif reduce == 'min':
+        values = np.full(len(keys), np.inf, dtype=np.float32)
+        np.minimum.at(values, inverse, rows['value'])
+    else:
+        values = (np.bincount(inverse, weights=rows['value']) / np.bincount(inverse)).astype(np.float32)
+    return keys, values
+
+def group_quantiles(groups, values, count, quantiles):
+    """
+        Return the minimum, given quantiles (0 to 100, with linear interpolation) and maximum
+        of values by group (0 to count - 1), as arrays (NaN for empty groups).
+    """
+    order = np.lexsort((values, groups))
+    values = values[order]
+    sizes = np.bincount(groups, minlength=count)
+    starts = np.cumsum(sizes) - sizes
+    empty = sizes == 0
+    results = []
+    for q in [0] + list(quantiles) + [100]:
+        position = starts + (q / 100.0) * np.maximum(sizes - 1, 0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        if len(values) == 0:
+            results.append(np.full(count, np.nan))
+            continue
+        lower = np.minimum(lower, len(values) - 1)
+        upper = np.minimum(upper, len(values) - 1)
+        result = values[lower] + (values[upper] - values[lower]) * (position - lower)
+        result[empty] = np.nan
+        results.append(result)
+    return results
+
+def compare_partition(spool, partition, labels, args):
+    """
+        Align the scenarios of a partition, returning data frames of pairs and origin summaries.
+    """
+    scenarios = [read_partition(spool, s, partition, args.reduce) for s in range(len(labels))]
+    keys = np.unique(np.concatenate([k for k, v in scenarios]))
+    table = np.full((len(labels), len(keys)), np.nan, dtype=np.float32)
+    for s, (k, v) in enumerate(scenarios):
+        table[s, np.searchsorted(keys, k)] = v
+    deltas = table[1:] - table[0]
+    origin_mode = keys >> MODE_SHIFT
+    pairs = pd.DataFrame({'origin_id': keys >> ORIGIN_SHIFT,
+                          'destination_id': keys & 0xFFFFFFFF,
+                          'mode_id': origin_mode & 0xFF})
+    for s, label in enumerate(labels):
+        pairs['{}_{}'.format(label, args.value)] = table[s]
+    for s, label in enumerate(labels[1:]):
+        pairs['{}_delta'.format(label)] = deltas[s]
+    if args.pair_output == 'changed':
+        reached = ~np.isnan(table)
+        changed = (reached != reached[0]).any(axis=0) | (np.abs(np.nan_to_num(deltas)) > args.min_delta).any(axis=0)
+        pairs = pairs[changed]
+    groups, group_index = np.unique(origin_mode, return_inverse=True)
+    summaries = []
+    base = ~np.isnan(table[0])
+    for s, label in enumerate(labels[1:]):
+        other = ~np.isnan(table[s + 1])
+        both = base & other
+        count = np.bincount(group_index[both], minlength=len(groups))
+        summary = pd.DataFrame({'origin_id': groups >> (ORIGIN_SHIFT - MODE_SHIFT),
+                                'mode_id': groups & 0xFF,
+                                'scenario': label,
+                                'base_reached': np.bincount(group_index[base], minlength=len(groups)),
+                                'reached': np.bincount(group_index[other], minlength=len(groups)),
+                                'both': count,
+                                'gained': np.bincount(group_index[other & ~base], minlength=len(groups)),
+                                'lost': np.bincount(group_index[base & ~other], minlength=len(groups))})
+        delta_sum = np.bincount(group_index[both], weights=deltas[s][both], minlength=len(groups))
+        summary['mean_delta'] = np.where(count > 0, delta_sum / np.maximum(count, 1), np.nan)
+        stats = group_quantiles(group_index[both], deltas[s][both].astype(np.float64), len(groups), args.percentiles)
+        summary['min_delta'] = stats[0]
+        for q, values in zip(args.percentiles, stats[1:-1]):
+            summary['p{:g}_delta'.format(q)] = values
+        summary['max_delta'] = stats[-1]
+        summaries.append(summary)
+    return pairs, pd.concat(summaries, ignore_index=True), (table, deltas, keys)
+
+def create_tables(con, name, labels, args):
+    """
+        Create the comparison tables, replacing any of the same name.
+    """
+    for table in [name, '{}_origin_summary'.format(name)] + ['{}_{}_keys'.format(name, x) for x in ['origin', 'destination', 'mode']]:
+        con.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+    for view in ['{}_view'.format(name), '{}_origin_summary_view'.format(name)]:
+        con.execute('DROP VIEW IF EXISTS "{}"'.format(view))
+    columns = (['origin_id INTEGER', 'destination_id INTEGER', 'mode_id INTEGER']
+               + ['"{}_{}" REAL'.format(label, args.value) for label in labels]
+               + ['"{}_delta" REAL'.format(label) for label in labels[1:]])
+    con.execute('CREATE TABLE "{}" ({})'.format(name, ', '.join(columns)))
+    columns = (['origin_id INTEGER', 'mode_id INTEGER', 'scenario TEXT']
+               + ['{} INTEGER'.format(x) for x in ['base_reached', 'reached', 'both', 'gained', 'lost']]
+               + ['{} REAL'.format(x) for x in ['mean_delta', 'min_delta'] + ['p{:g}_delta'.format(q) for q in args.percentiles] + ['max_delta']])
+    con.execute('CREATE TABLE "{}_origin_summary" ({})'.format(name, ', '.join(columns)))
+    for field in ['origin', 'destination', 'mode']:
+        con.execute('CREATE TABLE "{name}_{field}_keys" (id INTEGER PRIMARY KEY, {field} TEXT UNIQUE)'.format(name=name, field=field))
+
+def write_keys(con, name, encoders):
+    """
+        Record the IDs of each key, and create views of the comparison tables with IDs.
+    """
+    for field, encoder in encoders.items():
+        con.executemany('INSERT INTO "{}_{}_keys" VALUES (?, ?)'.format(name, field),
+                        [(int(i), x) for i, x in enumerate(encoder.index)])
+    value_columns = [x[1] for x in con.execute('PRAGMA table_info("{}")'.format(name))][3:]
+    con.execute('''
+        CREATE VIEW "{name}_view" AS
+        SELECT o.origin, d.destination, m.mode, {columns}
+        FROM "{name}" r
+        JOIN "{name}_origin_keys" o ON r.origin_id = o.id
+        JOIN "{name}_destination_keys" d ON r.destination_id = d.id
+        JOIN "{name}_mode_keys" m ON r.mode_id = m.id
+        '''.format(name=name, columns=', '.join(['r."{}"'.format(x) for x in value_columns])))
+    summary_columns = [x[1] for x in con.execute('PRAGMA table_info("{}_origin_summary")'.format(name))][2:]
+    con.execute('''
+        CREATE VIEW "{name}_origin_summary_view" AS
+        SELECT o.origin, m.mode, {columns}
+        FROM "{name}_origin_summary" r
+        JOIN "{name}_origin_keys" o ON r.origin_id = o.id
+        JOIN "{name}_mode_keys" m ON r.mode_id = m.id
+        '''.format(name=name, columns=', '.join(['r."{}"'.format(x) for x in summary_columns])))
+
+def compare(sources, args):
+    labels = [source['label'] for source in sources]
+    encoders = dict([(field, Encoder(field)) for field in ['origin', 'destination', 'mode']])
+    spool = tempfile.mkdtemp(prefix='odm_compare_', dir=args.tmpdir)
+    try:
+        for scenario, source in enumerate(sources):
+            spool_input(source, scenario, encoders, spool, args)
+        con = sqlite3.connect(args.outdb)
+        create_tables(con, args.name, labels, args)
+        # overall difference by scenario and mode: (pairs reached in both, sum of differences, gained, lost)
+        totals = {}
+        for p in range(args.partitions):
+            pairs, summary, (table, deltas, keys) = compare_partition(spool, p, labels, args)
+            if args.pair_output != 'none':
+                pairs.to_sql(args.name, con, if_exists='append', index=False)
+            summary.to_sql('{}_origin_summary'.format(args.name), con, if_exists='append', index=False)
+            modes = (keys >> MODE_SHIFT) & 0xFF
+            base = ~np.isnan(table[0])
+            for s, label in enumerate(labels[1:]):
+                other = ~np.isnan(table[s + 1])
+                for mode in np.unique(modes):
+                    in_mode = modes == mode
+                    both = in_mode & base & other
+                    total = totals.setdefault((label, int(mode)), [0, 0.0, 0, 0])
+                    total[0] += int(both.sum())
+                    total[1] += float(deltas[s][both].sum())
+                    total[2] += int((in_mode & other & ~base).sum())
+                    total[3] += int((in_mode & base & ~other).sum())
+            con.commit()
+            sys.stdout.write('\rCompared partition {} of {}'.format(p + 1, args.partitions))
+            sys.stdout.flush()
+        print('')
+        write_keys(con, args.name, encoders)
+        con.commit()
+        con.close()
+    finally:
+        shutil.rmtree(spool, ignore_errors=True)
+    print('Wrote comparison of {} to {} in {}'.format(', '.join(labels), args.name, args.outdb))
+    for (label, mode), (both, delta_sum, gained, lost) in sorted(totals.items()):
+        print('{} vs {}, {}: {} pairs reached in both (mean difference {:.3f}), {} gained, {} lost'.format(label,
+                                                                                                       labels[0],
+                                                                                                       encoders['mode'].index[mode],
+                                                                                                       both,
+                                                                                                       delta_sum / max(both, 1),
+                                                                                                       gained,
+                                                                                                       lost))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare origin destination matrix outputs for two or more scenarios')
+    parser.add_argument('inputs',
+                        help='long form csv files, or SQLite databases produced by odm.py (with --tables); the first is the base scenario',
+                        nargs='+')
+    parser.add_argument('--tables',
+                        help='results table of each SQLite input, or a single table name for all',
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--labels',
+                        help='label of each scenario, used in column names (default: the table name or file name)',
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--value',
+                        help='value compared: travel time (minutes) or walk distance (metres) (default: time_mins)',
+                        choices=['time_mins', 'dist_m'],
+                        default='time_mins')
+    parser.add_argument('--reduce',
+                        help='reduction of values for a pair with several departure times (default: mean)',
+                        choices=['mean', 'min'],
+                        default='mean')
+    parser.add_argument('--percentiles',
+                        help='percentiles of the per-origin distributions of differences (default: 10 50 90)',
+                        nargs='+',
+                        default=[10, 50, 90],
+                        type=float)
+    parser.add_argument('--pair_output',
+                        help='pairs written: all, those reached in only some scenarios or differing by more than --min_delta, or none (origin summaries only) (default: all)',
+                        choices=['all', 'changed', 'none'],
+                        default='all')
+    parser.add_argument('--min_delta',
+                        help='difference above which a pair is written with --pair_output changed (default: 0)',
+                        default=0,
+                        type=float)
+    parser.add_argument('--outdb',
+                        help='SQLite database to which the comparison is written (default: odm_comparison.db)',
+                        default='odm_comparison.db')
+    parser.add_argument('--name',
+                        help='name of the comparison table, prefixing the other tables (default: comparison)',
+                        default='comparison')
+    parser.add_argument('--chunksize',
+                        help='number of rows read at a time (default: 1000000)',
+                        default=1000000,
+                        type=int)
+    parser.add_argument('--partitions',
+                        help='number of origin partitions compared at a time; memory use is proportional to the rows of all scenarios divided by this (default: 64)',
+                        default=64,
+                        type=int)
+    parser.add_argument('--tmpdir',
+                        help='directory for spooled partitions (default: the system temporary directory)',
+                        default=None)
+    args = parser.parse_args()
+    if len(args.inputs) < 2:
+        parser.error('at least two inputs are required')
+    sqlite_inputs = [os.path.splitext(x)[1].lower() in SQLITE_EXTENSIONS for x in args.inputs]
+    tables = args.tables or []
+    if any(sqlite_inputs) and len(tables) not in [1, sum(sqlite_inputs)]:
+        parser.error('specify a single --tables name, or one for each SQLite input')
+    if args.labels is not None and len(args.labels) != len(args.inputs):
+        parser.error('specify a label for each input')
+    sources = []
+    for i, (path, sqlite) in enumerate(zip(args.inputs, sqlite_inputs)):
+        source = {'path': path, 'sqlite': sqlite, 'table': None}
+        if sqlite:
+            source['table'] = tables[0] if len(tables) == 1 else tables[sum(sqlite_inputs[:i])]
+        if args.labels is not None:
+            source['label'] = args.labels[i]
+        else:
+            source['label'] = source['table'] or os.path.splitext(os.path.basename(path))[0]
+        source['label'] = re.sub(r'\W+', '_', source['label'])
+        sources.append(source)
+    labels = [source['label'] for source in sources]
+    if len(set(labels)) < len(labels):
+        # e.g. the same table name in each database
+        for i, source in enumerate(sources):
+            source['label'] = '{}_{}'.format(source['label'], i + 1)
+    compare(sources, args)
@@ -0,0 +1,129 @@
+# !/usr/bin/jython
+
+# Graph loading layer around OtpsEntryPoint, used by odm_batch.py.
+# Loaded graphs (routers) are kept resident after use, so that later jobs for the same region
+# start computing without deserialising Graph.obj again.  Resident graphs are held within a
+# heap budget: when a graph must be loaded and does not fit, the least recently used graphs not
+# currently in use are evicted; if it still does not fit, loading waits until graphs are released.
+
+import os.path, time
+import threading
+
+from org.opentripplanner.scripting.api import OtpsEntryPoint
+from java.lang import Runtime, System
+
+GB = 1024.0**3
+
+def usedHeap():
+    """
+        Return the JVM heap currently in use, in bytes.
+    """
+    runtime = Runtime.getRuntime()
+    return runtime.totalMemory() - runtime.freeMemory()
+
+class GraphCache(object):
+    """
+        Least recently used cache of OtpsEntryPoints, each with one region's graph loaded.
+        Use acquire(region) to obtain an entry point, and release(region) once finished with it.
+    """
+    def __init__(self, budget, graph_memory_factor = 3, graphs_dir = 'graphs'):
+        self.budget = budget
+        self.graph_memory_factor = graph_memory_factor
+        self.graphs_dir = graphs_dir
+        self.entries = {}      # region: [otp, estimated memory, users]
+        self.recent = []       # regions, least recently used first
+        self.loading = {}      # region: event set once loading completes
+        self.reserved = 0
+        self.condition = threading.Condition()
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0, 'load_seconds': 0.0}
+
+    def estimate(self, region):
+        """
+            Return the estimated memory (bytes) required for a region's graph once loaded.
+        """
+        graph = os.path.join(self.graphs_dir, region, 'Graph.obj')
+        if not os.path.exists(graph):
+            return 0
+        return self.graph_memory_factor * os.path.getsize(graph)
+
+    def evict(self, memory):
+        """
+            Evict least recently used graphs not in use until the given memory fits within
+            the budget (or no further graphs may be evicted).  Call with the condition held.
+        """
+        for region in list(self.recent):
+            if self.reserved + memory <= self.budget:
+                break
+            otp, estimate, users = self.entries[region]
+            if users == 0:
+                del self.entries[region]
+                self.recent.remove(region)
+                self.reserved -= estimate
+                self.stats['evictions'] += 1
+                print("Evicted graph {} ({:.2f} GB)".format(region, estimate / GB))
+        return self.reserved + memory <= self.budget
+
+    def acquire(self, region):
+        """
+            Return an OtpsEntryPoint with the region's graph loaded, loading it if not resident.
+        """
+        with self.condition:
+            while True:
+                if region in self.entries:
+                    entry = self.entries[region]
+                    entry[2] += 1
+                    self.recent.remove(region)
+                    self.recent.append(region)
+                    self.stats['hits'] += 1
+                    print("Using resident graph {}".format(region))
+                    return entry[0]
+                if region in self.loading:
+                    # another job is loading this graph; wait for it
+                    self.condition.wait()
+                    continue
+                memory = self.estimate(region)
+                if self.evict(memory) or self.reserved == 0:
+                    break
+                self.condition.wait()
+            self.reserved += memory
+            self.loading[region] = True
+        try:
+            load_time = time.time()
+            otp = OtpsEntryPoint.fromArgs(['--graphs', self.graphs_dir, '--router', region])
+            otp.getRouter(region)
+            load_time = time.time() - load_time
+        except:
+            with self.condition:
+                self.reserved -= memory
+                del self.loading[region]
+                self.condition.notifyAll()
+            raise
+        with self.condition:
+            del self.loading[region]
+            self.entries[region] = [otp, memory, 1]
+            self.recent.append(region)
+            self.stats['loads'] += 1
+            self.stats['load_seconds'] += load_time
+            print("Loaded graph {} in {:g} seconds ({:.2f} GB heap in use; {:.2f} of {:.2f} GB budget reserved)".format(region,
+                                                                                                                   load_time,
+                                                                                                                   usedHeap() / GB,
+                                                                                                                   self.reserved / GB,
+                                                                                                                   self.budget / GB))
+            self.condition.notifyAll()
+        return otp
+
+    def release(self, region):
+        """
+            Mark a job as finished with the region's graph; it remains resident until evicted.
+        """
+        with self.condition:
+            self.entries[region][2] -= 1
+            self.condition.notifyAll()
+        System.gc()
+
+    def report(self):
+        """
+            Return a summary of cache use.
+        """
+        return "Graph cache: {hits} hits, {loads} loads ({load_seconds:.1f} seconds loading), {evictions} evictions; resident: {resident}".format(
+                   resident = ', '.join(self.recent) or 'none', **self.stats)
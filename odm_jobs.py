@@ -0,0 +1,50 @@
+# !/usr/bin/jython
+
+# Running odm.py jobs within a JVM, as used by odm_batch.py and odm_cluster.py.
+# A job is a dictionary of odm.py arguments (see odm_batch.py for the manifest format); it is
+# run by executing odm.py in its own namespace, with a shared OtpsEntryPoint having the job's
+# graph loaded (see odm_graphs.py), and populations cached from earlier jobs with the same inputs.
+
+import os.path
+
+from java.lang import Throwable
+
+odm_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'odm.py')
+odm_code   = compile(open(odm_script).read(), odm_script, 'exec')
+
+# populations read from unchanged input files, reused by later jobs (see loadPopulation in odm.py)
+populations = {}
+
+def jobArguments(job):
+    """
+        Return the odm.py arguments for a manifest job.
+    """
+    argv = ['--proj_dir', os.path.join('.', 'graphs', job['region'])]
+    for key, value in sorted(job.items()):
+        if key == 'region':
+            continue
+        if isinstance(value, list):
+            argv += ['--{}'.format(key)] + [str(x) for x in value]
+        elif value is True:
+            argv += ['--{}'.format(key)]
+        elif value not in [False, None]:
+            argv += ['--{}'.format(key), str(value)]
+    return argv
+
+def runJob(otp, job):
+    """
+        Run an odm.py job in its own namespace, using the shared OtpsEntryPoint; return True on success.
+    """
+    namespace = {'__name__': '__odm_job__',
+                 '__file__': odm_script,
+                 'job_argv': jobArguments(job),
+                 'shared_otp': otp,
+                 'shared_populations': populations}
+    try:
+        exec odm_code in namespace
+    except SystemExit, code:
+        return code.code in [None, 0]
+    except (Exception, Throwable), msg:
+        print("Job failed: {}".format(msg))
+        return False
+    return True
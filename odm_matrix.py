@@ -0,0 +1,283 @@
+# This script reads and writes the dense binary matrix store for origin destination results,
+# as written by odm.py using --out_format matrix, or converted from an odm.py SQLite results table.
+#
+# For a fixed set of origins, destinations, departure times and modes, results form a dense array,
+# stored as a single file:
+#     bytes 0-7    magic number ODMATRX1
+#     bytes 8-15   length of the header in bytes (little endian unsigned 64 bit integer)
+#     header       UTF-8 JSON, padded with spaces, describing the store:
+#                      origins, destinations   lists of IDs, giving the index of each row and column
+#                      layers                  list of {dep_time, mode, time_offset, dist_offset}
+#                      dtype                   float32, or int16 (for half the size)
+#                      time_scale, dist_scale  units of stored values: float32 uses minutes and
+#                                              metres (1, 1); int16 uses tenths of minutes and
+#                                              tens of metres (0.1, 10)
+#                      sentinel                value of unreachable pairs: null (NaN) for float32,
+#                                              or -1 for int16
+#     data         from the first multiple of 4096 bytes following the header, for each layer
+#                  (departure time and mode), a travel time array and a walk distance array, each
+#                  of origins x destinations values in little endian byte order, origin-major
+#                  (the values for an origin are contiguous).
+# Readers memory-map the layers, so any origin row or destination column may be sliced without
+# loading the file.  For example:
+#     from odm_matrix import MatrixStore
+#     store = MatrixStore('graphs/region06/od_modes_0745.odmx')
+#     store.origin_row('30101100101', 'WALK,TRANSIT')                # travel time (minutes) to each destination
+#     store.destination_column('1100011', 'CAR', field = 'dist')     # walk distance from each origin
+#
+# Usage:
+#   python odm_matrix.py convert graphs/region06/sa1_dzn_region06_2019_0745_max_3hrs.db --table od_modes_0745 --out od_modes_0745.odmx
+#   python odm_matrix.py info od_modes_0745.odmx
+#   python odm_matrix.py row od_modes_0745.odmx 30101100101 --mode WALK,TRANSIT
+#   python odm_matrix.py column od_modes_0745.odmx 1100011 --mode CAR --field dist
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'ODMATRX1'
+ALIGNMENT = 4096
+DTYPES = {'float32': {'time_scale': 1, 'dist_scale': 1, 'sentinel': None},
+          'int16': {'time_scale': 0.1, 'dist_scale': 10, 'sentinel': -1}}
+
+def build_header(origins, destinations, layers, dtype):
+    """
+        Return the header for a store of the given IDs and (dep_time, mode) layers, and
+        the offset of its data, assigning the offset of each layer's arrays.
+    """
+    header = {'origins': list(origins),
+              'destinations': list(destinations),
+              'dtype': dtype,
+              'layers': [{'dep_time': dep_time, 'mode': mode, 'time_offset': 0, 'dist_offset': 0} for dep_time, mode in layers]}
+    header.update(DTYPES[dtype])
+    # offsets are assigned once the length of the header (with offsets up to 20 digits) is known
+    length = len(json.dumps(header).encode('utf-8')) + 40 * len(layers)
+    data_offset = -(-(16 + length) // ALIGNMENT) * ALIGNMENT
+    size = len(origins) * len(destinations) * np.dtype(dtype).itemsize
+    for i, layer in enumerate(header['layers']):
+        layer['time_offset'] = data_offset + 2 * i * size
+        layer['dist_offset'] = data_offset + (2 * i + 1) * size
+    return header, data_offset
+
+def create(path, origins, destinations, layers, dtype = 'float32'):
+    """
+        Create a store with all pairs unreachable, returning it opened for writing.
+    """
+    header, data_offset = build_header(origins, destinations, layers, dtype)
+    encoded = json.dumps(header).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', data_offset - 16))
+        f.write(encoded + b' ' * (data_offset - 16 - len(encoded)))
+        f.truncate(data_offset + 2 * len(layers) * len(origins) * len(destinations) * np.dtype(dtype).itemsize)
+    store = MatrixStore(path, mode = 'r+')
+    for arrays in store.layers.values():
+        for array in arrays:
+            array[:] = np.nan if store.sentinel is None else store.sentinel
+    return store
+
+class MatrixStore(object):
+    """
+        Memory-mapped matrix store; see the description of the format above.
+    """
+    def __init__(self, path, mode = 'r'):
+        with open(path, 'rb') as f:
+            if f.read(8) != MAGIC:
+                raise ValueError('{} is not a matrix store'.format(path))
+            length = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        self.path = path
+        self.origins = self.header['origins']
+        self.destinations = self.header['destinations']
+        self.origin_index = dict([(x, i) for i, x in enumerate(self.origins)])
+        self.destination_index = dict([(x, i) for i, x in enumerate(self.destinations)])
+        self.dtype = np.dtype(self.header['dtype']).newbyteorder('<')
+        self.sentinel = self.header['sentinel']
+        self.scales = {'time': self.header['time_scale'], 'dist': self.header['dist_scale']}
+        shape = (len(self.origins), len(self.destinations))
+        self.layers = {}
+        for layer in self.header['layers']:
+            self.layers[(layer['dep_time'], layer['mode'])] = tuple([np.memmap(path, dtype = self.dtype, mode = mode,
+                                                                               offset = layer[offset], shape = shape)
+                                                                     for offset in ['time_offset', 'dist_offset']])
+
+    def layer(self, mode, dep_time = None, field = 'time'):
+        """
+            Return the stored array of a field (time or dist) for a mode and departure time
+            (by default, the first departure time for which the mode is stored).
+        """
+        if dep_time is None:
+            dep_times = sorted([dep for dep, layer_mode in self.layers if layer_mode == mode])
+            if len(dep_times) == 0:
+                raise KeyError('mode {} is not stored'.format(mode))
+            dep_time = dep_times[0]
+        return self.layers[(dep_time, mode)][0 if field == 'time' else 1]
+
+    def decode(self, values, field = 'time'):
+        """
+            Return stored values as float minutes (time) or metres (dist), with NaN for unreachable pairs.
+        """
+        values = np.asarray(values)
+        if self.sentinel is None:
+            return values.astype(np.float64) * self.scales[field]
+        decoded = values.astype(np.float64) * self.scales[field]
+        decoded[values == self.sentinel] = np.nan
+        return decoded
+
+    def encode(self, values, field = 'time'):
+        """
+            Return float minutes or metres (NaN for unreachable) as stored values.
+        """
+        values = np.asarray(values, dtype = np.float64)
+        if self.sentinel is None:
+            return values.astype(self.dtype)
+        limit = np.iinfo(self.dtype).max
+        encoded = np.clip(np.round(values / self.scales[field]), 0, limit)
+        encoded[np.isnan(values)] = self.sentinel
+        return encoded.astype(self.dtype)
+
+    def origin_row(self, origin, mode, dep_time = None, field = 'time'):
+        """
+            Return the values from an origin to each destination.
+        """
+        return self.decode(self.layer(mode, dep_time, field)[self.origin_index[origin]], field)
+
+    def destination_column(self, destination, mode, dep_time = None, field = 'time'):
+        """
+            Return the values from each origin to a destination.
+        """
+        return self.decode(self.layer(mode, dep_time, field)[:, self.destination_index[destination]], field)
+
+    def flush(self):
+        for arrays in self.layers.values():
+            for array in arrays:
+                array.flush()
+
+def read_ids(path, id_name):
+    """
+        Return the IDs in a column of a csv file, in order.
+    """
+    with open(path) as f:
+        reader = csv.reader(f)
+        column = next(reader).index(id_name)
+        return [row[column] for row in reader]
+
+def convert(args):
+    """
+        Convert an odm.py SQLite results table to a matrix store.
+    """
+    con = sqlite3.connect(args.path)
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+    # tables written using --bulk_load have integer keys, resolved by their view
+    source = '{}_view'.format(args.table) if '{}_view'.format(args.table) in tables else args.table
+    if args.originsfile is not None:
+        origins = read_ids(args.originsfile, args.id_names[0])
+        destinations = read_ids(args.destsfile, args.id_names[1])
+    else:
+        origins = [row[0] for row in con.execute('SELECT DISTINCT origin FROM "{}" ORDER BY origin'.format(source))]
+        destinations = [row[0] for row in con.execute('SELECT DISTINCT destination FROM "{}" ORDER BY destination'.format(source))]
+    layers = [(row[0], row[1].strip('"')) for row in con.execute('SELECT DISTINCT dep_time, mode FROM "{}" ORDER BY dep_time, mode'.format(source))]
+    print("Converting {} origins, {} destinations and {} departure time and mode layers from {} to {}".format(len(origins), len(destinations), len(layers), source, args.out))
+    store = create(args.out, origins, destinations, layers, args.dtype)
+    cursor = con.execute('SELECT origin, destination, dep_time, mode, dist_m, time_mins FROM "{}"'.format(source))
+    count = 0
+    while True:
+        rows = cursor.fetchmany(args.chunksize)
+        if len(rows) == 0:
+            break
+        groups = {}
+        for origin, destination, dep_time, mode, dist_m, time_mins in rows:
+            i, j = store.origin_index.get(origin), store.destination_index.get(destination)
+            if i is None or j is None:
+                continue
+            group = groups.setdefault((dep_time, mode.strip('"')), ([], [], [], []))
+            group[0].append(i)
+            group[1].append(j)
+            group[2].append(time_mins)
+            group[3].append(dist_m)
+        for (dep_time, mode), (i, j, times, dists) in groups.items():
+            time_array, dist_array = store.layers[(dep_time, mode)]
+            time_array[i, j] = store.encode(times, 'time')
+            dist_array[i, j] = store.encode(dists, 'dist')
+        count += len(rows)
+    store.flush()
+    con.close()
+    print("Converted {} rows".format(count))
+
+def write_values(store, ids, values, label):
+    writer = csv.writer(sys.stdout)
+    writer.writerow([label, 'value'])
+    for x, value in zip(ids, values):
+        writer.writerow([x, '' if np.isnan(value) else '{:g}'.format(value)])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dense binary matrix store for origin destination results')
+    parser.add_argument('action',
+                        help='convert a SQLite results table; report a store\'s contents; or write an origin row or destination column as csv',
+                        choices=['convert', 'info', 'row', 'column'])
+    parser.add_argument('path',
+                        help='SQLite database (convert) or matrix store')
+    parser.add_argument('id',
+                        help='origin (row) or destination (column) ID',
+                        nargs='?',
+                        default=None)
+    parser.add_argument('--table',
+                        help='results table to convert')
+    parser.add_argument('--out',
+                        help='matrix store to write (default: the database path, with extension .odmx)',
+                        default=None)
+    parser.add_argument('--dtype',
+                        help='stored value type (default: float32)',
+                        choices=sorted(DTYPES.keys()),
+                        default='float32')
+    parser.add_argument('--originsfile',
+                        help='origins csv file, giving the full set and order of origin IDs (default: those in the results, sorted)',
+                        default=None)
+    parser.add_argument('--destsfile',
+                        help='destinations csv file, giving the full set and order of destination IDs',
+                        default=None)
+    parser.add_argument('--id_names',
+                        help='ID columns of the origins and destinations files',
+                        nargs=2,
+                        default=['SA1_MAINCO', 'DZN_CODE_2016'])
+    parser.add_argument('--chunksize',
+                        help='number of rows converted at a time (default: 1000000)',
+                        default=1000000,
+                        type=int)
+    parser.add_argument('--mode',
+                        help='mode of the row or column')
+    parser.add_argument('--dep_time',
+                        help='departure time of the row or column (default: the first for the mode)',
+                        default=None)
+    parser.add_argument('--field',
+                        help='travel time (minutes) or walk distance (metres) (default: time)',
+                        choices=['time', 'dist'],
+                        default='time')
+    args = parser.parse_args()
+    if args.action == 'convert':
+        if args.table is None:
+            parser.error('a --table must be specified to convert')
+        if (args.originsfile is None) != (args.destsfile is None):
+            parser.error('specify both --originsfile and --destsfile, or neither')
+        if args.out is None:
+            args.out = '{}.odmx'.format(os.path.splitext(args.path)[0])
+        convert(args)
+    elif args.action == 'info':
+        store = MatrixStore(args.path)
+        print("{} origins, {} destinations, {}".format(len(store.origins), len(store.destinations), store.header['dtype']))
+        for dep_time, mode in sorted(store.layers):
+            print("{}\t{}".format(dep_time, mode))
+    else:
+        if args.id is None or args.mode is None:
+            parser.error('an ID and --mode must be specified')
+        store = MatrixStore(args.path)
+        if args.action == 'row':
+            write_values(store, store.destinations, store.origin_row(args.id, args.mode, args.dep_time, args.field), 'destination')
+        else:
+            write_values(store, store.origins, store.destination_column(args.id, args.mode, args.dep_time, args.field), 'origin')
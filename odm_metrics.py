@@ -0,0 +1,127 @@
+# !/usr/bin/jython
+
+# Instrumentation for odm.py (see --metrics).
+# The phases of evaluating an origin are timed for each transport mode: planning the shortest
+# path tree (plan), sampling it for the accessibility surface (raster, see --raster), evaluating
+# it for the destinations (eval) and filtering and formatting the results (filter); writing an
+# origin's results (write) covers all of its modes in a single transaction, so is recorded under
+# the mode 'all'.  Timings are summarised as counts, totals and histograms, along with throughput
+# (trees and rows per second), the estimated time remaining and JVM heap use, as snapshots
+# suitable for JSON lines or a metrics table.
+
+import bisect
+import threading
+
+from java.lang import Runtime, System
+
+PHASES = ['plan', 'raster', 'eval', 'filter', 'write']
+
+# upper bounds (milliseconds) of the timing histogram buckets; a final bucket counts longer timings
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+MB = 1024.0**2
+
+def clock():
+    """
+        Return a monotonic time in seconds, with sub-millisecond resolution.
+    """
+    return System.nanoTime() / 1e9
+
+class Timing(object):
+    """
+        Count, total, maximum and histogram of the durations recorded for a phase and mode.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def quantile(self, q):
+        """
+            Return an upper bound (milliseconds) on the q quantile (0 to 1), from the histogram.
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.histogram):
+            cumulative += count
+            if count > 0 and cumulative >= rank:
+                if bucket < len(BUCKETS_MS):
+                    return min(BUCKETS_MS[bucket], self.max * 1000)
+                break
+        return self.max * 1000
+
+    def summary(self):
+        return {'count': self.count,
+                'total_s': round(self.total, 3),
+                'mean_ms': round(1000 * self.total / max(self.count, 1), 3),
+                'p50_ms': round(self.quantile(0.5), 3),
+                'p90_ms': round(self.quantile(0.9), 3),
+                'max_ms': round(self.max * 1000, 3),
+                'histogram': list(self.histogram)}
+
+class Metrics(object):
+    """
+        Thread safe record of phase timings by mode and counts of origins, trees and rows,
+        for a run evaluating total_origins origins.
+    """
+    def __init__(self, total_origins):
+        self.total_origins = total_origins
+        self.start = clock()
+        self.lock = threading.Lock()
+        self.timings = {}      # (mode, phase): Timing
+        self.counts = {'origins': 0, 'trees': 0, 'rows': 0}
+
+    def record(self, phase, mode, seconds):
+        """
+            Record the duration in seconds of a phase for a transport mode.
+        """
+        with self.lock:
+            timing = self.timings.get((mode, phase))
+            if timing is None:
+                timing = self.timings[(mode, phase)] = Timing()
+            timing.add(seconds)
+
+    def add(self, origins = 0, trees = 0, rows = 0):
+        """
+            Add to the counts of origins written, trees planned and result rows written.
+        """
+        with self.lock:
+            self.counts['origins'] += origins
+            self.counts['trees'] += trees
+            self.counts['rows'] += rows
+
+    def snapshot(self):
+        """
+            Return a dictionary of the counts, throughput, estimated time remaining (seconds;
+            None until an origin is written), heap use and phase timings by mode.
+        """
+        runtime = Runtime.getRuntime()
+        with self.lock:
+            elapsed = clock() - self.start
+            origins, trees, rows = [self.counts[x] for x in ['origins', 'trees', 'rows']]
+            timings = {}
+            for (mode, phase), timing in self.timings.items():
+                timings.setdefault(mode, {})[phase] = timing.summary()
+        eta = None
+        if origins > 0:
+            eta = round(elapsed * (self.total_origins - origins) / origins, 1)
+        return {'elapsed_s': round(elapsed, 3),
+                'origins': origins,
+                'total_origins': self.total_origins,
+                'trees': trees,
+                'rows': rows,
+                'origins_per_s': round(origins / max(elapsed, 1e-6), 3),
+                'trees_per_s': round(trees / max(elapsed, 1e-6), 3),
+                'rows_per_s': round(rows / max(elapsed, 1e-6), 3),
+                'eta_s': eta,
+                'heap_used_mb': round((runtime.totalMemory() - runtime.freeMemory()) / MB, 1),
+                'heap_max_mb': round(runtime.maxMemory() / MB, 1),
+                'buckets_ms': BUCKETS_MS,
+                'timings': timings}
@@ -0,0 +1,112 @@
+# This script is a columnar output sink for odm.py, run with --out_format parquet
+# (odm.py runs under Jython, which cannot load pyarrow, so it launches this script
+# using a Python 3 interpreter and streams result rows to it).
+#
+# Rows are read from stdin as tab separated lines:
+#     R <origin> <destination> <dep_time> <mode> <dist_m> <time_mins>
+# and buffered by partition.  On a flush line (F <batch>) the buffered rows are written as a
+# new compressed parquet file in each partition, under a temporary name, and OK is written to
+# stdout; odm.py flushes before each commit of its progress table, recording the batch in the
+# same transaction, and once committed sends a commit line (C <batch>), on which the batch's
+# files are renamed to their final names.  Written files therefore always cover completed
+# origins: rows not yet flushed when stdin is closed are discarded (their origins are planned
+# again when odm.py resumes), and temporary files of a batch whose commit was interrupted are
+# renamed or removed by odm.py when it next starts.
+#
+# The output is a hive partitioned dataset:
+#     <outdir>/region=<region>/mode=<mode>/dep_time=<dep_time>/part-<run>-<sequence>.parquet
+# with columns origin and destination (dictionary encoded strings), dist_m (int32) and
+# time_mins (float32).  It can be read with pushdown filters, for example:
+#     import pyarrow.dataset as ds
+#     ds.dataset(outdir, partitioning='hive').to_table(filter=ds.field('mode') == 'WALK')
+#
+# If running this on Ubuntu / Unix4Win you may need to
+# sudo pip3 install pyarrow
+
+import argparse
+import os
+import sys
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+schema = pa.schema([('origin', pa.string()),
+                    ('destination', pa.string()),
+                    ('dist_m', pa.int32()),
+                    ('time_mins', pa.float32())])
+
+parser = argparse.ArgumentParser(description='Write origin destination matrix rows to a partitioned parquet dataset')
+parser.add_argument('--outdir',
+                    help='output dataset directory',
+                    required=True)
+parser.add_argument('--region',
+                    help='region (project) name, used as the first partition level',
+                    required=True)
+parser.add_argument('--compression',
+                    help='parquet compression codec (default: zstd)',
+                    default='zstd')
+args = parser.parse_args()
+
+buffers = {}
+staged = {}
+
+def partition_dir(mode, dep_time):
+    """
+        Return the hive style directory for a region, mode and departure time partition.
+    """
+    return os.path.join(args.outdir,
+                        'region={}'.format(quote(args.region, safe='')),
+                        'mode={}'.format(quote(mode, safe='')),
+                        'dep_time={}'.format(quote(dep_time, safe='')))
+
+def flush(batch):
+    """
+        Write buffered rows for each partition as a new parquet file of the batch, under a
+        temporary name, and clear the buffers.
+    """
+    paths = staged.setdefault(batch, [])
+    for (mode, dep_time), columns in buffers.items():
+        if len(columns[0]) == 0:
+            continue
+        table = pa.Table.from_arrays([pa.array(columns[0], pa.string()),
+                                      pa.array(columns[1], pa.string()),
+                                      pa.array(columns[2], pa.int32()),
+                                      pa.array(columns[3], pa.float32())],
+                                     schema=schema)
+        outdir = partition_dir(mode, dep_time)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        path = os.path.join(outdir, 'part-{}-{:06d}.parquet'.format(batch, len(paths)))
+        pq.write_table(table, path + '.tmp', compression=args.compression)
+        paths.append(path)
+    buffers.clear()
+
+def publish(batch):
+    """
+        Rename the files of a committed batch to their final names.
+    """
+    for path in staged.pop(batch, []):
+        os.rename(path + '.tmp', path)
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    fields = line.rstrip('\n').split('\t')
+    if fields[0] == 'R':
+        origin, destination, dep_time, mode, dist_m, time_mins = fields[1:]
+        columns = buffers.setdefault((mode, dep_time), ([], [], [], []))
+        columns[0].append(origin)
+        columns[1].append(destination)
+        columns[2].append(int(dist_m))
+        columns[3].append(float(time_mins))
+    elif fields[0] == 'F':
+        flush(fields[1])
+        sys.stdout.write('OK\n')
+        sys.stdout.flush()
+    elif fields[0] == 'C':
+        publish(fields[1])
@@ -0,0 +1,250 @@
+# This script indexes and queries the results table of a finished odm.py database.
+#
+# The index action builds covering indexes of the results table by origin and by destination,
+# each followed by mode, departure time and travel time (as odm.py does using --index_results or
+# --bulk_load), and runs ANALYZE.  An origin's row or a destination's column is then read from an
+# index without scanning the table, in order of mode, departure time and travel time; so are the k
+# nearest destinations of an origin (or origins of a destination) for a given mode and departure
+# time, while nearest queries across modes or departure times sort just that origin's (or
+# destination's) rows.  Tables created by earlier versions of odm.py, whose columns have
+# no declared types, may be rebuilt with typed columns using --retype.
+#
+# Queries may be made from Python, with results cached by query (see ResultsQuery), e.g.
+#     from odm_query import ResultsQuery
+#     results = ResultsQuery('graphs/region06/sa1_dzn_region06_2019_0745_max_3hrs.db', 'od_modes_0745')
+#     results.origin_row('30101100101', mode = 'WALK,TRANSIT')
+#     results.nearest(origin = '30101100101', k = 10, mode = 'CAR')
+# or from the command line, writing csv:
+#   python odm_query.py index sa1_dzn_region06_2019_0745_max_3hrs.db --table od_modes_0745
+#   python odm_query.py row sa1_dzn_region06_2019_0745_max_3hrs.db --table od_modes_0745 --origin 30101100101 --mode CAR
+#   python odm_query.py column sa1_dzn_region06_2019_0745_max_3hrs.db --table od_modes_0745 --destination 1100011
+#   python odm_query.py nearest sa1_dzn_region06_2019_0745_max_3hrs.db --table od_modes_0745 --origin 30101100101 --k 10
+
+import argparse
+import collections
+import csv
+import sqlite3
+import sys
+import time
+
+RESULT_FIELDS = ['origin', 'destination', 'dep_time', 'mode', 'dist_m', 'time_mins']
+TYPED_COLUMNS = 'origin TEXT, destination TEXT, dep_time TEXT, mode TEXT, dist_m INTEGER, time_mins REAL'
+
+def table_columns(con, table):
+    """
+        Return the declared types of a table's columns, by name.
+    """
+    columns = collections.OrderedDict([(row[1], row[2]) for row in con.execute('PRAGMA table_info("{}")'.format(table))])
+    if len(columns) == 0:
+        raise ValueError('table {} does not exist'.format(table))
+    return columns
+
+def is_keyed(con, table):
+    """
+        Return True if a results table was written using --bulk_load, with integer keys.
+    """
+    return 'origin_id' in table_columns(con, table)
+
+def retype(con, table):
+    """
+        Rebuild a results table with typed columns, if they have no declared types.
+    """
+    columns = table_columns(con, table)
+    if is_keyed(con, table) or all(columns.values()):
+        return False
+    print('Rebuilding {} with typed columns...'.format(table))
+    with con:
+        con.execute('CREATE TABLE "{}_typed" ({})'.format(table, TYPED_COLUMNS))
+        con.execute('INSERT INTO "{table}_typed" SELECT {columns} FROM "{table}"'.format(table=table,
+                                                                                           columns=', '.join(['"{}"'.format(x) for x in RESULT_FIELDS])))
+        con.execute('DROP TABLE "{}"'.format(table))
+        con.execute('ALTER TABLE "{table}_typed" RENAME TO "{table}"'.format(table=table))
+    return True
+
+def index(con, table):
+    """
+        Build the covering indexes of a results table, and ANALYZE it; these match the indexes
+        built by odm.py (see indexResults).
+    """
+    if is_keyed(con, table):
+        origin, destination, mode, dep_time = 'origin_id', 'destination_id', 'mode_id', 'dep_time_id'
+    else:
+        origin, destination, mode, dep_time = 'origin', 'destination', 'mode', 'dep_time'
+    for name, first, other in [('origin', origin, destination), ('destination', destination, origin)]:
+        start = time.time()
+        # superseded by the covering index
+        con.execute('DROP INDEX IF EXISTS "{}_{}_idx"'.format(table, name))
+        con.execute('''CREATE INDEX IF NOT EXISTS "{table}_{name}_cover"
+                       ON "{table}" ({first}, {mode}, {dep_time}, time_mins, {other}, dist_m)'''.format(table=table,
+                                                                                                        name=name,
+                                                                                                        first=first,
+                                                                                                        mode=mode,
+                                                                                                        dep_time=dep_time,
+                                                                                                        other=other))
+        print('Indexed {} by {} ({:.1f} s)'.format(table, name, time.time() - start))
+    con.execute('ANALYZE "{}"'.format(table))
+    con.commit()
+
+class ResultsQuery(object):
+    """
+        Queries of an indexed results table, returning lists of (origin, destination, dep_time,
+        mode, dist_m, time_mins) tuples, with modes unquoted; the results of up to cache_size
+        queries are cached by query key.  Tables written using --bulk_load are queried by their
+        integer keys.
+    """
+    def __init__(self, path, table, cache_size = 1024):
+        self.con = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+        self.table = table
+        self.keyed = is_keyed(self.con, table)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.stats = {'hits': 0, 'misses': 0}
+        self.key_ids = {}
+
+    def key_id(self, field, value):
+        """
+            Return the integer key of a value of a field in a keyed table (None if absent).
+        """
+        if (field, value) not in self.key_ids:
+            row = self.con.execute('SELECT id FROM "{table}_{field}_keys" WHERE {field} = ?'.format(table=self.table, field=field),
+                                   (value,)).fetchone()
+            self.key_ids[(field, value)] = None if row is None else row[0]
+        return self.key_ids[(field, value)]
+
+    def select(self, by, value, mode, dep_time, order, limit):
+        """
+            Return rows with the given origin or destination (by), and optionally mode and
+            departure time, in index order (mode, departure time, travel time and the other key),
+            or in order of travel time if order is 'time'.
+        """
+        other = 'destination' if by == 'origin' else 'origin'
+        conditions = []
+        params = []
+        if self.keyed:
+            source = '''"{table}" r
+                        JOIN "{table}_origin_keys" o ON r.origin_id = o.id
+                        JOIN "{table}_destination_keys" d ON r.destination_id = d.id
+                        JOIN "{table}_dep_time_keys" t ON r.dep_time_id = t.id
+                        JOIN "{table}_mode_keys" m ON r.mode_id = m.id'''.format(table=self.table)
+            fields = 'o.origin, d.destination, t.dep_time, m.mode, r.dist_m, r.time_mins'
+            for field, filter_value in [(by, value), ('mode', mode), ('dep_time', dep_time)]:
+                if filter_value is None:
+                    continue
+                key = self.key_id(field, filter_value)
+                if key is None:
+                    return []
+                conditions.append('r.{}_id = ?'.format(field))
+                params.append(key)
+            sort = 'r.time_mins' if order == 'time' else 'r.mode_id, r.dep_time_id, r.time_mins, r.{}_id'.format(other)
+        else:
+            source = '"{}" r'.format(self.table)
+            fields = ', '.join(['r.{}'.format(x) for x in RESULT_FIELDS])
+            for field, filter_value in [(by, value), ('mode', None if mode is None else '"{}"'.format(mode)), ('dep_time', dep_time)]:
+                if filter_value is not None:
+                    conditions.append('r.{} = ?'.format(field))
+                    params.append(filter_value)
+            sort = 'r.time_mins' if order == 'time' else 'r.mode, r.dep_time, r.time_mins, r.{}'.format(other)
+        query = 'SELECT {} FROM {} WHERE {} ORDER BY {}'.format(fields, source, ' AND '.join(conditions), sort)
+        if limit is not None:
+            query += ' LIMIT {:d}'.format(limit)
+        return [row[:3] + (row[3].strip('"'),) + row[4:] for row in self.con.execute(query, params)]
+
+    def cached(self, key, *query):
+        if key in self.cache:
+            self.cache[key] = self.cache.pop(key)
+            self.stats['hits'] += 1
+            return self.cache[key]
+        self.stats['misses'] += 1
+        rows = self.select(*query)
+        self.cache[key] = rows
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return rows
+
+    def origin_row(self, origin, mode = None, dep_time = None):
+        """
+            Return the results from an origin, optionally for a mode and departure time.
+        """
+        return self.cached(('row', origin, mode, dep_time), 'origin', origin, mode, dep_time, None, None)
+
+    def destination_column(self, destination, mode = None, dep_time = None):
+        """
+            Return the results to a destination, optionally for a mode and departure time.
+        """
+        return self.cached(('column', destination, mode, dep_time), 'destination', destination, mode, dep_time, None, None)
+
+    def nearest(self, origin = None, destination = None, k = 10, mode = None, dep_time = None):
+        """
+            Return the k results with the least travel time from an origin (or to a destination),
+            optionally for a mode and departure time.
+        """
+        by, value = ('origin', origin) if origin is not None else ('destination', destination)
+        return self.cached(('nearest', by, value, k, mode, dep_time), by, value, mode, dep_time, 'time', k)
+
+    def close(self):
+        self.con.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index and query the results table of a finished odm.py database')
+    parser.add_argument('action',
+                        help='build the results indexes; or write the results from origins (row), to destinations (column), or the k nearest, as csv',
+                        choices=['index', 'row', 'column', 'nearest'])
+    parser.add_argument('db',
+                        help='odm.py output database')
+    parser.add_argument('--table',
+                        help='results table',
+                        required=True)
+    parser.add_argument('--retype',
+                        help='when indexing, first rebuild a results table whose columns have no declared types with typed columns',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--origin',
+                        help='origin ID(s) queried',
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--destination',
+                        help='destination ID(s) queried',
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--mode',
+                        help='mode queried (default: all)',
+                        default=None)
+    parser.add_argument('--dep_time',
+                        help='departure time queried, as recorded in the results (default: all)',
+                        default=None)
+    parser.add_argument('--k',
+                        help='number of nearest results (default: 10)',
+                        default=10,
+                        type=int)
+    args = parser.parse_args()
+    if args.action == 'index':
+        con = sqlite3.connect(args.db)
+        if args.retype:
+            retype(con, args.table)
+        index(con, args.table)
+        con.close()
+        sys.exit(0)
+    if args.action == 'row' and args.origin is None:
+        parser.error('row requires --origin')
+    if args.action == 'column' and args.destination is None:
+        parser.error('column requires --destination')
+    if args.action == 'nearest' and (args.origin is None) == (args.destination is None):
+        parser.error('nearest requires either --origin or --destination')
+    results = ResultsQuery(args.db, args.table)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(RESULT_FIELDS)
+    start = time.time()
+    count = 0
+    for value in (args.origin or args.destination):
+        if args.action == 'row':
+            rows = results.origin_row(value, args.mode, args.dep_time)
+        elif args.action == 'column':
+            rows = results.destination_column(value, args.mode, args.dep_time)
+        elif args.origin is not None:
+            rows = results.nearest(origin=value, k=args.k, mode=args.mode, dep_time=args.dep_time)
+        else:
+            rows = results.nearest(destination=value, k=args.k, mode=args.mode, dep_time=args.dep_time)
+        writer.writerows(rows)
+        count += len(rows)
+    results.close()
+    sys.stderr.write('{} rows in {:.1f} ms\n'.format(count, (time.time() - start) * 1000))
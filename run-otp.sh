@@ -9,6 +9,8 @@ VERBOSE=0   # default, not verbose
 BUILD_GRAPH=0   # default is to build the graph and run otp
 RUN_OTP=0
 CALCULATE_ODM=0
+RUN_BATCH=0
+RUN_CLUSTER=0
 
 ############################################################################
 # Usage
@@ -33,9 +35,16 @@ usage: $(basename $0) [options]
                   -h, --help            show this help message and exit
                   --departure_time DEPARTURE_TIME
                                         departure time - format YYYY-MM-DD-HH:MM:SS
+                  --time_zone TIME_ZONE
+                                        Time zone of the departure time, e.g.
+                                        Australia/Queensland (default: the JVM time zone, as
+                                        set by run-otp.sh -t)
                   --duration_reps DURATION_REPS DURATION_REPS
                                         Two optional parameters defining a time duration and a
-                                        repeat interval in hours.
+                                        repeat interval in hours. For example, departures
+                                        every 5 minutes from 07:00 to 09:00 are specified
+                                        using --departure_time YYYY-MM-DD-07:00:00
+                                        --duration_reps 2 0.083333
                   --proj_dir PROJ_DIR   project directory
                   --originsfile ORIGINSFILE
                                         path to the input csv file, which contains coordinates
@@ -47,6 +56,27 @@ usage: $(basename $0) [options]
                                         traveltime_matrix)
                   --outtable OUTTABLE   path to the output sqlite database (default:
                                         traveltime_matrix)
+                  --out_format {sqlite,parquet,matrix}
+                                        Format for results: sqlite, recorded in OUTTABLE of
+                                        the output database; parquet, a partitioned
+                                        (region/mode/departure time) dataset written
+                                        incrementally to directory OUTDB_OUTTABLE (without
+                                        the database extension), using the Python 3
+                                        interpreter given by --python with pyarrow installed
+                                        (implies --checkpoint); or matrix, a dense binary
+                                        matrix store OUTDB_OUTTABLE.odmx of travel times and
+                                        distances for every origin and destination
+                                        (one-to-many only; implies --checkpoint), which may
+                                        be memory-mapped using odm_matrix.py. Inputs,
+                                        summaries and progress are recorded in the output
+                                        database in any case (default: sqlite)
+                  --matrix_dtype {float32,int16}
+                                        Value type of the matrix store for --out_format
+                                        matrix: float32 (minutes and metres), or int16
+                                        (tenths of minutes and tens of metres; half the
+                                        size) (default: float32)
+                  --python PYTHON       Python 3 interpreter used to run odm_parquet_sink.py
+                                        for --out_format parquet (default: python3)
                   --max_time MAX_TIME   maximum travel time in seconds (default: 7200)
                   --max_walking_distance MAX_WALKING_DISTANCE
                                         maximum walking distance in meters (default: 500)
@@ -66,6 +96,39 @@ usage: $(basename $0) [options]
                   --matching MATCHING   How origins and destinations should be matched. Can be
                                         either one-to-one or one-to-many (default: one-to-
                                         many)
+                  --reuse_modes         Plan each distinct useful combination of modes once
+                                        per origin (e.g. with --combinations): transit is
+                                        dropped from the combinations of an origin where
+                                        none of their transit modes serve stops within its
+                                        reach, combinations reducing to the same modes share
+                                        results, and combinations without transit are
+                                        planned once across departure times
+                  --dedup_origins DEDUP_ORIGINS
+                                        For one-to-many matching, plan once for each group
+                                        of origins with identical coordinates (0), or within
+                                        the given tolerance in metres of the first origin of
+                                        a group, writing the results for every origin ID in
+                                        the group (implies --checkpoint)
+                  --raster RASTER       Sample each shortest path tree onto a regional grid of
+                                        cells of the given size in metres, recording for each
+                                        departure time and mode the minimum travel time to
+                                        each cell from any origin and the number of origins
+                                        reaching it within RASTER_CUTOFF, as memory-mapped
+                                        rasters with GDAL VRT headers in directory
+                                        OUTDB_OUTTABLE_surface
+                  --raster_extent RASTER_EXTENT RASTER_EXTENT RASTER_EXTENT RASTER_EXTENT
+                                        Extent of the --raster grid in decimal degrees: top
+                                        bottom left right (default: the extent of the
+                                        destinations, with a margin of one cell)
+                  --raster_cutoff RASTER_CUTOFF
+                                        Travel time in minutes within which cells are counted
+                                        as reached by an origin, for --raster (default:
+                                        MAX_TIME)
+                  --group_pairs         For one-to-one matching, group the destinations paired
+                                        with each distinct origin, so that one shortest path
+                                        tree is planned per origin and mode and evaluated for
+                                        the whole group (rather than one per pair); implied by
+                                        --checkpoint
                   --combinations        Create all combinations of supplied destination list
                   --id_names [ID_NAMES [ID_NAMES ...]]
                                         Names of respective ID fields for source Origin and
@@ -73,10 +136,123 @@ usage: $(basename $0) [options]
                   --latlon_names [LATLON_NAMES [LATLON_NAMES ...]]
                                         Names of latitude and longitude fields in source
                                         Origin and Destination csv fields (default: lat lon)
-                  --wideform            Transpose data to wideform from longform main output
+                  --wideform            Transpose data to wideform from longform main output:
+                                        results are also recorded in table OUTTABLE_wide, with
+                                        a row for each origin, destination and departure time,
+                                        and travel time and distance columns for each mode;
+                                        this is built as each origin is processed
+                  --window_output {rows,summary,both}
+                                        Output for a sweep of departure times (see
+                                        --duration_reps): rows, a result for each departure
+                                        time; summary, travel time statistics for each
+                                        origin, destination and mode across the time window
+                                        (recorded in table OUTTABLE_summary; implies
+                                        --checkpoint); or both (default: rows)
+                  --percentiles [PERCENTILES [PERCENTILES ...]]
+                                        Percentiles of travel time across the departure time
+                                        window to be recorded in the summary table, in
+                                        addition to minimum, median and maximum (default: 90)
+                  --cutoffs [CUTOFFS [CUTOFFS ...]]
+                                        Travel times in minutes (e.g. 30 45 60; up to
+                                        --max_time) within which destinations reached are
+                                        counted (and weighted, see --weight_column) for each
+                                        origin, departure time and mode, recorded in table
+                                        OUTTABLE_access along with the gravity measure (see
+                                        --decay)
+                  --weight_column WEIGHT_COLUMN
+                                        Column of the destinations file weighting each
+                                        destination (e.g. jobs) in the measures recorded using
+                                        --cutoffs (default: each destination has weight 1)
+                  --decay {exponential,power,linear}
+                                        Decay function of travel time t (minutes) for the
+                                        gravity measure recorded using --cutoffs, the sum of
+                                        the weights of destinations reached multiplied by:
+                                        exponential, exp(-DECAY_PARAM * t); power, max(t,
+                                        1)^-DECAY_PARAM; or linear, max(0, 1 - t /
+                                        DECAY_PARAM) (default: none, no gravity measure)
+                  --decay_param DECAY_PARAM
+                                        Parameter of the --decay function; greater than 0
+                                        for linear (default: 0.1 for exponential, 1 for
+                                        power, the maximum time in minutes for linear)
+                  --aggregate_only      Record only the measures of destinations reached (see
+                                        --cutoffs), and not rows for each origin and
+                                        destination (nor the summary or wide form tables);
+                                        implies --checkpoint
+                  --checkpoint          Record completed (origin, departure time, mode) units
+                                        in a progress table (OUTTABLE_progress), in the same
+                                        transaction as their results; on restart, completed
+                                        units are skipped, regardless of the order of origins
+                                        in the input file
+                  --bulk_load           Write results using integer keys for origin,
+                                        destination, departure time and mode (with lookup
+                                        tables OUTTABLE_origin_keys etc, and a view
+                                        OUTTABLE_view with the usual text columns), reused
+                                        prepared statements, commits batched across origins
+                                        (see --commit_every) and SQLite settings tuned for
+                                        bulk loading; indexes are created once loading has
+                                        finished. Implies --checkpoint.
+                  --index_results       Once the run has finished, build covering indexes of
+                                        the results table by origin and by destination (each
+                                        followed by mode, departure time and travel time),
+                                        and ANALYZE it, for fast row, column and nearest
+                                        destination queries (see odm_query.py); always done
+                                        with --bulk_load
+                  --commit_every COMMIT_EVERY
+                                        Number of origins written per transaction when using
+                                        --bulk_load (default: 100)
+                  --stream_inputs       Read each input csv once in chunks, staging it to the
+                                        database and building the OTP population in the same
+                                        pass (rather than copying inputs via an intermediate
+                                        _updated.csv file)
+                  --chunk_size CHUNK_SIZE
+                                        Number of rows read and staged at a time when using
+                                        --stream_inputs (default: 10000)
+                  --restage_inputs      Stage the input csv files to the database even if
+                                        they are unchanged since they were last staged for
+                                        OUTTABLE (by default, unchanged inputs, as
+                                        identified by their path, size and SHA-1 digest, are
+                                        read directly into the OTP populations without being
+                                        staged again)
+                  --prune_dests         For one-to-many matching, only evaluate each shortest
+                                        path tree for destinations within the straight line
+                                        distance reachable within --max_time at the maximum
+                                        speed of its modes (see MAX_SPEEDS); the travel time
+                                        limit is still applied to the results
+                  --workers WORKERS     Number of threads planning disjoint shards of origins
+                                        against the shared router; results are written in
+                                        origin order by a single writer (default: 1)
+                  --queue_size QUEUE_SIZE
+                                        Maximum number of origins planned ahead of the
+                                        writer, which writes results in origin order;
+                                        workers pause while this many origins are being
+                                        planned or awaiting the writer (default: 4 x
+                                        WORKERS)
+                  --progress_interval PROGRESS_INTERVAL
+                                        Minimum interval in seconds between progress
+                                        reports (default: 10)
+                  --metrics {jsonl,table}
+                                        With each progress report, record timings of the
+                                        plan, eval, filter and write phases by mode,
+                                        throughput, estimated time remaining and heap use
+                                        (see odm_metrics.py): jsonl, appended as JSON lines
+                                        to OUTDB_OUTTABLE_metrics.jsonl; or table, in table
+                                        OUTTABLE_metrics
                   --cmd CMD             The command used to call the python script may be
                                         specified; if so it is recorded to the log txt file.
     -r       run Open Trip Planner (use -x too if needed)
+    -b FILE  Run a batch of odm.py jobs listed in a JSON manifest within a single JVM, using
+             odm_batch.py; each graph is loaded once for all of its jobs (see odm_batch.py for
+             the manifest format).  The JVM maximum heap may be set using the OTP_HEAP
+             environment variable (default: 4G), and the time zone of jobs without a
+             time_zone entry using -t, as for a single job.  Loaded graphs are kept resident,
+             subject to a memory budget; to keep them resident across batches, run with
+             -b "--watch SPOOL_DIR" and place manifests in the spool directory.
+    -c ARGS  Distribute odm.py jobs across nodes sharing a spool directory, using odm_cluster.py
+             with the given arguments, in quotes: "submit MANIFEST --spool DIR" splits a
+             manifest's jobs into tasks by origin chunk and departure time; "work --spool DIR",
+             run on each node, claims and runs tasks, writing each to its own shard; and
+             "merge --spool DIR" combines the shards of completed jobs into their outdb.
+             Tasks from failed or stalled workers are leased out again (see odm_cluster.py).
     
 There is an assumption that GTFS.zip, osm.pbf and (optionally) .tif data are stored 
 in the./graphs/project_folder directory.  
@@ -113,7 +289,7 @@ END_HELP
 ############################################################################
 getOptions() {
   local OPTIND;
-  while getopts ":hvd:p:t:rw:x" opt; do
+  while getopts ":hvd:p:t:rw:xb:c:" opt; do
     case "$opt" in
       v) VERBOSE=1 ;;
       d) PROJ_NAME=${OPTARG}; PROJ_DIR=${DIR}/graphs/${OPTARG};;
@@ -122,6 +298,8 @@ getOptions() {
       r) RUN_OTP=1 ;;
       w) CALCULATE_ODM=1 ; ODM_ARGS=$OPTARG ;;
       x) BUILD_GRAPH=1 ;;
+      b) RUN_BATCH=1 ; MANIFEST=$OPTARG ;;
+      c) RUN_CLUSTER=1 ; CLUSTER_ARGS=$OPTARG ;;
       h) usage ; exit 0 ;;
       \?) echo "Invalid option: -$OPTARG" >&2 ; usage >&2; exit 1 ;;
       :) echo "Option -$OPTARG requires an argument." >&2; exit 1 ;;
@@ -184,6 +362,34 @@ calculateODM() {
   if [ $VERBOSE -eq 1 ] ; then echo $CMD; fi; eval $CMD
 }
 
+############################################################################
+# Run a batch of Origin Destination Matrix jobs in a single JVM
+############################################################################
+runBatch() {
+  if [ ! -f "$JYTHONJAR" ]; then
+    CMD="wget -O $JYTHONJAR http://search.maven.org/remotecontent?filepath=org/python/jython-standalone/2.7.0/jython-standalone-2.7.0.jar"
+    if [ $VERBOSE -eq 1 ] ; then echo $CMD; fi; eval $CMD
+  fi
+
+  CMD="java -Xmx${OTP_HEAP:-4G} -Duser.timezone=$TIME_ZONE -cp $OTPJAR:$JYTHONJAR:$SQLITEJAR org.python.util.jython $BATCH_SCRIPT $MANIFEST"
+  echo $CMD
+  eval $CMD
+}
+
+############################################################################
+# Run a distributed Origin Destination Matrix action (submit, work, merge or status)
+############################################################################
+runCluster() {
+  if [ ! -f "$JYTHONJAR" ]; then
+    CMD="wget -O $JYTHONJAR http://search.maven.org/remotecontent?filepath=org/python/jython-standalone/2.7.0/jython-standalone-2.7.0.jar"
+    if [ $VERBOSE -eq 1 ] ; then echo $CMD; fi; eval $CMD
+  fi
+
+  CMD="java -Xmx${OTP_HEAP:-4G} -Duser.timezone=$TIME_ZONE -cp $OTPJAR:$JYTHONJAR:$SQLITEJAR org.python.util.jython $CLUSTER_SCRIPT $CLUSTER_ARGS"
+  echo $CMD
+  eval $CMD
+}
+
 ############################################################################
 # Main script starts here
 ############################################################################
@@ -192,8 +398,12 @@ OTPJAR=${DIR}/otp-0.19.0-shaded.jar
 JYTHONJAR=${DIR}/jython-standalone-2.7.0.jar
 SQLITEJAR=${DIR}/sqlite-jdbc-3.23.1.jar
 ODM_SCRIPT=${DIR}/odm.py
+BATCH_SCRIPT=${DIR}/odm_batch.py
+CLUSTER_SCRIPT=${DIR}/odm_cluster.py
 getOptions "$@"
 
 if [ $BUILD_GRAPH -eq 1 ] ; then buildGraph ; fi
 if [ $CALCULATE_ODM -eq 1 ] ; then calculateODM $ODM_ARGS; fi
+if [ $RUN_BATCH -eq 1 ] ; then runBatch ; fi
+if [ $RUN_CLUSTER -eq 1 ] ; then runCluster ; fi
 if [ $RUN_OTP -eq 1 ] ; then runOTP ; fi